@@ -1,44 +1,243 @@
-import configparser
-import json
+import hashlib
 import logging
 import os
+import tarfile
+import tempfile
 import requests
-from threading import Event
-from time import time, sleep
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Event, Lock, RLock, Thread
+from time import monotonic, perf_counter
 from queue import Queue
 from requests import Response
+from requests.adapters import HTTPAdapter
 from datetime import datetime
-from copy import copy
-
-parser = configparser.ConfigParser()
-parser.read('config.ini')
-logging.basicConfig(
-    filename=parser.get('app_config', 'log_path'),
-    format='%(name)s | %(asctime)s | %(levelname)s | %(message)s',
-    level=logging.INFO
+from contextlib import nullcontext
+from typing import Optional
+from config import Config, ConfigStore, DEFAULT_PAIR
+from change_detector import detect_changes, is_changed, same_stat, stat_file
+from reconciliation import (
+    RemoteListingError, REMOTE_FIELDS, OVERWRITE, DELETE, RECORD, FORGET, DOWNLOAD, DELETE_LOCAL, CONFLICT,
+    bidirectional_diff, build_remote_index, removed_folders, three_way_diff, two_way_diff, untracked_remote_paths
 )
-logger = logging.getLogger('synchronizer')
+from watcher import FolderWatch
+from tree_index import TreeIndex
+from record_keeping import RecordKeeping, open_record_keeping
+from journal import IntentJournal
+from transfer import (
+    BandwidthLimiter, TransferAborted, TransferProgress, UploadStream, backoff_delay, parse_bandwidth_schedule, MEGABYTE
+)
+from request_executor import (
+    CircuitBreaker, RequestExecutor, TokenBucket, RETRYABLE_STATUS_CODES, TRANSFER_ERRORS, retry_delay
+)
+from stability import StabilityGate, clone_file
+from events import create_events_hash
+from scheduler import FairTaskPool, LargeFileLane, OperationPoller, is_large_task, parse_patterns, task_priority
+from compression import COMPRESSION_SUFFIXES, choose_codec, compress_file, parse_extensions, zstandard
+from metrics import DURATION_BUCKETS, LATENCY_BUCKETS, THROUGHPUT_BUCKETS, MetricsExporter, metrics, profile_to
+from delta import SignatureStore, build_manifest, chunk_rel_path, compute_signature, diff_signatures, MANIFEST_SUFFIX
+from packing import BUNDLES_FOLDER, BundleWriter, PackIndex, is_packed, new_bundle_rel_path
+
 CONFIG_PATH = 'config.ini'
+config_store = ConfigStore(CONFIG_PATH)
+LOG_FORMAT = '%(name)s | %(asctime)s | %(levelname)s | %(message)s'
+logger = logging.getLogger('synchronizer')
+# Downloads are written next to their target under this prefix and renamed into place when complete
+PARTIAL_DOWNLOAD_PREFIX = '.~file_synch.'
+# Passes a single run makes again for files still being written
+SETTLE_ROUNDS = 3
+# Seconds of streaming between checks of config.ini for edited bandwidth options
+BANDWIDTH_CHECK_INTERVAL = 5.0
+
+
+def _counting_pool_class(pool_class, count_connect):
+    # Pools keep their connection objects and a dropped or non keep-alive connection connects again in place,
+    # so TCP connects are counted in the connection itself
+    class CountingConnection(pool_class.ConnectionCls):
+        def connect(self):
+            super().connect()
+            count_connect()
+
+    return type(pool_class.__name__, (pool_class,), {'ConnectionCls': CountingConnection})
+
+
+class _CountingHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self._stats_lock = RLock()
+        self._connects_count = 0
+        self._disposed_requests = 0
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: _counting_pool_class(pool_class, self._count_connect)
+            for scheme, pool_class in self.poolmanager.pool_classes_by_scheme.items()
+        }
+        dispose_func = self.poolmanager.pools.dispose_func
+
+        def dispose_with_counting(pool):
+            with self._stats_lock:
+                self._disposed_requests += pool.num_requests
+            dispose_func(pool)
+
+        self.poolmanager.pools.dispose_func = dispose_with_counting
+
+    def _count_connect(self):
+        with self._stats_lock:
+            self._connects_count += 1
+
+    def connection_stats(self) -> dict[str, int]:
+        with self._stats_lock:
+            created = self._connects_count
+            requests_count = self._disposed_requests
+            for key in self.poolmanager.pools.keys():
+                pool = self.poolmanager.pools.get(key)
+                if pool is not None:
+                    requests_count += pool.num_requests
+        return {'created': created, 'reused': max(0, requests_count - created)}
+
+
+def create_session(pool_size: int, hosts_count: int, keep_alive: bool, headers: dict[str, str] = None) -> requests.Session:
+    session = requests.Session()
+    adapter = _CountingHTTPAdapter(pool_connections=hosts_count, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if headers:
+        session.headers.update(headers)
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+    return session
+
+
+def get_pair_config(pair_name: str, refresh: bool = False) -> Optional[Config]:
+    config = config_store.refresh() if refresh else config_store.current
+    return config.pair_config(pair_name)
+
+
+class ApiTransport:
+    # Connection pools, rate limiter and circuit breaker of the Disk API, one for all sync pairs.
+    # The token is sent with every request, so pairs of different accounts share the connections.
+    def __init__(self, config: Config, exit_event: Event):
+        # Points to a mock server in benchmarks, see benchmarks/mock_disk_api.py
+        self.base_url = config.api_base_url.rstrip('/') + '/'
+        self.timeout = config.request_timeout
+        self._exit_event = exit_event
+        pool_size = max(config.pool_size, config.workers)
+        headers = {
+            'Accept': 'application/json',
+            'Content-Type': 'application/json',
+        }
+        # Disk API is a single host, upload hrefs are spread over several storage hosts
+        self.api_session = create_session(pool_size, 1, config.keep_alive, headers)
+        self.upload_session = create_session(pool_size, 4, config.keep_alive)
+        self.executor = RequestExecutor(
+            TokenBucket(config.api_rate, config.api_burst),
+            CircuitBreaker(config.breaker_threshold, config.breaker_reset),
+            config.api_retries,
+            self.wait,
+        )
+        # One uplink for all pairs, the limiter follows the options of [app_config]
+        self.bandwidth = BandwidthLimiter()
+        self._bandwidth_lock = RLock()
+        self._bandwidth_settings = None
+        self._bandwidth_error = None
+        self._bandwidth_checked = monotonic()
+        self.apply_bandwidth(config)
+        metrics.register_collector('api', lambda: [
+            ('file_synch_api_retries_total', {}, self.executor.retries_count),
+            ('file_synch_api_rate', {}, self.executor.bucket.rate),
+            ('file_synch_upload_bandwidth_bytes', {}, self.bandwidth.current_rate()),
+            *(
+                ('file_synch_http_connections_total', {'session': session, 'connection': state}, count)
+                for session, stats in self.connection_stats().items() for state, count in stats.items()
+            ),
+        ])
+
+    def wait(self, seconds: float) -> bool:
+        return not self._exit_event.wait(seconds)
+
+    def connection_stats(self) -> dict[str, dict[str, int]]:
+        return {
+            'api': self.api_session.get_adapter(self.base_url).connection_stats(),
+            'upload': self.upload_session.get_adapter('https://').connection_stats(),
+        }
+
+    def apply_bandwidth(self, config: Config):
+        # Parses the bandwidth options again when they changed, a malformed schedule keeps the previous windows
+        settings = (config.bandwidth_limit, config.bandwidth_schedule)
+        with self._bandwidth_lock:
+            if settings == self._bandwidth_settings:
+                return
+            self._bandwidth_settings = settings
+            windows = None
+            try:
+                windows = parse_bandwidth_schedule(config.bandwidth_schedule)
+            except ValueError as e:
+                self._bandwidth_error = f'Bandwidth schedule is not applied. {e}'
+            self.bandwidth.configure(max(0, config.bandwidth_limit), windows)
+
+    def pop_bandwidth_error(self) -> Optional[str]:
+        with self._bandwidth_lock:
+            error, self._bandwidth_error = self._bandwidth_error, None
+        return error
+
+    def throttle_upload(self, bytes_count: int):
+        # Called for every block an upload reads, config.ini is checked for edits every few seconds of streaming
+        now = monotonic()
+        if now - self._bandwidth_checked >= BANDWIDTH_CHECK_INTERVAL:
+            self._bandwidth_checked = now
+            self.apply_bandwidth(config_store.refresh())
+        delay = self.bandwidth.reserve(bytes_count)
+        if delay:
+            self.wait(delay)
 
 
 class Synchronizer:
-    def __init__(self, token: str, events_hash: dict[str, Event], queue: Queue):
+    def __init__(self, token: str, events_hash: dict[str, Event], queue: Queue, pair_name: str = DEFAULT_PAIR, transport: Optional[ApiTransport] = None):
         self._token = token
         self._events_hash = events_hash
         self._queue = queue
-        self._headers = {
-            'Accept': 'application/json',
-            'Content-Type': 'application/json',
-            'Authorization': f'OAuth {self._token}',
-        }
-        self._base_url = 'https://cloud-api.yandex.net/v1/disk/'
+        self.pair_name = pair_name
+        self._headers = {'Authorization': f'OAuth {self._token}'}
+        self._events_lock = RLock()
+        self._folders_lock = RLock()
+        self._known_folders = set()
+        self._config = get_pair_config(pair_name) or config_store.current
+
+        self._transport = transport or ApiTransport(config_store.current, events_hash['exit_event'])
+        self._base_url = self._transport.base_url
+        self._timeout = self._transport.timeout
+        self._api_session = self._transport.api_session
+        self._upload_session = self._transport.upload_session
+        self._executor = self._transport.executor
+        # Deletes answered with 202 finish in the background, see collect_remote_operations
+        self.operations = OperationPoller(self.operation_status, self._config.operation_poll_interval, events_hash['wake_event'].set)
+
+    def _request(self, operation: str, method: str, url: str, **kwargs) -> Response:
+        # operation is the name of the calling method, latencies and status codes are counted by it
+        def send() -> Response:
+            with metrics.timer('file_synch_api_request_duration_seconds', LATENCY_BUCKETS, operation=operation):
+                response = self._api_session.request(method, url, headers=self._headers, timeout=self._timeout, **kwargs)
+            metrics.increment('file_synch_api_responses_total', operation=operation, status=response.status_code)
+            return response
+
+        return self._executor.execute(send)
+
+    def pair_config(self, reload: bool = False) -> Config:
+        # The last known one is kept if the pair disappeared from config.ini, its loop stops at the next pass
+        if reload:
+            config_store.refresh(True)
+        self._config = get_pair_config(self.pair_name) or self._config
+        return self._config
 
     def _check_local_folder_change(self):
+        with self._events_lock:
+            return self._check_local_folder_change_locked()
+
+    def _check_local_folder_change_locked(self):
         if self._events_hash['local_folder_set_event'].is_set():
             self._events_hash['local_folder_set_event'].clear()
 
-            parser.read(CONFIG_PATH)
-            local_folder_name = parser.get('app_config', 'local_path').split('/')[-1]
+            local_folder_name = self.pair_config(True).local_folder_name
+            with self._folders_lock:
+                self._known_folders.clear()
             create_folder_response_status_code = self.create_folder(local_folder_name).status_code
 
             if create_folder_response_status_code == 201:
@@ -55,161 +254,1179 @@ class Synchronizer:
 
             return local_folder_name
         else:
-            return parser.get('app_config', 'local_path').split('/')[-1]
+            return self.pair_config().local_folder_name
 
     def _check_token_change(self):
+        with self._events_lock:
+            self._check_token_change_locked()
+
+    def _check_token_change_locked(self):
         if self._events_hash['token_set_event'].is_set():
             self._events_hash['token_set_event'].clear()
-            parser.read(CONFIG_PATH)
-            new_token = parser.get('api', 'token')
+            new_token = self.pair_config(True).token
             self._token = new_token
             self._headers['Authorization'] = f'OAuth {new_token}'
             # log = 'Detected changed token. Initialize new record keeping.'
             # propagate_log(log, self._queue, False)
             # first_synchronization(self, self._queue, self._events_hash)
 
-    def load(self, abs_local_file_path) -> Response:
+    def load(self, rel_path) -> Response:
         self._check_token_change()
         local_folder_name = self._check_local_folder_change()
-        file_name = abs_local_file_path.split("/")[-1]
-
-        return requests.get(
-            f'{self._base_url}resources/upload?path=%2F{local_folder_name}%2F{file_name}',
-            headers=self._headers
+        return self._request(
+            'load', 'GET',
+            f'{self._base_url}resources/upload',
+            params={'path': f'/{local_folder_name}/{rel_path}'},
         )
 
-    def reload(self, abs_local_file_path) -> Response:
+    def reload(self, rel_path) -> Response:
         self._check_token_change()
         local_folder_name = self._check_local_folder_change()
-        file_name = abs_local_file_path.split("/")[-1]
-
-        return requests.get(
-            f'{self._base_url}resources/upload?path=%2F{local_folder_name}%2F{file_name}&overwrite=true',
-            headers=self._headers
+        return self._request(
+            'reload', 'GET',
+            f'{self._base_url}resources/upload',
+            params={'path': f'/{local_folder_name}/{rel_path}', 'overwrite': 'true'},
         )
 
-    def delete(self, file_name, permanently: bool = False) -> Response:
+    def delete(self, rel_path, permanently: bool = False) -> Response:
         self._check_token_change()
         local_folder_name = self._check_local_folder_change()
-        return requests.delete(
-            f'{self._base_url}resources?path=%2F{local_folder_name}%2F{file_name}&permanently={str(permanently).lower()}',
-            headers=self._headers
+        return self._request(
+            'delete', 'DELETE',
+            f'{self._base_url}resources',
+            params={'path': f'/{local_folder_name}/{rel_path}', 'permanently': str(permanently).lower()},
         )
 
+    def get_operation(self, href: str) -> Response:
+        return self._request('get_operation', 'GET', href)
+
+    def operation_status(self, href: str) -> Optional[bool]:
+        # True when the operation succeeded, False when it failed or is unknown, None while it runs
+        # or can not be checked now
+        try:
+            response = self.get_operation(href)
+        except TRANSFER_ERRORS:
+            return None
+        if response.status_code == 404:
+            return False
+        if response.status_code != 200:
+            return None
+        status = response.json().get('status')
+        if status == 'success':
+            return True
+        if status == 'failed':
+            return False
+        return None
+
     def get_info(self) -> Response:
         self._check_token_change()
         local_folder_name = self._check_local_folder_change()
-        return requests.get(
-            f'{self._base_url}resources?path=%2F{local_folder_name}',
-            headers=self._headers
+        return self._request(
+            'get_info', 'GET',
+            f'{self._base_url}resources',
+            params={'path': f'/{local_folder_name}'},
         )
 
-    def create_folder(self, local_folder_name) -> Response:
+    def list_folder(self, rel_dir, limit: int, offset: int) -> Response:
+        local_folder_name = self._check_local_folder_change()
+        return self._request(
+            'list_folder', 'GET',
+            f'{self._base_url}resources',
+            params={
+                'path': f'/{local_folder_name}/{rel_dir}' if rel_dir else f'/{local_folder_name}',
+                'limit': limit,
+                'offset': offset,
+                'fields': REMOTE_FIELDS,
+            },
+        )
+
+    def get_file_info(self, rel_path) -> Response:
+        local_folder_name = self._check_local_folder_change()
+        return self._request(
+            'get_file_info', 'GET',
+            f'{self._base_url}resources',
+            params={'path': f'/{local_folder_name}/{rel_path}', 'fields': 'name,type,size,md5,sha256,modified'},
+        )
+
+    def create_folder(self, folder_path) -> Response:
         self._check_token_change()
-        return requests.put(f'{self._base_url}resources?path=%2F{local_folder_name}', headers=self._headers)
+        return self._request(
+            'create_folder', 'PUT',
+            f'{self._base_url}resources',
+            params={'path': f'/{folder_path}'},
+        )
+
+    def ensure_remote_folders(self, rel_path) -> bool:
+        # Creates missing parents of a file, folders known to exist are remembered until the local folder changes
+        local_folder_name = self._check_local_folder_change()
+        rel_dirs = rel_path.split('/')[:-1]
+        with self._folders_lock:
+            for depth in range(1, len(rel_dirs) + 1):
+                folder_path = f'{local_folder_name}/' + '/'.join(rel_dirs[:depth])
+                if folder_path in self._known_folders:
+                    continue
+                if self.create_folder(folder_path).status_code not in (201, 409):
+                    return False
+                self._known_folders.add(folder_path)
+        return True
+
+    def forget_remote_folders(self, rel_dir: str):
+        # rel_dir was removed remotely, or may have been: it, the folders under it and its parents are created
+        # again before the next upload into them, a parent that still exists costs one request answered with 409
+        local_folder_name = self._check_local_folder_change()
+        folder_path = f'{local_folder_name}/{rel_dir}'.rstrip('/')
+        with self._folders_lock:
+            self._known_folders = {
+                known_folder for known_folder in self._known_folders
+                if not (known_folder == folder_path or known_folder.startswith(folder_path + '/') or folder_path.startswith(known_folder + '/'))
+            }
+
+    def get_download_link(self, rel_path) -> Response:
+        self._check_token_change()
+        local_folder_name = self._check_local_folder_change()
+        return self._request(
+            'get_download_link', 'GET',
+            f'{self._base_url}resources/download',
+            params={'path': f'/{local_folder_name}/{rel_path}'},
+        )
+
+    def upload(self, href: str, data) -> Response:
+        with metrics.timer('file_synch_api_request_duration_seconds', DURATION_BUCKETS, operation='upload'):
+            response = self._upload_session.put(href, data=data, timeout=self._timeout)
+        metrics.increment('file_synch_api_responses_total', operation='upload', status=response.status_code)
+        return response
+
+    def download(self, href: str) -> Response:
+        # Download hrefs point to the same storage hosts as the upload ones, the time is up to the response headers
+        with metrics.timer('file_synch_api_request_duration_seconds', LATENCY_BUCKETS, operation='download'):
+            response = self._upload_session.get(href, stream=True, timeout=self._timeout)
+        metrics.increment('file_synch_api_responses_total', operation='download', status=response.status_code)
+        return response
+
+    def wait(self, seconds: float) -> bool:
+        # Sleeps before a retry, False means the application is exiting
+        return not self._events_hash['exit_event'].wait(seconds)
+
+    def check_exit(self, bytes_count: int = 0):
+        # Called for every block of a transfer, a service manager stopping the application
+        # does not wait for a big file to finish
+        if self._events_hash['exit_event'].is_set():
+            raise TransferAborted()
+
+    def throttle_upload(self, bytes_count: int):
+        self.check_exit()
+        self._transport.throttle_upload(bytes_count)
+
+
+_signature_stores: dict[str, SignatureStore] = {}
+# Workers of a pass ask for the store at once, two stores of one folder would lose each other's writes
+_signature_stores_lock = Lock()
+
+
+def get_signature_store(config: Config) -> SignatureStore:
+    signatures_path = config.signatures_path
+    with _signature_stores_lock:
+        if signatures_path not in _signature_stores:
+            _signature_stores[signatures_path] = SignatureStore(signatures_path)
+        return _signature_stores[signatures_path]
+
+
+_pack_indexes: dict[str, PackIndex] = {}
+_pack_indexes_lock = Lock()
+
+
+def get_pack_index(config: Config) -> PackIndex:
+    pack_index_path = config.pack_index_path
+    with _pack_indexes_lock:
+        if pack_index_path not in _pack_indexes:
+            _pack_indexes[pack_index_path] = PackIndex(pack_index_path)
+        return _pack_indexes[pack_index_path]
 
 
-def load_local_file(file_name: str, queue: Queue, synchronizer: Synchronizer, overwrite=False):
-    parser.read(CONFIG_PATH)
-    abs_local_file_path = parser.get('app_config', 'local_path') + '/' + file_name
+def forget_remote_file(file_name: str, config: Config):
+    # Local state kept about a remote file that is gone
+    get_signature_store(config).remove(file_name)
+    get_pack_index(config).remove(file_name)
+
+
+def record_transfer(direction: str, progress: TransferProgress):
+    metrics.increment('file_synch_transfer_bytes_total', progress.bytes_done, direction=direction)
+    if progress.bytes_done:
+        metrics.observe('file_synch_transfer_throughput_megabytes', progress.throughput, THROUGHPUT_BUCKETS, direction=direction)
+
+
+def response_error(response: Response) -> str:
+    # Disk API names the kind of an error in the body, e.g. DiskResourceAlreadyExistsError
+    try:
+        return response.json().get('error') or ''
+    except ValueError:
+        return ''
+
+
+def send_with_retries(rel_path: str, open_body, total_bytes: int, queue: Queue, synchronizer: Synchronizer, config: Config, overwrite: bool):
+    # open_body(progress) returns a context manager with the request body, it is reopened for every attempt.
+    # The upload href can not continue an interrupted PUT, so a dropped body is sent again from a fresh href.
+    # Disk API calls are already retried by the request executor, only the PUT to the storage is retried here.
+    method = synchronizer.reload if overwrite else synchronizer.load
+    upload_retries = config.upload_retries
+    progress_interval = config.progress_interval
+    for attempt in range(1, upload_retries + 2):
+        progress = TransferProgress(
+            total_bytes,
+            lambda current_progress: propagate_log(f'Uploading file {rel_path}: {current_progress.describe()}', queue, False),
+            progress_interval,
+            synchronizer.throttle_upload,
+        )
+        if not synchronizer.ensure_remote_folders(rel_path):
+            log = f'Remote folder for file {rel_path} creating unsuccessfully.'
+            propagate_log(log, queue)
+            return None, progress
+        response = method(rel_path)
+        if response.status_code == 409 and response_error(response) == 'DiskPathDoesntExistsError':
+            # A parent folder was removed remotely after it was remembered, it is created again once
+            synchronizer.forget_remote_folders(os.path.dirname(rel_path))
+            if not synchronizer.ensure_remote_folders(rel_path):
+                log = f'Remote folder for file {rel_path} creating unsuccessfully.'
+                propagate_log(log, queue)
+                return None, progress
+            response = method(rel_path)
+        if response.status_code != 200:
+            return response, progress
+        try:
+            with open_body(progress) as body:
+                response = synchronizer.upload(response.json()['href'], body)
+        except TransferAborted:
+            log = f'Uploading file {rel_path} stopped, the application is exiting.'
+            propagate_log(log, queue, False)
+            return None, progress
+        except TRANSFER_ERRORS as e:
+            reason = type(e).__name__
+            response = None
+        else:
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                return response, progress
+            reason = f'HTTP {response.status_code}'
+        finally:
+            record_transfer('upload', progress)
+
+        if attempt > upload_retries:
+            log = f'Uploading file {rel_path} unsuccessfully after {attempt} attempts. {reason}.'
+            propagate_log(log, queue)
+            return None, progress
+        delay = retry_delay(response, attempt)
+        log = f'Uploading file {rel_path} interrupted. {reason}. Retry {attempt} of {upload_retries} in {delay:.1f} s.'
+        propagate_log(log, queue)
+        metrics.increment('file_synch_transfer_retries_total', direction='upload')
+        if not synchronizer.wait(delay):
+            return None, progress
+
+
+def load_file_chunks(file_name: str, abs_local_file_path: str, signature: list[list], queue: Queue, synchronizer: Synchronizer, config: Config):
+    # Content addressed chunks under .chunks/ plus a manifest in place of the file,
+    # chunks already stored remotely, by this or by any other file, are not sent again.
+    signature_store = get_signature_store(config)
+    block_size = config.delta_block_size
+    chunk_size = config.upload_chunk_size
+    uploaded_chunks = set()
+    # The chunks are referenced while they are sent, a garbage sweep running meanwhile keeps them
+    signature_store.begin_chunks(file_name, {strong for _, strong, _ in signature})
+    stored = False
+    try:
+        for index, (_, strong, length) in enumerate(signature):
+            if strong in uploaded_chunks or signature_store.is_chunk_uploaded(strong):
+                continue
+            response, _ = send_with_retries(
+                chunk_rel_path(strong),
+                lambda progress, offset=index * block_size, length=length: UploadStream(abs_local_file_path, progress, chunk_size, offset, length),
+                length,
+                queue,
+                synchronizer,
+                config,
+                False
+            )
+            if response is None:
+                return None
+            if response.status_code not in (201, 202) and response_error(response) != 'DiskResourceAlreadyExistsError':
+                log = f'Unknown error. {response.text} {response.status_code}'
+                propagate_log(log, queue)
+                return None
+            uploaded_chunks.add(strong)
+        signature_store.add_uploaded_chunks(uploaded_chunks)
+
+        manifest = build_manifest(signature, os.path.getsize(abs_local_file_path), block_size)
+        response, _ = send_with_retries(
+            file_name + MANIFEST_SUFFIX,
+            lambda progress: nullcontext(manifest),
+            len(manifest),
+            queue,
+            synchronizer,
+            config,
+            True
+        )
+        stored = response is not None and response.status_code in (201, 202)
+    finally:
+        signature_store.end_chunks(file_name, stored)
+    if stored:
+        log = f'Sent {len(uploaded_chunks)} of {len(signature)} chunks of file {file_name}.'
+        propagate_log(log, queue, False)
+        # Chunks only the previous manifest referenced are garbage now
+        collect_chunk_garbage(queue, synchronizer, config)
+    return response
+
+
+def collect_chunk_garbage(queue: Queue, synchronizer: Synchronizer, config: Config):
+    # Deletes the uploaded chunks no manifest references, the ones left are tried again by a later sweep
+    signature_store = get_signature_store(config)
+    garbage = signature_store.take_garbage()
+    if not garbage:
+        return
+    deleted = set()
+    try:
+        for strong in garbage:
+            response = synchronizer.delete(chunk_rel_path(strong), True)
+            if response.status_code in (202, 204, 404):
+                deleted.add(strong)
+            else:
+                log = f'Deleting chunk {strong} unsuccessfully. HTTP {response.status_code}.'
+                propagate_log(log, queue)
+                break
+    except TRANSFER_ERRORS as e:
+        log = f'Deleting unreferenced chunks interrupted. {type(e).__name__}. They are left for the next pass.'
+        propagate_log(log, queue)
+    finally:
+        signature_store.finish_garbage(garbage, deleted)
+    if deleted:
+        log = f'Deleted {len(deleted)} unreferenced chunks.'
+        propagate_log(log, queue, False)
+
+
+def take_snapshot(file_name: str, config: Config) -> Optional[str]:
+    # Copy-on-write clone next to the file, named like a partial download so scans skip it
+    if config.snapshot_mode != 'reflink':
+        return None
+    abs_local_file_path = os.path.join(config.local_path, file_name)
+    folder, name = os.path.split(abs_local_file_path)
+    snapshot_path = os.path.join(folder, f'{PARTIAL_DOWNLOAD_PREFIX}{os.getpid()}.snapshot.{name}')
+    return snapshot_path if clone_file(abs_local_file_path, snapshot_path) else None
+
+
+def load_local_file(file_name: str, queue: Queue, synchronizer: Synchronizer, config: Config, overwrite=False, last_entry=None, local_entry=None):
+    abs_local_file_path = config.local_path + '/' + file_name
     if overwrite:
         log = f'Detected change in file {file_name}'
-        method = synchronizer.reload
     else:
-        method = synchronizer.load
         log = f'Detected new file {file_name}'
-    propagate_log(log, queue, False)
 
-    response = method(abs_local_file_path)
+    # The file is read from a snapshot when the filesystem can take one, either way it has to be
+    # the version that was scanned and hashed, a file changed meanwhile waits for the next scan
+    snapshot_path = take_snapshot(file_name, config)
+    source_path = snapshot_path or abs_local_file_path
+    try:
+        if local_entry is not None and not same_stat(local_entry, stat_file(abs_local_file_path)):
+            log = f'File {file_name} changed after scanning, it is left for the next scan.'
+            propagate_log(log, queue, False)
+            return None
+        file_size = os.path.getsize(source_path)
+        signature = None
+        if config.delta_min_size and file_size >= config.delta_min_size:
+            signature = compute_signature(source_path, config.delta_block_size)
+            last_signature = get_signature_store(config).load(file_name) if overwrite else None
+            if last_signature is not None:
+                _, changed_bytes = diff_signatures(signature, last_signature)
+                log += f'. Changed {changed_bytes / MEGABYTE:.1f} MB of {file_size / MEGABYTE:.1f} MB'
+        propagate_log(log, queue, False)
 
-    if response.status_code == 401:
-        log = f'Authorization unsuccessfully. Please, set valid OAuth-token.'
-        propagate_log(log, queue)
-    elif response.status_code == 409:
+        last_remote_path = last_entry.get('remote_path') if isinstance(last_entry, dict) else None
+        remote_details = {}
+        codec = choose_codec(
+            file_name,
+            file_size,
+            config.compression,
+            parse_extensions(config.compression_skip_extensions),
+            config.compression_min_size
+        )
+        if signature is not None and config.delta_mode == 'chunks':
+            response = load_file_chunks(file_name, source_path, signature, queue, synchronizer, config)
+            remote_path = file_name + MANIFEST_SUFFIX
+            progress = None
+        elif codec is not None:
+            # Stored as <name>.gz or <name>.zst, the entry keeps the size and hash of the original
+            remote_path = file_name + COMPRESSION_SUFFIXES[codec]
+            compressed_path, compressed_size, compressed_sha256 = compress_file(
+                source_path, codec, config.compression_level, config.compression_workers
+            )
+            try:
+                response, progress = send_with_retries(
+                    remote_path,
+                    lambda current_progress: UploadStream(compressed_path, current_progress, config.upload_chunk_size),
+                    compressed_size,
+                    queue,
+                    synchronizer,
+                    config,
+                    True
+                )
+            finally:
+                os.remove(compressed_path)
+            remote_details = {'compression': codec, 'compressed_size': compressed_size, 'compressed_sha256': compressed_sha256}
+        else:
+            response, progress = send_with_retries(
+                file_name,
+                lambda current_progress: UploadStream(source_path, current_progress, config.upload_chunk_size),
+                file_size,
+                queue,
+                synchronizer,
+                config,
+                overwrite
+            )
+            remote_path = None
+    except FileNotFoundError:
+        log = f'File {file_name} removed before uploading.'
+        propagate_log(log, queue, False)
+        return
+    finally:
+        if snapshot_path is not None:
+            os.remove(snapshot_path)
+
+    if response is None:
+        return
+    if response.status_code == 409 and response_error(response) == 'DiskResourceAlreadyExistsError':
         log = f'File {file_name} already load on remote storage. Updating local meta data.'
         propagate_log(log, queue, False)
         return True
-    elif response.status_code == 200:
-        with open(abs_local_file_path, 'rb') as file:
-            while requests.put(response.json()['href'], data=file).status_code == 202:
+    elif response.status_code in (201, 202):
+        # 202 means the file is accepted and is being moved into place by the storage
+        log = f'{"Overwriting" if overwrite else "Writing"} file {file_name} successfully.'
+        if remote_details:
+            log += f' Compressed {file_size / MEGABYTE:.1f} MB to {remote_details["compressed_size"] / MEGABYTE:.1f} MB.'
+        if progress is not None and progress.reported:
+            log += f' {progress.bytes_done / MEGABYTE:.1f} MB in {progress.elapsed:.1f} s, {progress.throughput:.2f} MB/s.'
+        propagate_log(log, queue, False)
+
+        if signature is not None:
+            get_signature_store(config).save(file_name, signature)
+        if last_remote_path == BUNDLES_FOLDER:
+            # Moved out of its bundle, the dead bytes go with the next compaction
+            get_pack_index(config).remove(file_name)
+        elif last_entry is not None and last_remote_path != remote_path:
+            # The file switched between whole, chunked and compressed form, the previous remote object is stale
+            try:
+                synchronizer.delete(last_remote_path or file_name)
+            except TRANSFER_ERRORS:
                 pass
-            response = requests.put(response.json()['href'], data=file)
-        if response.status_code == 201:
-            log = f'{"Overwriting" if overwrite else "Writing"} file {file_name} successfully.'
-            propagate_log(log, queue, False)
-            return True
-        elif response.status_code == 413:
-            log = f'File size too large {file_name}'
-            propagate_log(log, queue)
-        elif response.status_code == 507:
-            log = f'Remote storage is full. Writing denied.'
-            propagate_log(log, queue)
-        else:
-            log = f'Unknown error. {response.text} {response.status_code}'
-            propagate_log(log, queue)
+            if last_remote_path and last_remote_path.endswith(MANIFEST_SUFFIX):
+                get_signature_store(config).release_chunks(file_name)
+        return {'remote_path': remote_path, **remote_details} if remote_path else True
     else:
-        log = f'Unknown error. {response.text} {response.status_code}'
-        propagate_log(log, queue)
+        propagate_log(upload_error_log(response, 'file', file_name), queue)
 
 
-def delete_remote_file(last_file_name, queue, synchronizer):
+def upload_error_log(response: Response, kind: str, rel_path: str) -> str:
+    # Log line of a failed upload, kind is what was uploaded: file or bundle
+    if response.status_code == 401:
+        return 'Authorization unsuccessfully. Please, set valid OAuth-token.'
+    if response.status_code == 413:
+        return f'{kind.capitalize()} size too large {rel_path}'
+    if response.status_code == 507:
+        return 'Remote storage is full. Writing denied.'
+    if response.status_code in RETRYABLE_STATUS_CODES:
+        return f'Remote storage is busy, {kind} {rel_path} is left for the next scan. HTTP {response.status_code}.'
+    return f'Unknown error. {response.text} {response.status_code}'
+
+
+def delete_remote_file(last_file_name, queue, synchronizer, config: Config, last_entry=None):
     log = f'Detected removed file {last_file_name}.'
     propagate_log(log, queue, False)
 
-    response = synchronizer.delete(last_file_name)
+    if is_packed(last_entry):
+        # Its bytes in the bundle turn dead, the bundle itself is rewritten by compaction
+        get_pack_index(config).remove(last_file_name)
+        return True
+    remote_path = last_entry.get('remote_path') if isinstance(last_entry, dict) else None
+    if config.sync_direction == 'both' and remote_path is None and isinstance(last_entry, dict):
+        remote_sha256 = get_remote_sha256(last_file_name, synchronizer)
+        if remote_sha256 is not None and remote_sha256 != last_entry.get('sha256'):
+            # Edited on the remote storage meanwhile, the next remote listing brings the file back
+            log = f'File {last_file_name} changed on remote storage, it is not removed.'
+            propagate_log(log, queue, False)
+            return None
+    response = synchronizer.delete(remote_path or last_file_name)
 
     if response.status_code == 204:
         log = f'Deleting remote file {last_file_name} successfully.'
         propagate_log(log, queue, False)
+        forget_remote_file(last_file_name, config)
         return True
+    elif response.status_code == 202:
+        # Recorded when the operation is finished, the file is not planned again meanwhile
+        if synchronizer.operations.watch(response.json()['href'], [last_file_name]):
+            log = f'Deleting remote file {last_file_name} started.'
+            propagate_log(log, queue, False)
     elif response.status_code == 404:
         log = f'File {last_file_name} not found on remote storage. Updating local record keeping.'
         propagate_log(log, queue, False)
+        forget_remote_file(last_file_name, config)
         return True
     elif response.status_code == 401:
         log = f'Authorization unsuccessfully. Please, set valid OAuth-token.'
         propagate_log(log, queue)
+    elif response.status_code in RETRYABLE_STATUS_CODES:
+        log = f'Remote storage is busy, file {last_file_name} is left for the next scan. HTTP {response.status_code}.'
+        propagate_log(log, queue)
+    else:
+        log = f'Unknown error. {response.text} {response.status_code}'
+        propagate_log(log, queue)
+
+
+def delete_remote_folder(rel_dir: str, file_names: list[str], queue: Queue, synchronizer: Synchronizer, config: Config):
+    # Every recorded file under the folder is removed, see removed_folders. Returns the results of the removed
+    # files, a folder with files in it is usually deleted asynchronously and recorded by collect_remote_operations.
+    log = f'Detected removed folder {rel_dir} with {len(file_names)} files.'
+    propagate_log(log, queue, False)
+    response = synchronizer.delete(rel_dir)
+    if response.status_code in (202, 204, 404):
+        synchronizer.forget_remote_folders(rel_dir)
+
+    if response.status_code in (204, 404):
+        log = (f'Deleting remote folder {rel_dir} successfully.' if response.status_code == 204
+               else f'Folder {rel_dir} not found on remote storage. Updating local record keeping.')
+        propagate_log(log, queue, False)
+        for file_name in file_names:
+            forget_remote_file(file_name, config)
+        return [(file_name, None, True) for file_name in file_names]
+    elif response.status_code == 202:
+        if synchronizer.operations.watch(response.json()['href'], file_names):
+            log = f'Deleting remote folder {rel_dir} started.'
+            propagate_log(log, queue, False)
+    elif response.status_code == 401:
+        log = 'Authorization unsuccessfully. Please, set valid OAuth-token.'
+        propagate_log(log, queue)
+    elif response.status_code in RETRYABLE_STATUS_CODES:
+        log = f'Remote storage is busy, folder {rel_dir} is left for the next scan. HTTP {response.status_code}.'
+        propagate_log(log, queue)
     else:
         log = f'Unknown error. {response.text} {response.status_code}'
         propagate_log(log, queue)
 
 
-def synchronization(synchronizer: Synchronizer, queue: Queue, events_hash: dict[str, Event]):
+def task_changes(file_name: str, new_entry, result) -> dict:
+    # Record keeping changes of a task result, rel_path -> entry or None for a removal.
+    # A task covering several files, a folder or a bundle, returns a list of (file_name, new_entry, result).
+    if not result:
+        return {}
+    if isinstance(result, list):
+        changes = {}
+        for file_result in result:
+            changes.update(task_changes(*file_result))
+        return changes
+    if new_entry is None:
+        return {file_name: None}
+    if isinstance(result, dict):
+        return {file_name: {**new_entry, **result}}
+    return {file_name: new_entry}
+
+
+def apply_changes(record_keeping: RecordKeeping, changes: dict):
+    for rel_path, entry in changes.items():
+        if entry is None:
+            record_keeping.pop(rel_path, None)
+        else:
+            record_keeping[rel_path] = entry
+
+
+def record_task_result(record_keeping: RecordKeeping, file_name: str, new_entry, result) -> bool:
+    # The journal gets the changes first and closes the intent of the task, a failed task records nothing
+    changes = task_changes(file_name, new_entry, result)
+    if record_keeping.journal is not None:
+        record_keeping.journal.done(file_name, changes)
+    apply_changes(record_keeping, changes)
+    return bool(changes)
+
+
+def is_partial_download(rel_path: str) -> bool:
+    return os.path.basename(rel_path).startswith(PARTIAL_DOWNLOAD_PREFIX)
+
+
+def receive_remote_file(file_name: str, target_rel_path: str, queue: Queue, synchronizer: Synchronizer, config: Config, remote_entry: dict, expected_local_entry=None):
+    # Streams the remote file into a partial file next to the target and renames it into place.
+    # The target is replaced only if it is still as planned: missing for a new file, with the stat
+    # of expected_local_entry otherwise, a local edit made meanwhile is never overwritten.
+    # Returns the new local entry or None.
+    abs_target_path = f'{config.local_path}/{target_rel_path}'
+    target_folder, target_name = os.path.split(abs_target_path)
+    os.makedirs(target_folder, exist_ok=True)
+    partial_path = os.path.join(target_folder, f'{PARTIAL_DOWNLOAD_PREFIX}{os.getpid()}.{target_name}')
+
+    def discard_partial():
+        try:
+            os.remove(partial_path)
+        except FileNotFoundError:
+            pass
+
+    for attempt in range(1, config.upload_retries + 2):
+        response = synchronizer.get_download_link(file_name)
+        if response.status_code == 404:
+            log = f'File {file_name} not found on remote storage, skipping download.'
+            propagate_log(log, queue, False)
+            return None
+        if response.status_code != 200:
+            log = f'Downloading file {file_name} unsuccessfully. {response.text} {response.status_code}'
+            propagate_log(log, queue)
+            return None
+
+        progress = TransferProgress(
+            remote_entry.get('size') or 0,
+            lambda current_progress: propagate_log(f'Downloading file {file_name}: {current_progress.describe()}', queue, False),
+            config.progress_interval,
+            synchronizer.check_exit,
+        )
+        file_hash = hashlib.sha256()
+        try:
+            with synchronizer.download(response.json()['href']) as response, open(partial_path, 'wb') as partial_file:
+                if response.status_code == 200:
+                    for chunk in response.iter_content(config.upload_chunk_size):
+                        partial_file.write(chunk)
+                        file_hash.update(chunk)
+                        progress.advance(len(chunk))
+        except TransferAborted:
+            log = f'Downloading file {file_name} stopped, the application is exiting.'
+            propagate_log(log, queue, False)
+            discard_partial()
+            return None
+        except TRANSFER_ERRORS as e:
+            reason = type(e).__name__
+            response = None
+        else:
+            if response.status_code == 200:
+                break
+            reason = f'HTTP {response.status_code}'
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                log = f'Downloading file {file_name} unsuccessfully. {reason}.'
+                propagate_log(log, queue)
+                discard_partial()
+                return None
+        finally:
+            record_transfer('download', progress)
+
+        if attempt > config.upload_retries:
+            log = f'Downloading file {file_name} unsuccessfully after {attempt} attempts. {reason}.'
+            propagate_log(log, queue)
+            discard_partial()
+            return None
+        delay = retry_delay(response, attempt)
+        log = f'Downloading file {file_name} interrupted. {reason}. Retry {attempt} of {config.upload_retries} in {delay:.1f} s.'
+        propagate_log(log, queue)
+        metrics.increment('file_synch_transfer_retries_total', direction='download')
+        if not synchronizer.wait(delay):
+            discard_partial()
+            return None
+
+    sha256 = file_hash.hexdigest()
+    if remote_entry.get('sha256') and remote_entry['sha256'] != sha256:
+        log = f'File {file_name} changed on remote storage while downloading, left for the next scan.'
+        propagate_log(log, queue, False)
+        discard_partial()
+        return None
+    try:
+        current_stat = stat_file(abs_target_path)
+    except FileNotFoundError:
+        current_stat = None
+    if (current_stat is None) != (expected_local_entry is None) or (current_stat is not None and not same_stat(expected_local_entry, current_stat)):
+        log = f'File {target_rel_path} changed locally while downloading, left for the next scan.'
+        propagate_log(log, queue, False)
+        discard_partial()
+        return None
+    os.replace(partial_path, abs_target_path)
+    return {**stat_file(abs_target_path), 'sha256': sha256}
+
+
+def download_remote_file(file_name: str, queue: Queue, synchronizer: Synchronizer, config: Config, remote_entry: dict, local_entry=None):
+    log = f'Detected {"change in remote" if local_entry is not None else "new remote"} file {file_name}'
+    propagate_log(log, queue, False)
+    new_entry = receive_remote_file(file_name, file_name, queue, synchronizer, config, remote_entry, local_entry)
+    if new_entry is not None:
+        log = f'Downloading file {file_name} successfully.'
+        propagate_log(log, queue, False)
+    return new_entry
+
+
+def delete_local_file(file_name: str, queue: Queue, config: Config, last_entry):
+    log = f'Detected file {file_name} removed from remote storage.'
+    propagate_log(log, queue, False)
+    abs_local_file_path = f'{config.local_path}/{file_name}'
+    try:
+        if not same_stat(last_entry, stat_file(abs_local_file_path)):
+            log = f'File {file_name} changed locally, it is not removed.'
+            propagate_log(log, queue, False)
+            return None
+        os.remove(abs_local_file_path)
+    except FileNotFoundError:
+        pass
+    log = f'Deleting local file {file_name} successfully.'
+    propagate_log(log, queue, False)
+    return True
+
+
+def resolve_conflict(file_name: str, queue: Queue, synchronizer: Synchronizer, config: Config, remote_entry: dict, last_entry=None):
+    # Both sides changed the file: the remote version is kept locally as a conflict copy, which is
+    # uploaded as a new file by the next scan, and the local version goes to the remote storage.
+    # Every host ends up with both versions.
+    stem, extension = os.path.splitext(file_name)
+    conflict_rel_path = f'{stem} (conflict {datetime.now().strftime("%Y-%m-%d %H%M%S")}){extension}'
+    log = f'Detected conflicting changes in file {file_name}. Remote version is saved as {conflict_rel_path}.'
+    propagate_log(log, queue)
+    if receive_remote_file(file_name, conflict_rel_path, queue, synchronizer, config, remote_entry) is None:
+        return None
+    return load_local_file(file_name, queue, synchronizer, config, True, last_entry)
+
+
+def get_remote_sha256(file_name: str, synchronizer: Synchronizer) -> Optional[str]:
+    response = synchronizer.get_file_info(file_name)
+    if response.status_code == 200:
+        return response.json().get('sha256')
+    return None
+
+
+def push_local_file(file_name: str, queue: Queue, synchronizer: Synchronizer, config: Config, local_entry: dict, last_entry=None):
+    # Pulling without a fresh remote listing: the remote file is checked against record keeping
+    # before it is replaced, a change made there since the last synchronization is a conflict
+    remote_sha256 = get_remote_sha256(file_name, synchronizer)
+    base_sha256 = last_entry.get('sha256') if isinstance(last_entry, dict) else None
+    if remote_sha256 is not None and remote_sha256 != base_sha256:
+        if remote_sha256 == local_entry['sha256']:
+            return True
+        return resolve_conflict(file_name, queue, synchronizer, config, {'sha256': remote_sha256}, last_entry)
+    return load_local_file(file_name, queue, synchronizer, config, last_entry is not None, last_entry, local_entry)
+
+
+def upload_bundle(bundle_rel_path: str, bundle: BundleWriter, queue: Queue, synchronizer: Synchronizer, config: Config) -> bool:
+    try:
+        bundle_size = bundle.close()
+        response, _ = send_with_retries(
+            bundle_rel_path,
+            lambda current_progress: UploadStream(bundle.path, current_progress, config.upload_chunk_size),
+            bundle_size,
+            queue,
+            synchronizer,
+            config,
+            False
+        )
+    finally:
+        os.remove(bundle.path)
+    if response is None:
+        return False
+    if response.status_code in (201, 202):
+        log = f'Writing bundle {bundle_rel_path} successfully. {len(bundle.locations)} files, {bundle_size / MEGABYTE:.1f} MB.'
+        propagate_log(log, queue, False)
+        return True
+    propagate_log(upload_error_log(response, 'bundle', bundle_rel_path), queue)
+    return False
+
+
+def pack_local_files(bundle_rel_path: str, members: list[tuple], queue: Queue, synchronizer: Synchronizer, config: Config):
+    # Small files are sent as one tar bundle, two requests for all of them. members are (file_name, entry, last_entry),
+    # returns their results, see record_task_result.
+    log = f'Detected {len(members)} new or changed small files, packing them into bundle {bundle_rel_path}.'
+    propagate_log(log, queue, False)
+    bundle = BundleWriter()
+    for file_name, entry, _ in members:
+        abs_local_file_path = os.path.join(config.local_path, file_name)
+        try:
+            with open(abs_local_file_path, 'rb') as file:
+                data = file.read()
+            # Unchanged after reading, so the data is the version that was hashed
+            if not same_stat(entry, stat_file(abs_local_file_path)):
+                log = f'File {file_name} changed after scanning, it is left for the next scan.'
+                propagate_log(log, queue, False)
+                continue
+            bundle.add(file_name, data, entry['mtime_ns'] / 1e9)
+        except FileNotFoundError:
+            log = f'File {file_name} removed before uploading.'
+            propagate_log(log, queue, False)
+    if not bundle.locations:
+        bundle.discard()
+        return None
+    if not upload_bundle(bundle_rel_path, bundle, queue, synchronizer, config):
+        return None
+    pack_index = get_pack_index(config)
+    pack_index.add_bundle(bundle_rel_path, bundle.locations)
+    # Saved before the journal records the files, a replayed entry of a packed file always has its location
+    pack_index.save()
+
+    results = []
+    for file_name, entry, last_entry in members:
+        if file_name not in bundle.locations:
+            continue
+        last_remote_path = last_entry.get('remote_path') if isinstance(last_entry, dict) else None
+        if last_entry is not None and last_remote_path != BUNDLES_FOLDER:
+            # Stored on its own before, that object is stale now
+            try:
+                synchronizer.delete(last_remote_path or file_name)
+            except TRANSFER_ERRORS:
+                pass
+            if last_remote_path and last_remote_path.endswith(MANIFEST_SUFFIX):
+                get_signature_store(config).release_chunks(file_name)
+        results.append((file_name, entry, {'remote_path': BUNDLES_FOLDER}))
+    return results
+
+
+def download_bundle(bundle_rel_path: str, synchronizer: Synchronizer, config: Config) -> Optional[str]:
+    # Returns the path of a temporary copy, the caller removes it
+    response = synchronizer.get_download_link(bundle_rel_path)
+    if response.status_code != 200:
+        return None
+    descriptor, temporary_path = tempfile.mkstemp(prefix='file_synch_', suffix='.tar')
+    progress = TransferProgress(0, lambda current_progress: None, config.progress_interval, synchronizer.check_exit)
+    try:
+        with synchronizer.download(response.json()['href']) as response, os.fdopen(descriptor, 'wb') as file:
+            if response.status_code == 200:
+                for chunk in response.iter_content(config.upload_chunk_size):
+                    file.write(chunk)
+                    progress.advance(len(chunk))
+    except TransferAborted:
+        os.remove(temporary_path)
+        return None
+    finally:
+        record_transfer('download', progress)
+    if response.status_code != 200:
+        os.remove(temporary_path)
+        return None
+    return temporary_path
+
+
+def compact_bundles(queue: Queue, synchronizer: Synchronizer, config: Config):
+    # Runs in the background between passes: the live files of the sparsest bundles are copied from
+    # the remote copies into a new bundle, emptied bundles are deleted. Only the pack index changes,
+    # record keeping entries of packed files do not name their bundle.
+    pack_index = get_pack_index(config)
+    bundle = None
+    try:
+        bundles = pack_index.compaction_candidates(config.bundle_compaction_ratio, config.bundle_size)
+        if bundles:
+            bundle_rel_path = new_bundle_rel_path()
+            bundle = BundleWriter()
+            for old_bundle_rel_path in bundles:
+                old_bundle_path = download_bundle(old_bundle_rel_path, synchronizer, config)
+                if old_bundle_path is None:
+                    log = f'Downloading bundle {old_bundle_rel_path} unsuccessfully, compaction is left for the next pass.'
+                    propagate_log(log, queue)
+                    return
+                live_files = pack_index.files_in(old_bundle_rel_path)
+                try:
+                    with tarfile.open(old_bundle_path) as old_bundle:
+                        for member in old_bundle:
+                            if live_files.get(member.name) == (member.offset_data, member.size):
+                                bundle.add(member.name, old_bundle.extractfile(member).read(), member.mtime)
+                finally:
+                    os.remove(old_bundle_path)
+            if not upload_bundle(bundle_rel_path, bundle, queue, synchronizer, config):
+                return
+            pack_index.move_files(bundle_rel_path, bundle.locations, bundles)
+            log = f'Compacted {len(bundles)} bundles into {bundle_rel_path}.'
+            propagate_log(log, queue, False)
+
+        for dead_bundle_rel_path in pack_index.dead_bundles():
+            response = synchronizer.delete(dead_bundle_rel_path)
+            if response.status_code in (202, 204, 404):
+                pack_index.forget_bundle(dead_bundle_rel_path)
+            else:
+                log = f'Deleting bundle {dead_bundle_rel_path} unsuccessfully. HTTP {response.status_code}.'
+                propagate_log(log, queue)
+    except TRANSFER_ERRORS as e:
+        log = f'Compacting bundles interrupted. {type(e).__name__}. Compaction is left for the next pass.'
+        propagate_log(log, queue)
+    finally:
+        if bundle is not None:
+            bundle.discard()
+        pack_index.save()
+
+
+def run_timed_task(function, *args):
+    with metrics.timer('file_synch_task_duration_seconds', task=function.__name__):
+        return function(*args)
+
+
+def run_sync_tasks(tasks: list[tuple], record_keeping: RecordKeeping, config: Config, large_file_lane: Optional[LargeFileLane] = None, task_pool: Optional[FairTaskPool] = None) -> bool:
+    # Task is (function, args, file_name, new_entry), new_entry None means removal from record keeping.
+    # A task may return a dict of remote details to keep in the entry along with the local ones.
+    # Every file is handled by one worker from start to end, so its log lines stay in order,
+    # record keeping and its journal are touched only here, in the calling thread.
+    # A connection failure of one task does not stop the others, results of finished ones are kept
+    # and the first failure is raised once the pool is drained.
     changes_have_been_made = False
-    local_data = get_meta_data_files_local_folder(queue, events_hash)
-    record_keeping_path = parser.get('app_config', 'record_keeping_path')
-    if os.path.getsize(os.path.abspath(record_keeping_path)) > 0:
-        with open(record_keeping_path, 'r') as file:
-            last_local_data = json.load(file)
-            record_keeping = copy(last_local_data)
-        for last_file_name, last_file_size in last_local_data.items():
-            if last_file_name not in local_data and delete_remote_file(last_file_name, queue, synchronizer):
-                changes_have_been_made = True
-                record_keeping.pop(last_file_name)
-            elif last_file_name in local_data and local_data[last_file_name] != last_file_size and load_local_file(last_file_name, queue, synchronizer, overwrite=True):
-                changes_have_been_made = True
-                record_keeping[last_file_name] = local_data[last_file_name]
+    patterns = parse_patterns(config.schedule_patterns)
+    tasks = [(run_timed_task, (function, *args), file_name, new_entry) for function, args, file_name, new_entry in tasks]
+    regular_tasks = []
+    for task in tasks:
+        file_name = task[2]
+        if large_file_lane is not None and large_file_lane.is_running(file_name):
+            # Checked again when the transfer in progress is finished
+            continue
+        if record_keeping.journal is not None:
+            # Written ahead of the task, see replay_journal
+            record_keeping.journal.begin(task[1][0].__name__, file_name, task[3])
+        if large_file_lane is not None and (large_file_lane.is_waiting(file_name) or is_large_task(task, config.large_file_size)):
+            large_file_lane.submit(task, task_priority(task, config.schedule_policy, patterns))
+            continue
+        regular_tasks.append(task)
+    if not regular_tasks:
+        return changes_have_been_made
+    # The pool takes tasks in submission order, so the policy order is kept
+    regular_tasks.sort(key=lambda regular_task: task_priority(regular_task, config.schedule_policy, patterns))
 
-        for local_file_name, local_file_size in local_data.items():
-            if local_file_name not in last_local_data and load_local_file(local_file_name, queue, synchronizer):
+    transfer_error = None
+    # Workers shared with other sync pairs take turns between pairs, without them a pool serves this pass only
+    executor = ThreadPoolExecutor(max_workers=min(max(1, config.workers), len(regular_tasks))) if task_pool is None else None
+    with executor or nullcontext():
+        if executor is not None:
+            futures = {executor.submit(function, *args): (file_name, new_entry) for function, args, file_name, new_entry in regular_tasks}
+        else:
+            futures = {task_pool.submit(config.pair_name, function, *args): (file_name, new_entry) for function, args, file_name, new_entry in regular_tasks}
+        for future in as_completed(futures):
+            file_name, new_entry = futures[future]
+            try:
+                result = future.result()
+            except TRANSFER_ERRORS as e:
+                transfer_error = transfer_error or e
+                # Planned again by the next pass, its intent is closed without changes
+                record_task_result(record_keeping, file_name, new_entry, None)
+                continue
+            if record_task_result(record_keeping, file_name, new_entry, result):
                 changes_have_been_made = True
-                record_keeping[local_file_name] = local_file_size
-
-        # if changes_have_been_made:
-        #     log = 'Scanning is over. Changes have been made.'
-        #     propagate_log(log, queue, False)
-        # else:
-        #     pass
-            # log = 'Scanning is over. Changes not found.'
-            # propagate_log(log, queue, False)
-
-        with open(record_keeping_path, 'w') as file:
-            json.dump(record_keeping, file, indent=4)
+
+    if transfer_error is not None:
+        raise transfer_error
+    return changes_have_been_made
+
+
+def collect_large_files(large_file_lane: Optional[LargeFileLane], record_keeping: RecordKeeping, queue: Queue) -> set[str]:
+    # Records transfers finished by the large file lane, their files are returned to be checked
+    # again, they may have changed while they were uploading
+    finished_file_names = set()
+    if large_file_lane is None:
+        return finished_file_names
+    for (_, _, file_name, new_entry), future in large_file_lane.pop_finished():
+        finished_file_names.add(file_name)
+        try:
+            result = future.result()
+        except TRANSFER_ERRORS as e:
+            log = f'Synchronizing file {file_name} interrupted. {type(e).__name__}. File is left for the next scan.'
+            propagate_log(log, queue)
+            result = None
+        record_task_result(record_keeping, file_name, new_entry, result)
+    return finished_file_names
+
+
+def collect_remote_operations(synchronizer: Synchronizer, record_keeping: RecordKeeping, config: Config, queue: Queue) -> set[str]:
+    # Records deletes finished in the background, files of failed ones are returned to be planned again
+    finished_file_names = set()
+    for file_names, succeeded in synchronizer.operations.pop_finished():
+        finished_file_names.update(file_names)
+        if not succeeded:
+            log = f'Deleting {len(file_names)} remote files unsuccessfully. Files are left for the next scan.'
+            propagate_log(log, queue)
+            continue
+        for file_name in file_names:
+            synchronizer.forget_remote_folders(os.path.dirname(file_name))
+        changes = {file_name: None for file_name in file_names}
+        if record_keeping.journal is not None:
+            record_keeping.journal.done(None, changes)
+        apply_changes(record_keeping, changes)
+        for file_name in file_names:
+            forget_remote_file(file_name, config)
+        log = f'Deleting {len(file_names)} remote files successfully.'
+        propagate_log(log, queue, False)
+    return finished_file_names
+
+
+def get_remote_index(synchronizer: Synchronizer, queue: Queue, config: Config) -> Optional[dict[str, dict]]:
+    def list_page(rel_dir, limit, offset):
+        response = synchronizer.list_folder(rel_dir, limit, offset)
+        if response.status_code == 404:
+            return None
+        if response.status_code != 200:
+            raise RemoteListingError(f'{response.text} {response.status_code}')
+        return response.json()
+
+    try:
+        return build_remote_index(list_page, config.listing_page_size)
+    except (RemoteListingError, *TRANSFER_ERRORS) as e:
+        log = f'Remote listing unsuccessfully. {e}'
+        propagate_log(log, queue)
+        return None
+
+
+def plan_sync_tasks(local_data: dict, last_local_data: dict, remote_index: Optional[dict], queue: Queue, synchronizer: Synchronizer, record_keeping: RecordKeeping, config: Config) -> list[tuple]:
+    if remote_index is None:
+        actions = two_way_diff(local_data, last_local_data)
+    elif config.sync_direction == 'both':
+        actions = bidirectional_diff(local_data, last_local_data, remote_index)
     else:
-        first_synchronization(synchronizer, queue, events_hash)
+        actions = three_way_diff(local_data, last_local_data, remote_index)
+        untracked = untracked_remote_paths(local_data, last_local_data, remote_index)
+        if untracked:
+            log = f'Found {len(untracked)} remote files not present in local directory.'
+            propagate_log(log, queue, False)
+
+    tasks = []
+    deleted = {}
+    packed = []
+    # Pulling needs every file under its own name, small files are packed only when pushing
+    pack_max_size = config.pack_max_size if config.sync_direction != 'both' else 0
+    for action, rel_path, entry in actions:
+        last_entry = last_local_data.get(rel_path)
+        if action == DELETE and synchronizer.operations.is_pending(rel_path):
+            # Being deleted in the background
+            continue
+        metrics.increment('file_synch_changes_detected_total', action=action, pair=config.pair_name)
+        if isinstance(entry, dict):
+            metrics.increment('file_synch_changes_detected_bytes_total', entry.get('size') or 0, action=action, pair=config.pair_name)
+        if action == RECORD:
+            record_keeping[rel_path] = entry
+        elif action == FORGET:
+            record_keeping.pop(rel_path)
+            forget_remote_file(rel_path, config)
+        elif action == DELETE:
+            deleted[rel_path] = last_entry
+        elif action == DELETE_LOCAL:
+            # Its folder may be gone from the remote storage as well
+            synchronizer.forget_remote_folders(os.path.dirname(rel_path))
+            tasks.append((delete_local_file, (rel_path, queue, config, last_entry), rel_path, None))
+        elif action == DOWNLOAD:
+            # The result of the download is the whole entry, size here only places the task in the schedule
+            tasks.append((download_remote_file, (rel_path, queue, synchronizer, config, entry, local_data.get(rel_path)), rel_path, {'size': entry.get('size') or 0}))
+        elif action == CONFLICT:
+            tasks.append((resolve_conflict, (rel_path, queue, synchronizer, config, remote_index[rel_path], last_entry), rel_path, entry))
+        elif remote_index is None and config.sync_direction == 'both' and not (isinstance(last_entry, dict) and last_entry.get('remote_path')):
+            tasks.append((push_local_file, (rel_path, queue, synchronizer, config, entry, last_entry), rel_path, entry))
+        else:
+            if remote_index is not None and last_entry is not None and not is_changed(entry, last_entry):
+                log = f'Detected remote drift of file {rel_path}.'
+                propagate_log(log, queue, False)
+            if pack_max_size and entry['size'] <= pack_max_size:
+                packed.append((rel_path, entry, last_entry))
+                continue
+            tasks.append((load_local_file, (rel_path, queue, synchronizer, config, action == OVERWRITE, last_entry, entry), rel_path, entry))
+
+    # Bundles of about bundle_size, each is one task
+    members = []
+    members_size = 0
+    for index, member in enumerate(packed, 1):
+        members.append(member)
+        members_size += member[1]['size']
+        if members_size >= config.bundle_size or index == len(packed):
+            bundle_rel_path = new_bundle_rel_path()
+            tasks.append((pack_local_files, (bundle_rel_path, members, queue, synchronizer, config), bundle_rel_path, {'size': members_size}))
+            members = []
+            members_size = 0
+
+    # A removed folder is deleted with one request. Pulling, a remote file is deleted only if it is
+    # unchanged since the last synchronization, for a whole folder that is known from the remote listing.
+    folders = {}
+    if len(deleted) > 1 and (config.sync_direction != 'both' or remote_index is not None):
+        folders = removed_folders(
+            deleted, record_keeping.keys(), remote_index,
+            lambda rel_dir: os.path.isdir(os.path.join(config.local_path, rel_dir)),
+        )
+    for rel_dir, file_names in folders.items():
+        tasks.append((delete_remote_folder, (rel_dir, file_names, queue, synchronizer, config), rel_dir, None))
+        for file_name in file_names:
+            del deleted[file_name]
+    for rel_path, last_entry in deleted.items():
+        tasks.append((delete_remote_file, (rel_path, queue, synchronizer, config, last_entry), rel_path, None))
+    return tasks
 
 
-def check_authorization(synchronizer: Synchronizer, queue: Queue, events_hash):
+def observe_phase(phase: str, pair_name: str, started: float) -> float:
+    # Records the time since started, returns the start of the next phase
+    now = perf_counter()
+    metrics.observe('file_synch_pass_phase_duration_seconds', now - started, DURATION_BUCKETS, phase=phase, pair=pair_name)
+    return now
+
+
+def hold_unsettled_files(stability_gate: Optional[StabilityGate], local_stats: dict, last_local_data: dict, queue: Queue) -> set[str]:
+    # Files still being written look untouched to the pass: recorded ones keep their recorded stat, new ones
+    # are left out. Returns the left out ones, they are taken out of the remote listing too.
+    if stability_gate is None:
+        return set()
+    previously_held = stability_gate.held
+    left_out = set()
+    for rel_path in stability_gate.hold(local_stats, last_local_data):
+        if rel_path not in previously_held:
+            log = f'File {rel_path} is still being written, it is synchronized once it settles.'
+            propagate_log(log, queue, False)
+        last_entry = last_local_data.get(rel_path)
+        if isinstance(last_entry, dict) and last_entry.get('sha256'):
+            local_stats[rel_path] = {key: last_entry.get(key) for key in ('size', 'mtime_ns', 'inode')}
+        else:
+            del local_stats[rel_path]
+            last_local_data.pop(rel_path, None)
+            left_out.add(rel_path)
+    return left_out
+
+
+def synchronization(synchronizer: Synchronizer, queue: Queue, events_hash: dict[str, Event], tree_index: TreeIndex, record_keeping: RecordKeeping, dirty_file_names: Optional[set[str]] = None, reconcile: bool = False, large_file_lane: Optional[LargeFileLane] = None, task_pool: Optional[FairTaskPool] = None, stability_gate: Optional[StabilityGate] = None):
+    if not record_keeping.is_initialized():
+        first_synchronization(synchronizer, queue, events_hash, tree_index, record_keeping, large_file_lane, task_pool, stability_gate)
+        return
+
+    pair_name = synchronizer.pair_name
+    started = perf_counter()
+    if dirty_file_names is None or reconcile:
+        if dirty_file_names:
+            # Edits reported by the watcher do not touch directory mtimes, the index takes them before the scan
+            dirty_stats = get_meta_data_dirty_files(dirty_file_names, synchronizer.pair_config())
+            for dirty_file_name in dirty_file_names:
+                tree_index.update_file(dirty_file_name, dirty_stats.get(dirty_file_name))
+        local_stats = get_meta_data_files_local_folder(queue, events_hash, tree_index, synchronizer.pair_name)
+        local_stats = {rel_path: stat for rel_path, stat in local_stats.items() if not is_partial_download(rel_path)}
+        last_local_data = dict(record_keeping.items())
+    else:
+        # Only rows of the reported files are looked up, the rest of the record keeping is not read
+        local_stats = get_meta_data_dirty_files(dirty_file_names, synchronizer.pair_config())
+        for dirty_file_name in dirty_file_names:
+            tree_index.update_file(dirty_file_name, local_stats.get(dirty_file_name))
+        last_local_data = {}
+        for dirty_file_name in dirty_file_names:
+            last_entry = record_keeping.get(dirty_file_name)
+            if last_entry is not None:
+                last_local_data[dirty_file_name] = last_entry
+    tree_index.save()
+    left_out = hold_unsettled_files(stability_gate, local_stats, last_local_data, queue)
+    started = observe_phase('scan', pair_name, started)
+    # One snapshot for the whole pass, workers never see the configuration change under them
+    config = synchronizer.pair_config()
+    local_data = detect_changes(config.local_path, local_stats, last_local_data, config.hash_workers)
+    started = observe_phase('hash', pair_name, started)
+
+    remote_index = None
+    if reconcile:
+        remote_index = get_remote_index(synchronizer, queue, config)
+        if remote_index is not None:
+            for rel_path in left_out:
+                remote_index.pop(rel_path, None)
+        started = observe_phase('remote_listing', pair_name, started)
+    tasks = plan_sync_tasks(local_data, last_local_data, remote_index, queue, synchronizer, record_keeping, config)
+    started = observe_phase('plan', pair_name, started)
+    try:
+        changes_have_been_made = run_sync_tasks(tasks, record_keeping, config, large_file_lane, task_pool)
+    finally:
+        # Files synchronized before a connection failure stay recorded, the index first,
+        # packed files are never recorded without their location
+        get_pack_index(config).save()
+        record_keeping.commit()
+        observe_phase('transfer', pair_name, started)
+
+    # if changes_have_been_made:
+    #     log = 'Scanning is over. Changes have been made.'
+    #     propagate_log(log, queue, False)
+    # else:
+    #     pass
+        # log = 'Scanning is over. Changes not found.'
+        # propagate_log(log, queue, False)
+
+
+def check_authorization(synchronizer: Synchronizer, queue: Queue, events_hash, wait_for_token: bool = True) -> bool:
+    # Without waiting for a new token a wrong one is reported and False is returned
     detected_wrong_token = False
     while not events_hash['exit_event'].is_set():
         if not synchronizer.get_info().status_code == 401:
@@ -217,21 +1434,44 @@ def check_authorization(synchronizer: Synchronizer, queue: Queue, events_hash):
         detected_wrong_token = True
         log = f'Authorization unsuccessfully. Please, set valid OAuth-token.'
         propagate_log(log, queue)
-        sleep(10)
+        if not wait_for_token:
+            return False
+        events_hash['exit_event'].wait(10)
     if events_hash['exit_event'].is_set():
         exit()
     if detected_wrong_token:
         log = 'Token updated. Authorization successfully.'
         propagate_log(log, queue, False)
+    return True
 
 
-def get_meta_data_files_local_folder(queue: Queue, events_hash: dict[str, Event]) -> dict[str, int]:
-    parser.read(CONFIG_PATH)
-    local_path = parser.get('app_config', 'local_path')
+def get_own_rel_paths(config: Config) -> set[str]:
+    # Record keeping, index and log may live inside the synchronized folder, they are never uploaded
+    own_paths = []
+    for own_path in (config.record_keeping_path, config.tree_index_path, config.pack_index_path, config.journal_path, config.log_path):
+        if own_path:
+            own_paths += [own_path, own_path + '.tmp']
+    record_keeping_stem = os.path.splitext(config.record_keeping_path)[0]
+    own_paths += [record_keeping_stem + suffix for suffix in ('.db', '.db-wal', '.db-shm', '.db-journal')]
+
+    own_rel_paths = set()
+    for own_path in own_paths:
+        rel_path = os.path.relpath(os.path.abspath(own_path), os.path.abspath(config.local_path))
+        if not rel_path.startswith('..'):
+            own_rel_paths.add(rel_path.replace(os.sep, '/'))
+    return own_rel_paths
+
+
+def get_meta_data_files_local_folder(queue: Queue, events_hash: dict[str, Event], tree_index: TreeIndex, pair_name: str = DEFAULT_PAIR) -> dict[str, dict[str, int]]:
+    config = get_pair_config(pair_name, True)
     detected_wrong_folder = False
     while not events_hash['exit_event'].is_set():
-        parser.read(CONFIG_PATH)
-        local_path = parser.get('app_config', 'local_path')
+        config = get_pair_config(pair_name, True)
+        if config is None:
+            log = f'Sync pair {pair_name} removed from configuration.'
+            propagate_log(log, queue)
+            exit()
+        local_path = config.local_path
         if os.path.exists(local_path):
             break
         else:
@@ -239,7 +1479,7 @@ def get_meta_data_files_local_folder(queue: Queue, events_hash: dict[str, Event]
             log = (f'Local directory {"not exists" if local_path else "not set"}.'
                    f' Press key "Change local directory and choose folder for synchronization')
             propagate_log(log, queue)
-            sleep(10)
+            events_hash['exit_event'].wait(10)
 
     if events_hash['exit_event'].is_set():
         exit()
@@ -247,55 +1487,150 @@ def get_meta_data_files_local_folder(queue: Queue, events_hash: dict[str, Event]
         log = 'Local directory updated.'
         propagate_log(log, queue, False)
 
+    local_stats = tree_index.scan(config.local_path, get_own_rel_paths(config))
+    metrics.set('file_synch_scan_files', len(local_stats), pair=pair_name)
+    metrics.set('file_synch_scan_bytes', sum(stat['size'] for stat in local_stats.values()), pair=pair_name)
+    return local_stats
+
+
+def get_meta_data_dirty_files(dirty_file_names: set[str], config: Config) -> dict[str, dict[str, int]]:
     local_files_hash = {}
-    for local_file_name in os.listdir(local_path):
-        local_file_path = f'{local_path}/{local_file_name}'
-        if os.path.isfile(local_file_path):
-            local_files_hash[local_file_name] = os.path.getsize(local_file_path)
-    try:
-        local_files_hash.pop(parser.get('app_config', 'record_keeping_path').split('/')[-1])
-    except KeyError:
-        pass
+    for dirty_file_name in dirty_file_names - get_own_rel_paths(config):
+        if is_partial_download(dirty_file_name):
+            continue
+        local_file_path = f'{config.local_path}/{dirty_file_name}'
+        try:
+            if os.path.isfile(local_file_path):
+                local_files_hash[dirty_file_name] = stat_file(local_file_path)
+        except FileNotFoundError:
+            pass
 
     return local_files_hash
 
 
-def first_synchronization(synchronizer: Synchronizer, queue: Queue, events_hash: dict[str, Event]):
-    parser.read('config_ini')
-    log = 'Initialize new record keeping.'
+def first_synchronization(synchronizer: Synchronizer, queue: Queue, events_hash: dict[str, Event], tree_index: TreeIndex, record_keeping: RecordKeeping, large_file_lane: Optional[LargeFileLane] = None, task_pool: Optional[FairTaskPool] = None, stability_gate: Optional[StabilityGate] = None):
+    # Files recorded by an interrupted initialization, replayed from the journal, are not hashed or sent again
+    last_local_data = dict(record_keeping.items())
+    if last_local_data:
+        log = f'Resume initializing record keeping, {len(last_local_data)} files are recorded already.'
+    else:
+        log = 'Initialize new record keeping.'
     propagate_log(log, queue, False)
 
     # vvv infinity validation user parameters vvv
     check_authorization(synchronizer, queue, events_hash)
-    local_data = get_meta_data_files_local_folder(queue, events_hash)
+    pair_name = synchronizer.pair_name
+    started = perf_counter()
+    local_stats = get_meta_data_files_local_folder(queue, events_hash, tree_index, pair_name)
+    tree_index.save()
     # ^^^ infinity validation user parameters ^^^
+    left_out = hold_unsettled_files(stability_gate, local_stats, last_local_data, queue)
+    started = observe_phase('scan', pair_name, started)
+    config = synchronizer.pair_config()
+    local_data = detect_changes(config.local_path, local_stats, last_local_data, config.hash_workers)
+    started = observe_phase('hash', pair_name, started)
 
-    local_folder_name = parser.get('app_config', 'local_path').split('/')[-1]
-    synchronizer.create_folder(local_folder_name)
+    synchronizer.create_folder(config.local_folder_name)
 
-    record_keeping = local_data.copy()
-    record_keeping_path = parser.get('app_config', 'record_keeping_path')
-    record_keeping_abspath = os.path.abspath(record_keeping_path)
-    if os.path.exists(record_keeping_abspath):
-        os.remove(record_keeping_abspath)
+    # Files already on the remote storage with the same content are only recorded, not uploaded again
+    remote_index = get_remote_index(synchronizer, queue, config)
+    if remote_index is not None:
+        for rel_path in left_out:
+            remote_index.pop(rel_path, None)
+    started = observe_phase('remote_listing', pair_name, started)
+    tasks = plan_sync_tasks(local_data, last_local_data, remote_index, queue, synchronizer, record_keeping, config)
+    started = observe_phase('plan', pair_name, started)
+    run_sync_tasks(tasks, record_keeping, config, large_file_lane, task_pool)
+    observe_phase('transfer', pair_name, started)
+    get_pack_index(config).save()
+    record_keeping.mark_initialized()
+    record_keeping.commit()
 
-    for local_file_name in local_data:
-        abs_local_file_path = local_folder_name + '/' + local_file_name
-        if load_local_file(local_file_name, queue, synchronizer):
-            record_keeping[local_file_name] = os.path.getsize(abs_local_file_path)
 
-    with open(record_keeping_path, 'w') as file:
-        json.dump(record_keeping, file, indent=4)
+def verify_intent(intent: dict, record_keeping: RecordKeeping, synchronizer: Synchronizer, config: Config) -> bool:
+    # An upload left in flight is finished if the remote file has the hash it was started with and the local
+    # file is still the one hashed, a delete if the remote file is gone. Anything else is planned by the next pass.
+    rel_path = intent['path']
+    entry = intent['entry']
+    last_entry = record_keeping.get(rel_path)
+    if isinstance(last_entry, dict) and last_entry.get('remote_path'):
+        # Stored chunked, compressed or packed, the remote file under its own name tells nothing
+        return False
+    if intent['intent'] in ('load_local_file', 'push_local_file'):
+        if not isinstance(entry, dict) or not entry.get('sha256'):
+            return False
+        try:
+            local_stat = stat_file(os.path.join(config.local_path, rel_path))
+        except FileNotFoundError:
+            return False
+        if not same_stat(entry, local_stat) or get_remote_sha256(rel_path, synchronizer) != entry['sha256']:
+            return False
+        record_keeping[rel_path] = entry
+        return True
+    if intent['intent'] == 'delete_remote_file':
+        if last_entry is None or synchronizer.get_file_info(rel_path).status_code != 404:
+            return False
+        record_keeping.pop(rel_path)
+        return True
+    return False
 
 
-def sleep_by_interval(events_hash: dict[str, Event]):
-    start_wait = time()
-    interval = float(parser.get('app_config', 'interval'))
-    while time() - start_wait < interval and not events_hash['interval_set_event'].is_set() and not events_hash['exit_event'].is_set():
-        pass
+def replay_journal(synchronizer: Synchronizer, record_keeping: RecordKeeping, queue: Queue, config: Config):
+    # Brings record keeping to the moment the last run stopped: operations it finished are recorded,
+    # the ones it left in flight are verified on the remote storage, only the rest is synchronized again
+    changes, intents = record_keeping.journal.read()
+    if not changes and not intents:
+        return
+    recovered_count = 0
+    for done_changes in changes:
+        apply_changes(record_keeping, done_changes)
+        recovered_count += len(done_changes)
+    verified_count = 0
+    try:
+        for intent in intents:
+            if verify_intent(intent, record_keeping, synchronizer, config):
+                verified_count += 1
+    except TRANSFER_ERRORS as e:
+        log = f'Verifying interrupted operations unsuccessfully. {type(e).__name__}. They are left for the next scan.'
+        propagate_log(log, queue)
+    record_keeping.commit()
+    log = (f'Journal replayed: {recovered_count} records restored, {verified_count} of {len(intents)} '
+           f'interrupted operations verified, the rest is left for the next scan.')
+    propagate_log(log, queue, False)
+
+
+def sleep_by_interval(events_hash: dict[str, Event], folder_watch: FolderWatch, large_file_lane: Optional[LargeFileLane] = None, interval: Optional[float] = None, operations: Optional[OperationPoller] = None):
+    # Blocks until the interval passes or somebody sets wake_event: the GUI after changing
+    # the interval or exiting, the filesystem watcher after a debounced change, the large file lane
+    # after a finished transfer, the operation poller after a finished remote delete.
+    deadline = monotonic() + (config_store.current.interval if interval is None else interval)
+    wake_event = events_hash['wake_event']
+    while (
+        not events_hash['interval_set_event'].is_set()
+        and not events_hash['exit_event'].is_set()
+        and not folder_watch.has_dirty()
+        and not (large_file_lane is not None and large_file_lane.has_finished())
+        and not (operations is not None and operations.has_finished())
+    ):
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            break
+        wake_event.wait(remaining)
+        wake_event.clear()
     events_hash['interval_set_event'].clear()
 
 
+def setup_logging(config: Config):
+    # Opened by the main cycle rather than on import, importing app does not touch the disk
+    root_logger = logging.getLogger()
+    log_path = os.path.abspath(config.log_path)
+    if not any(getattr(handler, 'baseFilename', None) == log_path for handler in root_logger.handlers):
+        handler = logging.FileHandler(log_path)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        root_logger.addHandler(handler)
+    root_logger.setLevel(min(root_logger.getEffectiveLevel(), logging.INFO))
+
+
 def propagate_log(log: str, queue: Queue, error: bool = True):
     if error:
         logger.error(log)
@@ -304,31 +1639,250 @@ def propagate_log(log: str, queue: Queue, error: bool = True):
     queue.put(datetime.now().strftime("%d.%m.%y %H:%M:%S ") + log)
 
 
-def mainloop(queue: Queue, events_hash: dict[str, Event]):
-    log = f'File synchronizer start working with directory: {parser.get("app_config", "local_path")}'
-    propagate_log(log, queue, False)
-    parser.read(CONFIG_PATH)
+def refresh_folder_watch(folder_watch: FolderWatch, queue: Queue, config: Config):
+    error = folder_watch.refresh(config.local_path, config.watch_mode, config.debounce)
+    if error:
+        log = f'Filesystem watcher unavailable. {error} Scanning by interval.'
+        propagate_log(log, queue)
+
+
+def run_pair(queue: Queue, events_hash: dict[str, Event], pair_name: str, transport: ApiTransport, task_pool: FairTaskPool, once: bool = False) -> bool:
+    # Runs the main cycle of one sync pair. With once a single full pass is made and nothing is waited for:
+    # a wrong folder or token and connection errors end it, the result tells whether the pass succeeded.
+    config = get_pair_config(pair_name, True)
+    if config is None:
+        return False
     synchronizer = Synchronizer(
-        parser.get('api', 'token'),
+        config.token,
         events_hash,
         queue,
+        pair_name,
+        transport,
     )
+    folder_watch = FolderWatch(events_hash['wake_event'])
+    tree_index = TreeIndex(config.tree_index_path, config.full_rescan_every)
+    # Held files are checked again by every pass until they settle, with the watcher a close ends the wait
+    stability_gate = StabilityGate(config.settle_time, folder_watch.pop_closed) if config.settle_time else None
 
-    try:
-        if not os.path.exists(parser.get('app_config', 'record_keeping_path')):
-            first_synchronization(synchronizer, queue, events_hash)
-            log = 'Initializing record keeping is over.'
-            propagate_log(log, queue, False)
+    record_keeping = open_record_keeping(config.record_keeping_backend, config.record_keeping_path)
+    if config.journal_path:
+        record_keeping.journal = IntentJournal(config.journal_path)
+    journal_replayed = record_keeping.journal is None
+    # A single pass has nobody to hand finished big transfers to, it waits for them with the rest
+    large_file_lane = None if once else LargeFileLane(config.large_file_workers, events_hash['wake_event'].set)
+    if large_file_lane is not None:
+        metrics.register_collector(f'large_file_lane.{pair_name}', lambda: [
+            ('file_synch_queue_depth', {'queue': f'large_files_{state}', 'pair': pair_name}, depth)
+            for state, depth in large_file_lane.depth().items()
+        ])
+    metrics.register_collector(f'remote_operations.{pair_name}', lambda: [
+        ('file_synch_queue_depth', {'queue': 'remote_operations', 'pair': pair_name}, synchronizer.operations.depth()),
+    ])
 
+    passes_count = 0
+    last_remote_poll = monotonic()
+    failures_count = 0
+    full_scan_pending = False
+    compaction = None
+    settle_rounds = 0
+
+    def wait_for_settling() -> bool:
+        # A single pass waits a little for files still being written and runs again,
+        # a file written all the time is left for the next run
+        nonlocal settle_rounds
+        if stability_gate is None or not stability_gate.held or settle_rounds >= SETTLE_ROUNDS:
+            return False
+        settle_rounds += 1
+        return synchronizer.wait(config.settle_time)
+
+    try:
         # vvv Main cycle vvv
         while not events_hash['exit_event'].is_set():
-            parser.read(CONFIG_PATH)
-            sleep_by_interval(events_hash)
-            check_authorization(synchronizer, queue, events_hash)
-            synchronization(synchronizer, queue, events_hash)
+            try:
+                if once:
+                    if not os.path.isdir(config.local_path):
+                        log = f'Local directory {config.local_path or "not set"} not found.'
+                        propagate_log(log, queue)
+                        return False
+                    if not check_authorization(synchronizer, queue, events_hash, False):
+                        return False
+                if not journal_replayed:
+                    replay_journal(synchronizer, record_keeping, queue, config)
+                    journal_replayed = True
+                if not record_keeping.is_initialized():
+                    first_synchronization(synchronizer, queue, events_hash, tree_index, record_keeping, large_file_lane, task_pool, stability_gate)
+                    log = 'Initializing record keeping is over.'
+                    propagate_log(log, queue, False)
+                    if once and not wait_for_settling():
+                        return True
+
+                # Parsed again only when config.ini changed since the last pass
+                config = get_pair_config(pair_name, True)
+                log = config_store.pop_error()
+                if log:
+                    propagate_log(log, queue)
+                if config is None:
+                    log = f'Sync pair {pair_name} removed from configuration.'
+                    propagate_log(log, queue)
+                    break
+                transport.apply_bandwidth(config_store.current)
+                log = transport.pop_bandwidth_error()
+                if log:
+                    propagate_log(log, queue)
+                if not once:
+                    refresh_folder_watch(folder_watch, queue, config)
+                    interval = config.interval
+                    if stability_gate is not None and stability_gate.held:
+                        # Held files are checked again as soon as they may have settled
+                        interval = min(interval, config.settle_time)
+                    sleep_by_interval(events_hash, folder_watch, large_file_lane, interval, synchronizer.operations)
+                finished_file_names = collect_large_files(large_file_lane, record_keeping, queue)
+                finished_file_names |= collect_remote_operations(synchronizer, record_keeping, config, queue)
+                if finished_file_names:
+                    record_keeping.commit()
+                # After a failed pass the reported edits are gone, cached stats can not be trusted
+                tree_index.trust_directory_mtime = folder_watch.watcher is not None and not full_scan_pending
+                dirty_file_names = folder_watch.pop_dirty()
+                if full_scan_pending:
+                    dirty_file_names = None
+                # Remote changes are only seen in the remote listing, it is read by interval when pulling
+                remote_poll_due = config.sync_direction == 'both' and (once or monotonic() - last_remote_poll >= config.remote_poll_interval)
+                if dirty_file_names is not None:
+                    dirty_file_names |= finished_file_names
+                    if stability_gate is not None:
+                        dirty_file_names |= stability_gate.held
+                    dirty_file_names -= get_own_rel_paths(config)
+                    if not dirty_file_names and not remote_poll_due:
+                        continue
+                passes_count += 1
+                reconcile = remote_poll_due or (bool(config.reconcile_every) and passes_count % config.reconcile_every == 0)
+                if reconcile:
+                    last_remote_poll = monotonic()
+                check_authorization(synchronizer, queue, events_hash)
+                # A pass is profiled when profile_path is set and the file is missing, removing it profiles the next one
+                profile_path = config.profile_path if config.profile_path and not os.path.exists(config.profile_path) else ''
+                with profile_to(profile_path) if profile_path else nullcontext():
+                    synchronization(
+                        synchronizer, queue, events_hash, tree_index, record_keeping,
+                        dirty_file_names, reconcile, large_file_lane, task_pool, stability_gate
+                    )
+                if profile_path:
+                    log = f'Profile of the pass saved to {profile_path}.'
+                    propagate_log(log, queue, False)
+                # Bundles are compacted on the shared workers between passes, one compaction at a time
+                if compaction is not None and compaction.done():
+                    compaction.result()
+                    compaction = None
+                if compaction is None and get_pack_index(config).needs_compaction(config.bundle_compaction_ratio):
+                    compaction = task_pool.submit(pair_name, run_timed_task, compact_bundles, queue, synchronizer, config)
+                # Chunks of removed files and of failed deletes, uploads collect the ones they replace themselves
+                collect_chunk_garbage(queue, synchronizer, config)
+                full_scan_pending = False
+                failures_count = 0
+                if once:
+                    if wait_for_settling():
+                        continue
+                    # Deletes still running on the remote storage are recorded before the end
+                    while not synchronizer.operations.wait(1) and not events_hash['exit_event'].is_set():
+                        pass
+                    if compaction is not None:
+                        compaction.result()
+                    return True
+
+            except TRANSFER_ERRORS as e:
+                if once:
+                    log = f'Connection error. Check the internet connection. {type(e).__name__}.'
+                    propagate_log(log, queue)
+                    return False
+                # Changes reported for the failed pass are gone, the next pass scans the whole folder
+                full_scan_pending = True
+                failures_count += 1
+                config = synchronizer.pair_config()
+                delay = config.interval + backoff_delay(failures_count, config.interval, 300)
+                log = f'Connection error. Check the internet connection. {type(e).__name__}. Next attempt in {delay:.1f} s.'
+                propagate_log(log, queue)
+                synchronizer.wait(delay)
         # ^^^ Main cycle ^^^
 
-    except requests.exceptions.ConnectionError:
-        log = 'Connection error. Check the internet connection.'
+        return True
+
+    finally:
+        if large_file_lane is not None:
+            metrics.unregister_collector(f'large_file_lane.{pair_name}')
+            large_file_lane.close()
+            collect_large_files(large_file_lane, record_keeping, queue)
+        metrics.unregister_collector(f'remote_operations.{pair_name}')
+        synchronizer.operations.close()
+        collect_remote_operations(synchronizer, record_keeping, synchronizer.pair_config(), queue)
+        record_keeping.commit()
+        folder_watch.close()
+        record_keeping.close()
+        if record_keeping.journal is not None:
+            record_keeping.journal.close()
+
+
+def mainloop(queue: Queue, events_hash: dict[str, Event], once: bool = False) -> bool:
+    # Returns whether every sync pair ended without errors, with once after its single pass
+    try:
+        config = config_store.reload()
+    except ValueError as e:
+        log = f'Configuration error. {e}'
+        propagate_log(log, queue)
+        return False
+    setup_logging(config)
+    log = f'File synchronizer start working with directory: {config.local_path}'
+    propagate_log(log, queue, False)
+    if config.compression == 'zstd' and zstandard is None:
+        log = 'Package zstandard is not installed, files are compressed with gzip.'
         propagate_log(log, queue)
-        mainloop(queue, events_hash)
+    # Every sync pair runs its own loop, the API connections and the workers are shared by all of them
+    transport = ApiTransport(config, events_hash['exit_event'])
+    task_pool = FairTaskPool(config.workers)
+    metrics.register_collector('queues', lambda: [
+        ('file_synch_queue_depth', {'queue': 'log'}, queue.qsize()),
+        *(('file_synch_queue_depth', {'queue': 'tasks', 'pair': pair_name}, depth) for pair_name, depth in task_pool.depth().items()),
+    ])
+    metrics_exporter = None
+    if config.metrics_port or config.metrics_path:
+        try:
+            metrics_exporter = MetricsExporter(config.metrics_port, config.metrics_path, config.metrics_interval)
+        except OSError as e:
+            log = f'Metrics endpoint on port {config.metrics_port} unavailable. {e}'
+            propagate_log(log, queue)
+    pair_names = config.pair_names
+    pair_events_hashes = [
+        {**create_events_hash(), 'exit_event': events_hash['exit_event']} for _ in pair_names[1:]
+    ]
+    results = {}
+
+    def run_pair_thread(pair_name, pair_events_hash):
+        results[pair_name] = False
+        results[pair_name] = run_pair(queue, pair_events_hash, pair_name, transport, task_pool, once)
+
+    pair_threads = [
+        Thread(target=run_pair_thread, args=(pair_name, pair_events_hash), name=f'pair-{pair_name}')
+        for pair_name, pair_events_hash in zip(pair_names[1:], pair_events_hashes)
+    ]
+    for pair_name in pair_names[1:]:
+        log = f'Sync pair {pair_name} start working with directory: {config.pair_config(pair_name).local_path}'
+        propagate_log(log, queue, False)
+    for thread in pair_threads:
+        thread.start()
+    try:
+        run_pair_thread(pair_names[0], events_hash)
+        if once:
+            for thread in pair_threads:
+                thread.join()
+        else:
+            # Exit is requested through the events of the first pair, the others sleep on their own wake events
+            events_hash['exit_event'].wait()
+    finally:
+        events_hash['exit_event'].set()
+        for pair_events_hash in pair_events_hashes:
+            pair_events_hash['wake_event'].set()
+        for thread in pair_threads:
+            thread.join()
+        task_pool.close()
+        if metrics_exporter is not None:
+            metrics_exporter.close()
+    return all(results.values())
@@ -0,0 +1,50 @@
+import argparse
+import os
+import sys
+import tempfile
+from threading import Thread
+from time import monotonic, process_time, sleep
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+from watcher import FolderWatch
+
+
+def measure_idle_cpu(duration: float, watch_mode: str) -> float:
+    # Runs the idle part of the main cycle, waiting for the next scan, and returns CPU time per wall second
+    events_hash = app.create_events_hash()
+    with tempfile.TemporaryDirectory() as local_path:
+        app.config_store.override(interval=duration * 10)
+        folder_watch = FolderWatch(events_hash['wake_event'])
+        folder_watch.refresh(local_path, watch_mode, 0.5)
+        sleeping_thread = Thread(target=app.sleep_by_interval, args=(events_hash, folder_watch))
+
+        start_cpu, start_wall = process_time(), monotonic()
+        sleeping_thread.start()
+        sleep(duration)
+        cpu, wall = process_time() - start_cpu, monotonic() - start_wall
+
+        events_hash['exit_event'].set()
+        events_hash['wake_event'].set()
+        sleeping_thread.join()
+        folder_watch.close()
+    return cpu / wall
+
+
+def main():
+    arguments_parser = argparse.ArgumentParser(description='Measure CPU usage of the synchronizer while it waits for the next scan.')
+    arguments_parser.add_argument('--duration', type=float, default=5.0)
+    arguments_parser.add_argument('--watch-mode', choices=('poll', 'inotify'), default='inotify')
+    arguments_parser.add_argument('--budget', type=float, default=0.02, help='Maximum share of one core, 0.02 is 2%%.')
+    arguments = arguments_parser.parse_args()
+
+    cpu_share = measure_idle_cpu(arguments.duration, arguments.watch_mode)
+    print(f'Idle CPU usage: {cpu_share * 100:.2f}% of one core over {arguments.duration} s ({arguments.watch_mode}).')
+    if cpu_share > arguments.budget:
+        print(f'Budget of {arguments.budget * 100:.2f}% exceeded.')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
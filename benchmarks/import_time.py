@@ -0,0 +1,76 @@
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that must stay out of the import of an entry point, they are loaded on first use
+LAZY_MODULES = {
+    'app': ('pygame', 'tkinter', 'gui'),
+    'cli': ('pygame', 'tkinter', 'gui'),
+    'main': ('pygame', 'tkinter', 'gui', 'app', 'requests'),
+    'gui.gui_': ('pygame',),
+}
+
+
+def measure_import(module: str) -> tuple[int, list[tuple[int, int, str]]]:
+    # Imports the module in a fresh interpreter with -X importtime, returns its cumulative time in microseconds
+    # and (self, cumulative, name) of every module imported on the way
+    code = f'import sys, {module}; print(",".join(sys.modules))'
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT, capture_output=True, text=True
+    )
+    if result.returncode:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    imported = set(result.stdout.strip().split(','))
+    for lazy_module in LAZY_MODULES.get(module, ()):
+        if any(name == lazy_module or name.startswith(lazy_module + '.') for name in imported if name != module):
+            raise RuntimeError(f'{lazy_module} is imported eagerly.')
+
+    lines = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, cumulative_time, name = line[len('import time:'):].split('|')
+        lines.append((int(self_time), int(cumulative_time), name.strip(), len(name) - len(name.lstrip())))
+    # A module is printed after its imports, they are the deeper indented lines right above it.
+    # Modules loaded by the interpreter itself (site) are left out.
+    index = max(index for index, line in enumerate(lines) if line[2] == module)
+    depth = lines[index][3]
+    timings = [lines[index][:3]]
+    while index > 0 and lines[index - 1][3] > depth:
+        index -= 1
+        timings.append(lines[index][:3])
+    return timings[0][1], timings
+
+
+def main():
+    arguments_parser = argparse.ArgumentParser(description='Measure import time of the entry points with -X importtime.')
+    arguments_parser.add_argument('modules', nargs='*', default=['app', 'cli', 'main'])
+    arguments_parser.add_argument('--budget', type=float, default=250.0, help='Maximum import time of a module, ms.')
+    arguments_parser.add_argument('--repeat', type=int, default=3, help='The fastest run counts.')
+    arguments_parser.add_argument('--top', type=int, default=5, help='Slowest imports to show.')
+    arguments = arguments_parser.parse_args()
+
+    over_budget = False
+    for module in arguments.modules:
+        try:
+            runs = [measure_import(module) for _ in range(arguments.repeat)]
+        except RuntimeError as e:
+            print(f'{module}: {e}')
+            over_budget = True
+            continue
+        total, timings = min(runs)
+        print(f'{module}: {total / 1000:.1f} ms')
+        for self_time, cumulative_time, name in sorted(timings, key=lambda timing: -timing[1])[1:arguments.top + 1]:
+            print(f'    {name}: {cumulative_time / 1000:.1f} ms ({self_time / 1000:.1f} ms itself)')
+        if total / 1000 > arguments.budget:
+            print(f'    Budget of {arguments.budget:.0f} ms exceeded.')
+            over_budget = True
+    if over_budget:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
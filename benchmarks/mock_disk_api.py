@@ -0,0 +1,416 @@
+import argparse
+import hashlib
+import json
+import random
+import sys
+import urllib.parse
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from threading import Lock, Thread
+from time import monotonic, sleep
+from typing import Optional
+
+API_PREFIX = '/v1/disk/'
+TRANSFER_CHUNK_SIZE = 64 * 1024
+
+
+class StoredFile:
+    __slots__ = ('content', 'size', 'md5', 'sha256', 'modified')
+
+    def __init__(self, content: bytes, keep_content: bool = True):
+        self.content = content if keep_content else None
+        self.size = len(content)
+        self.md5 = hashlib.md5(content).hexdigest()
+        self.sha256 = hashlib.sha256(content).hexdigest()
+        self.modified = datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+
+def normalize_path(path: str) -> str:
+    if path.startswith('disk:'):
+        path = path[len('disk:'):]
+    return '/' + path.strip('/')
+
+
+def parent_path(path: str) -> str:
+    return path.rsplit('/', 1)[0] or '/'
+
+
+class MockDiskApi:
+    # In-memory stand-in for the part of the Disk API the synchronizer uses: resource info and folder
+    # listing, create folder, delete (202 with an operation for non-empty folders), upload and download
+    # links and the storage hrefs behind them. Every API request waits `latency` seconds, bodies move at
+    # `bandwidth` bytes per second per connection, and a share of the requests fails on purpose:
+    # api_error_rate of the API calls answer 429 or 5xx, storage_error_rate of the uploads answer 503.
+    # Without keep_content only sizes and hashes are stored, downloads then answer 410.
+    def __init__(
+        self,
+        port: int = 0,
+        latency: float = 0.0,
+        bandwidth: float = 0.0,
+        api_error_rate: float = 0.0,
+        storage_error_rate: float = 0.0,
+        operation_delay: float = 0.0,
+        token: str = '',
+        keep_content: bool = True,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.api_error_rate = api_error_rate
+        self.storage_error_rate = storage_error_rate
+        self.operation_delay = operation_delay
+        self.token = token
+        self.keep_content = keep_content
+        self.files: dict[str, StoredFile] = {}
+        self.stats: dict[str, int] = {}
+        self._children: dict[str, set[str]] = {'/': set()}
+        self._sorted_children: dict[str, list[str]] = {}
+        self._hrefs: dict[str, tuple[str, str]] = {}
+        self._operations: dict[str, float] = {}
+        self._ids = count(1)
+        self._random = random.Random(seed)
+        self._lock = Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), _MockHandler)
+        self._server.daemon_threads = True
+        self._server.api = self
+        self._thread = Thread(target=self._server.serve_forever, name='mock-disk-api', daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self._server.server_address[1]}'
+
+    @property
+    def api_base_url(self) -> str:
+        return self.url + API_PREFIX
+
+    def start(self) -> 'MockDiskApi':
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    # vvv Storage vvv
+    def is_folder(self, path: str) -> bool:
+        return path in self._children
+
+    def _link(self, path: str):
+        parent = parent_path(path)
+        self._children[parent].add(path.rsplit('/', 1)[1])
+        self._sorted_children.pop(parent, None)
+
+    def create_folder(self, path: str) -> int:
+        with self._lock:
+            if path in self._children or path in self.files:
+                return 409
+            if parent_path(path) not in self._children:
+                return 409
+            self._children[path] = set()
+            self._link(path)
+            return 201
+
+    def put_file(self, path: str, content: bytes) -> bool:
+        stored = StoredFile(content, self.keep_content)
+        with self._lock:
+            if parent_path(path) not in self._children:
+                return False
+            self.files[path] = stored
+            self._link(path)
+            return True
+
+    def remove(self, path: str) -> int:
+        # Returns the number of files removed, -1 when nothing is found
+        with self._lock:
+            if path in self.files:
+                del self.files[path]
+                removed = 1
+            elif path in self._children and path != '/':
+                removed = 0
+                stack = [path]
+                while stack:
+                    folder = stack.pop()
+                    for name in self._children.pop(folder):
+                        child = f'{folder}/{name}'
+                        if child in self.files:
+                            del self.files[child]
+                            removed += 1
+                        else:
+                            stack.append(child)
+                    self._sorted_children.pop(folder, None)
+            else:
+                return -1
+            parent = parent_path(path)
+            self._children[parent].discard(path.rsplit('/', 1)[1])
+            self._sorted_children.pop(parent, None)
+            return removed
+
+    def list_children(self, path: str, offset: int, limit: int) -> tuple[list[str], int]:
+        with self._lock:
+            if path not in self._sorted_children:
+                self._sorted_children[path] = sorted(self._children[path])
+            names = self._sorted_children[path]
+            return names[offset:offset + limit], len(names)
+    # ^^^ Storage ^^^
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self.stats[name] = self.stats.get(name, 0) + value
+
+    def injected_error(self, rate: float, statuses: tuple[int, ...]) -> Optional[int]:
+        with self._lock:
+            if rate <= 0 or self._random.random() >= rate:
+                return None
+            self.stats['injected_errors'] = self.stats.get('injected_errors', 0) + 1
+            return self._random.choice(statuses)
+
+    def new_href(self, kind: str, path: str) -> str:
+        href_id = str(next(self._ids))
+        with self._lock:
+            self._hrefs[href_id] = (kind, path)
+        return f'{self.url}/{kind}/{href_id}'
+
+    def take_href(self, kind: str, href_id: str) -> Optional[str]:
+        # Upload hrefs are good for one request, like the real ones
+        with self._lock:
+            found_kind, path = self._hrefs.get(href_id, (None, None))
+            if found_kind != kind:
+                return None
+            if kind == 'upload':
+                del self._hrefs[href_id]
+            return path
+
+    def new_operation(self) -> str:
+        operation_id = str(next(self._ids))
+        with self._lock:
+            self._operations[operation_id] = monotonic() + self.operation_delay
+        return operation_id
+
+    def operation_status(self, operation_id: str) -> Optional[str]:
+        with self._lock:
+            done_at = self._operations.get(operation_id)
+        if done_at is None:
+            return None
+        return 'success' if monotonic() >= done_at else 'in-progress'
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def api(self) -> MockDiskApi:
+        return self.server.api
+
+    def do_GET(self):
+        self._route('GET')
+
+    def do_PUT(self):
+        self._route('PUT')
+
+    def do_DELETE(self):
+        self._route('DELETE')
+
+    def _route(self, method: str):
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if not url.path.startswith(API_PREFIX):
+            kind, _, href_id = url.path.strip('/').partition('/')
+            self.api.count(f'{method} {kind}')
+            if method == 'PUT' and kind == 'upload':
+                self._upload(href_id)
+            elif method == 'GET' and kind == 'download':
+                self._download(href_id)
+            else:
+                self._error(404, 'NotFound')
+            return
+
+        endpoint = url.path[len(API_PREFIX):]
+        if endpoint.startswith('operations/'):
+            endpoint, operation_id = 'operations', endpoint.split('/', 1)[1]
+        self.api.count(f'{method} {endpoint}')
+        if self.api.latency:
+            sleep(self.api.latency)
+        if self.api.token and self.headers.get('Authorization') != f'OAuth {self.api.token}':
+            self._error(401, 'UnauthorizedError')
+            return
+        status = self.api.injected_error(self.api.api_error_rate, (429, 500, 502, 503))
+        if status is not None:
+            self._send_json(status, {'error': 'InjectedError'}, {'Retry-After': '1'} if status == 429 else None)
+            return
+
+        path = normalize_path(query.get('path', '/'))
+        if (method, endpoint) == ('GET', 'resources'):
+            self._get_resource(path, int(query.get('offset', 0)), int(query.get('limit', 20)))
+        elif (method, endpoint) == ('PUT', 'resources'):
+            status = self.api.create_folder(path)
+            if status == 201:
+                self._send_json(201, {'href': f'{self.api.api_base_url}resources?path=disk:{path}', 'method': 'GET'})
+            else:
+                self._error(status, 'DiskPathPointsToExistentDirectoryError')
+        elif (method, endpoint) == ('DELETE', 'resources'):
+            self._delete_resource(path)
+        elif (method, endpoint) == ('GET', 'resources/upload'):
+            if path in self.api.files and query.get('overwrite') != 'true':
+                self._error(409, 'DiskResourceAlreadyExistsError')
+            elif not self.api.is_folder(parent_path(path)):
+                self._error(409, 'DiskPathDoesntExistsError')
+            else:
+                self._send_json(200, {'href': self.api.new_href('upload', path), 'method': 'PUT', 'templated': False})
+        elif (method, endpoint) == ('GET', 'resources/download'):
+            if path not in self.api.files:
+                self._error(404, 'DiskNotFoundError')
+            else:
+                self._send_json(200, {'href': self.api.new_href('download', path), 'method': 'GET', 'templated': False})
+        elif (method, endpoint) == ('GET', 'operations'):
+            status = self.api.operation_status(operation_id)
+            if status is None:
+                self._error(404, 'OperationNotFoundError')
+            else:
+                self._send_json(200, {'status': status})
+        else:
+            self._error(404, 'NotFound')
+
+    def _send_json(self, status: int, body: Optional[dict] = None, headers: Optional[dict] = None):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, status: int, error: str):
+        self._send_json(status, {'error': error, 'description': error})
+
+    def _throttle(self, bytes_count: int, started: float):
+        if self.api.bandwidth:
+            delay = started + bytes_count / self.api.bandwidth - monotonic()
+            if delay > 0:
+                sleep(delay)
+
+    def _resource(self, path: str) -> Optional[dict]:
+        stored = self.api.files.get(path)
+        if stored is not None:
+            return {
+                'name': path.rsplit('/', 1)[1], 'path': 'disk:' + path, 'type': 'file', 'size': stored.size,
+                'md5': stored.md5, 'sha256': stored.sha256, 'modified': stored.modified,
+            }
+        if self.api.is_folder(path):
+            return {'name': path.rsplit('/', 1)[-1], 'path': 'disk:' + path, 'type': 'dir'}
+        return None
+
+    def _get_resource(self, path: str, offset: int, limit: int):
+        resource = self._resource(path)
+        if resource is None:
+            self._error(404, 'DiskNotFoundError')
+            return
+        if resource['type'] == 'dir':
+            names, total = self.api.list_children(path, offset, limit)
+            prefix = path.rstrip('/') + '/'
+            items = [self._resource(prefix + name) for name in names]
+            resource['_embedded'] = {
+                'items': [item for item in items if item is not None], 'total': total,
+                'offset': offset, 'limit': limit, 'path': 'disk:' + path,
+            }
+        self._send_json(200, resource)
+
+    def _delete_resource(self, path: str):
+        is_folder = self.api.is_folder(path)
+        removed = self.api.remove(path)
+        if removed < 0:
+            self._error(404, 'DiskNotFoundError')
+        elif is_folder and removed:
+            # Like the real API, removing a folder with files in it is an asynchronous operation
+            operation_id = self.api.new_operation()
+            self._send_json(202, {'href': f'{self.api.api_base_url}operations/{operation_id}', 'method': 'GET'})
+        else:
+            self._send_json(204)
+
+    def _read_body(self) -> bytes:
+        started = monotonic()
+        chunks = []
+        received = 0
+        chunked = self.headers.get('Transfer-Encoding', '').lower() == 'chunked'
+        remaining = int(self.headers.get('Content-Length', 0))
+        while chunked or remaining:
+            if chunked:
+                size = int(self.rfile.readline().split(b';')[0].strip(), 16)
+                chunk = self.rfile.read(size) if size else b''
+                self.rfile.readline()
+                if not size:
+                    break
+            else:
+                chunk = self.rfile.read(min(remaining, TRANSFER_CHUNK_SIZE))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+            chunks.append(chunk)
+            received += len(chunk)
+            self._throttle(received, started)
+        self.api.count('bytes_received', received)
+        return b''.join(chunks)
+
+    def _upload(self, href_id: str):
+        path = self.api.take_href('upload', href_id)
+        content = self._read_body()
+        if path is None:
+            self._error(404, 'UploadLinkNotFound')
+        elif self.api.injected_error(self.api.storage_error_rate, (503,)) is not None:
+            self._error(503, 'InjectedError')
+        elif not self.api.put_file(path, content):
+            self._error(409, 'DiskPathDoesntExistsError')
+        else:
+            self._send_json(201)
+
+    def _download(self, href_id: str):
+        path = self.api.take_href('download', href_id)
+        stored = self.api.files.get(path) if path is not None else None
+        if stored is None:
+            self._error(404, 'DiskNotFoundError')
+            return
+        if stored.content is None:
+            self._error(410, 'ContentNotKept')
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(stored.size))
+        self.end_headers()
+        started = monotonic()
+        for offset in range(0, stored.size, TRANSFER_CHUNK_SIZE):
+            self.wfile.write(stored.content[offset:offset + TRANSFER_CHUNK_SIZE])
+            self._throttle(min(stored.size, offset + TRANSFER_CHUNK_SIZE), started)
+        self.api.count('bytes_sent', stored.size)
+
+
+def main():
+    arguments_parser = argparse.ArgumentParser(description='Local mock of the Disk API for offline runs and benchmarks.')
+    arguments_parser.add_argument('--port', type=int, default=8080)
+    arguments_parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every API request.')
+    arguments_parser.add_argument('--bandwidth', type=float, default=0.0, help='Bytes per second per connection, 0 is unlimited.')
+    arguments_parser.add_argument('--api-error-rate', type=float, default=0.0, help='Share of API requests failing with 429 or 5xx.')
+    arguments_parser.add_argument('--storage-error-rate', type=float, default=0.0, help='Share of uploads failing with 503.')
+    arguments_parser.add_argument('--operation-delay', type=float, default=0.0, help='Seconds an asynchronous delete stays in progress.')
+    arguments_parser.add_argument('--token', default='', help='Only this OAuth token is accepted, any token if empty.')
+    arguments_parser.add_argument('--seed', type=int, default=0)
+    arguments = arguments_parser.parse_args()
+
+    api = MockDiskApi(
+        arguments.port, arguments.latency, arguments.bandwidth, arguments.api_error_rate,
+        arguments.storage_error_rate, arguments.operation_delay, arguments.token, seed=arguments.seed,
+    ).start()
+    print(f'Mock Disk API on {api.api_base_url}, set api_base_url in config.ini to use it.', flush=True)
+    try:
+        while True:
+            sleep(3600)
+    except KeyboardInterrupt:
+        api.close()
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
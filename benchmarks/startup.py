@@ -0,0 +1,64 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Each build is started in a fresh interpreter and brought to the point where synchronization can begin.
+# The GUI build is measured up to its sounds, the display is not needed for that.
+BUILDS = {
+    'headless': (
+        'import sys, cli\n'
+        'gui_modules = [name for name in sys.modules if name.split(".")[0] in ("pygame", "tkinter", "gui")]\n'
+        'assert not gui_modules, f"GUI modules imported: {gui_modules}"\n'
+    ),
+    'gui': (
+        'import main, pygame\n'
+        'from gui.gui_ import _Sounds\n'
+        '_Sounds()._loaded_event.wait()\n'
+    ),
+}
+
+
+def measure_start(code: str) -> tuple[float, int]:
+    # Returns wall time of the whole process and its peak RSS in KiB
+    environment = {**os.environ, 'SDL_AUDIODRIVER': 'dummy', 'PYGAME_HIDE_SUPPORT_PROMPT': '1'}
+    start = perf_counter()
+    process = subprocess.Popen([sys.executable, '-c', code], cwd=ROOT, env=environment, stderr=subprocess.PIPE)
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    error = process.stderr.read().decode(errors='replace').strip()
+    process.stderr.close()
+    if process.returncode:
+        raise RuntimeError(error.splitlines()[-1] if error else f'exit status {process.returncode}')
+    return elapsed, usage.ru_maxrss
+
+
+def main():
+    arguments_parser = argparse.ArgumentParser(description='Compare cold start time and memory of the headless and the GUI builds.')
+    arguments_parser.add_argument('--repeat', type=int, default=5)
+    arguments = arguments_parser.parse_args()
+
+    results = {}
+    for build, code in BUILDS.items():
+        try:
+            samples = [measure_start(code) for _ in range(arguments.repeat)]
+        except RuntimeError as e:
+            print(f'{build}: unavailable, {e}')
+            if build == 'headless':
+                sys.exit(1)
+            continue
+        results[build] = statistics.median(sample[0] for sample in samples), max(sample[1] for sample in samples)
+        print(f'{build}: start {results[build][0] * 1000:.0f} ms (median of {arguments.repeat}), peak RSS {results[build][1] / 1024:.1f} MiB')
+
+    if len(results) == 2:
+        headless, gui = results['headless'], results['gui']
+        print(f'Headless starts {gui[0] / headless[0]:.1f}x faster and uses {(gui[1] - headless[1]) / 1024:.1f} MiB less.')
+
+
+if __name__ == '__main__':
+    main()
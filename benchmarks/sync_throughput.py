@@ -0,0 +1,161 @@
+import argparse
+import configparser
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.mock_disk_api import MockDiskApi
+from change_detector import detect_changes
+from tree_index import TreeIndex
+
+KIBIBYTE = 1024
+MEBIBYTE = 1024 * KIBIBYTE
+
+
+def draw_size(distribution: str, generator: random.Random) -> int:
+    # small: notes and sources, large: photos and archives, mixed: a home folder, mostly small with a long tail
+    if distribution == 'small':
+        return generator.randint(KIBIBYTE, 4 * KIBIBYTE)
+    if distribution == 'large':
+        return generator.randint(MEBIBYTE, 8 * MEBIBYTE)
+    return min(int(generator.lognormvariate(9.7, 1.8)), 64 * MEBIBYTE)
+
+
+def generate_folder(path: str, files_count: int, distribution: str, files_per_folder: int, seed: int) -> int:
+    # Files are spread over nested folders of files_per_folder entries, returns the total size
+    generator = random.Random(seed)
+    total_size = 0
+    for index in range(files_count):
+        folder_index = index // files_per_folder
+        folder = os.path.join(path, f'd{folder_index // files_per_folder:04d}', f'd{folder_index % files_per_folder:04d}')
+        if index % files_per_folder == 0:
+            os.makedirs(folder, exist_ok=True)
+        size = draw_size(distribution, generator)
+        with open(os.path.join(folder, f'f{index:07d}.bin'), 'wb') as file:
+            file.write(generator.randbytes(size))
+        total_size += size
+    return total_size
+
+
+def measure_scan(local_path: str, work_path: str, hash_workers: int) -> dict[str, float]:
+    tree_index = TreeIndex(os.path.join(work_path, 'scan_index.json'))
+    start = perf_counter()
+    local_stats = tree_index.scan(local_path)
+    cold_scan = perf_counter() - start
+    start = perf_counter()
+    tree_index.scan(local_path)
+    warm_scan = perf_counter() - start
+    start = perf_counter()
+    detect_changes(local_path, local_stats, {}, hash_workers)
+    hashing = perf_counter() - start
+    return {'cold_scan': cold_scan, 'warm_scan': warm_scan, 'hash': hashing}
+
+
+def write_config(work_path: str, local_path: str, api: MockDiskApi, arguments: argparse.Namespace):
+    parser = configparser.ConfigParser()
+    parser.read(os.path.join(ROOT, 'config.ini'))
+    parser['app_config'].update({
+        'local_path': local_path,
+        'api_base_url': api.api_base_url,
+        'remote_folder': 'benchmark',
+        'watch_mode': 'poll',
+        'workers': str(arguments.workers),
+        'api_rate': str(arguments.api_rate),
+        'bandwidth_limit': str(arguments.bandwidth_limit),
+        # The folder is generated right before the sync, its files would wait to settle
+        'settle_time': '0',
+        'pack_max_size': str(arguments.pack_max_size),
+        'pack_index_path': os.path.join(work_path, 'pack_index.json'),
+        'log_path': os.path.join(work_path, 'file_synch.log'),
+        'record_keeping_path': os.path.join(work_path, 'record_keeping_files.db'),
+        'tree_index_path': os.path.join(work_path, 'tree_index.json'),
+        'signatures_path': os.path.join(work_path, 'signatures'),
+    })
+    parser['api'] = {'token': 'benchmark'}
+    with open(os.path.join(work_path, 'config.ini'), 'w') as file:
+        parser.write(file)
+
+
+def run_sync_once(work_path: str) -> tuple[float, int]:
+    # One `python -m cli sync --once` in its own process, returns wall time and peak RSS in KiB
+    environment = {**os.environ, 'PYTHONPATH': ROOT}
+    start = perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'cli', 'sync', '--once', '--log-level', 'error'],
+        cwd=work_path, env=environment, stdout=subprocess.DEVNULL,
+    )
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = perf_counter() - start
+    if os.waitstatus_to_exitcode(status):
+        raise RuntimeError(f'Synchronization failed, see {work_path}/file_synch.log')
+    return elapsed, usage.ru_maxrss
+
+
+def run_case(files_count: int, distribution: str, arguments: argparse.Namespace):
+    work_path = tempfile.mkdtemp(prefix='file_synch_benchmark_')
+    local_path = os.path.join(work_path, 'local')
+    api = MockDiskApi(
+        latency=arguments.latency,
+        bandwidth=arguments.bandwidth,
+        api_error_rate=arguments.api_error_rate,
+        keep_content=False,
+        seed=arguments.seed,
+    ).start()
+    try:
+        start = perf_counter()
+        total_size = generate_folder(local_path, files_count, distribution, arguments.files_per_folder, arguments.seed)
+        generation = perf_counter() - start
+        scan = measure_scan(local_path, work_path, arguments.hash_workers)
+
+        write_config(work_path, local_path, api, arguments)
+        first_sync, first_rss = run_sync_once(work_path)
+        second_sync, second_rss = run_sync_once(work_path)
+        uploaded = api.stats.get('bytes_received', 0)
+
+        print(f'{files_count} files, {distribution}, {total_size / MEBIBYTE:.1f} MiB (generated in {generation:.1f} s)')
+        print(f'    scan: cold {scan["cold_scan"] * 1000:.0f} ms, warm {scan["warm_scan"] * 1000:.0f} ms, '
+              f'hashing {scan["hash"] * 1000:.0f} ms ({total_size / MEBIBYTE / max(scan["hash"], 1e-9):.0f} MiB/s)')
+        print(f'    first sync: {first_sync:.2f} s, {files_count / first_sync:.0f} files/s, '
+              f'{uploaded / MEBIBYTE / first_sync:.1f} MiB/s, peak RSS {first_rss / 1024:.0f} MiB')
+        print(f'    no-change sync: {second_sync:.2f} s, peak RSS {second_rss / 1024:.0f} MiB')
+        if api.stats.get('injected_errors'):
+            print(f'    injected errors: {api.stats["injected_errors"]}')
+    finally:
+        api.close()
+        if arguments.keep:
+            print(f'    kept in {work_path}')
+        else:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+
+def main():
+    arguments_parser = argparse.ArgumentParser(description='Scan and sync synthetic folders against the mock Disk API.')
+    arguments_parser.add_argument('--files', type=int, nargs='+', default=[1000], help='Files in a folder, one case per value.')
+    arguments_parser.add_argument('--distribution', choices=('small', 'mixed', 'large'), nargs='+', default=['small', 'mixed'])
+    arguments_parser.add_argument('--files-per-folder', type=int, default=100)
+    arguments_parser.add_argument('--workers', type=int, default=8)
+    arguments_parser.add_argument('--hash-workers', type=int, default=4)
+    arguments_parser.add_argument('--api-rate', type=float, default=0.0, help='Requests per second allowed by the client, 0 is unlimited.')
+    arguments_parser.add_argument('--bandwidth-limit', type=int, default=0, help='Bytes per second of all uploads of the client, 0 is unlimited.')
+    arguments_parser.add_argument('--pack-max-size', type=int, default=0, help='Pack files up to this size into bundles, 0 is off.')
+    arguments_parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every API request by the mock.')
+    arguments_parser.add_argument('--bandwidth', type=float, default=0.0, help='Bytes per second per connection, 0 is unlimited.')
+    arguments_parser.add_argument('--api-error-rate', type=float, default=0.0)
+    arguments_parser.add_argument('--seed', type=int, default=0)
+    arguments_parser.add_argument('--keep', action='store_true', help='Keep the generated folders.')
+    arguments = arguments_parser.parse_args()
+
+    for files_count in arguments.files:
+        for distribution in arguments.distribution:
+            run_case(files_count, distribution, arguments)
+
+
+if __name__ == '__main__':
+    main()
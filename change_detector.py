@@ -0,0 +1,70 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def stat_file(path: str) -> dict[str, int]:
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'inode': stat.st_ino}
+
+
+def same_stat(entry, stat: dict[str, int]) -> bool:
+    return (
+        isinstance(entry, dict)
+        and entry.get('size') == stat['size']
+        and entry.get('mtime_ns') == stat['mtime_ns']
+        and entry.get('inode') == stat['inode']
+    )
+
+
+def hash_file(path: str, chunk_size: int = HASH_CHUNK_SIZE) -> str:
+    # hashlib releases the GIL on large updates, so several files hash in parallel on threads
+    file_hash = hashlib.sha256()
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as file:
+        while read_count := file.readinto(buffer):
+            file_hash.update(view[:read_count])
+    return file_hash.hexdigest()
+
+
+def _hash_entry(path: str, stat: dict[str, int]):
+    try:
+        return {**stat, 'sha256': hash_file(path)}
+    except FileNotFoundError:
+        return None
+
+
+def detect_changes(local_path: str, local_stats: dict[str, dict[str, int]], record_keeping: dict, workers: int) -> dict[str, dict]:
+    # Only files whose (size, mtime_ns, inode) differs from record keeping are read,
+    # so a scan costs O(changed bytes) and not O(total bytes).
+    local_data = {}
+    to_hash = {}
+    for file_name, stat in local_stats.items():
+        entry = record_keeping.get(file_name)
+        if same_stat(entry, stat) and entry.get('sha256'):
+            local_data[file_name] = entry
+        else:
+            to_hash[file_name] = stat
+
+    if to_hash:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(to_hash)))) as executor:
+            futures = {
+                file_name: executor.submit(_hash_entry, os.path.join(local_path, file_name), stat)
+                for file_name, stat in to_hash.items()
+            }
+            for file_name, future in futures.items():
+                entry = future.result()
+                if entry is not None:
+                    local_data[file_name] = entry
+
+    return local_data
+
+
+def is_changed(entry, last_entry) -> bool:
+    # Record keeping written before hashing was introduced holds only the size
+    if isinstance(last_entry, int):
+        return entry['size'] != last_entry
+    return entry['sha256'] != last_entry.get('sha256')
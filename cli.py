@@ -0,0 +1,78 @@
+import argparse
+import json
+import logging
+import signal
+import sys
+from datetime import datetime
+from queue import Empty
+
+from app import mainloop
+from events import LogQueue, create_events_hash
+
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line, the thread name tells the sync pairs apart (pair-<name>)
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created).astimezone().isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging(level: str):
+    # The level applies to stdout only, the log file keeps receiving everything from info up
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter())
+    handler.setLevel(level.upper())
+    root_logger = logging.getLogger()
+    root_logger.addHandler(handler)
+    root_logger.setLevel(min(root_logger.getEffectiveLevel(), handler.level))
+
+
+def drain_queue(queue: LogQueue):
+    # Lines for the GUI are already in the log, without a reader they are dropped
+    while True:
+        try:
+            queue.get_nowait()
+        except Empty:
+            return
+
+
+def sync(once: bool) -> int:
+    queue = LogQueue()
+    queue.subscribe(lambda: drain_queue(queue))
+    events_hash = create_events_hash()
+
+    def request_exit(signal_number, _):
+        logging.getLogger('synchronizer').info(f'Received {signal.Signals(signal_number).name}, stopping current transfers.')
+        events_hash['exit_event'].set()
+        events_hash['wake_event'].set()
+
+    signal.signal(signal.SIGTERM, request_exit)
+    signal.signal(signal.SIGINT, request_exit)
+    succeeded = mainloop(queue, events_hash, once)
+    return 0 if succeeded else 1
+
+
+def main(arguments: list[str] = None) -> int:
+    arguments_parser = argparse.ArgumentParser(prog='python -m cli', description='File synchronizer without the GUI.')
+    commands = arguments_parser.add_subparsers(dest='command', required=True)
+    sync_parser = commands.add_parser('sync', help='Synchronize the folders of config.ini.')
+    mode = sync_parser.add_mutually_exclusive_group()
+    mode.add_argument('--once', action='store_true', help='Make one full pass and exit, status 1 if it failed.')
+    mode.add_argument('--daemon', action='store_true', help='Keep synchronizing until SIGTERM or SIGINT (default).')
+    sync_parser.add_argument('--log-level', choices=('debug', 'info', 'warning', 'error'), default='info')
+    arguments = arguments_parser.parse_args(arguments)
+
+    setup_logging(arguments.log_level)
+    return sync(arguments.once)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,80 @@
+import gzip
+import hashlib
+import multiprocessing
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+from typing import Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+COMPRESSION_BLOCK_SIZE = 4 * 1024 * 1024
+
+_pools: dict[int, ProcessPoolExecutor] = {}
+_pools_lock = Lock()
+
+
+def parse_extensions(extensions: str) -> set[str]:
+    return {extension.strip().lower().lstrip('.') for extension in extensions.split(',') if extension.strip()}
+
+
+def choose_codec(rel_path: str, size: int, codec: str, skip_extensions: set[str], min_size: int) -> Optional[str]:
+    # None means the file is sent as it is: compression is off, the file is small or already compressed
+    if codec == 'off' or size < min_size:
+        return None
+    extension = os.path.splitext(rel_path)[1].lower().lstrip('.')
+    if extension in skip_extensions:
+        return None
+    if codec == 'zstd' and zstandard is None:
+        # zstandard is an optional dependency, gzip is always there
+        return 'gzip'
+    return codec if codec in COMPRESSION_SUFFIXES else None
+
+
+def compress_block(codec: str, level: int, data: bytes) -> bytes:
+    # Every block is a complete gzip member or zstd frame, their concatenation is a valid
+    # .gz or .zst file, so blocks are compressed independently in separate processes
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def get_compression_pool(workers: int) -> ProcessPoolExecutor:
+    # Spawned, not forked: the synchronizer runs several threads and a forked child could inherit held locks
+    with _pools_lock:
+        if workers not in _pools:
+            _pools[workers] = ProcessPoolExecutor(max_workers=max(1, workers), mp_context=multiprocessing.get_context('spawn'))
+        return _pools[workers]
+
+
+def compress_file(path: str, codec: str, level: int, workers: int, block_size: int = COMPRESSION_BLOCK_SIZE) -> tuple[str, int, str]:
+    # Streams the file through the process pool block by block, at most two blocks per worker in flight,
+    # into a temporary file. Returns its path, size and sha256, the caller removes the file.
+    pool = get_compression_pool(workers)
+    compressed_hash = hashlib.sha256()
+    compressed_size = 0
+    descriptor, temporary_path = tempfile.mkstemp(prefix='file_synch_', suffix=COMPRESSION_SUFFIXES[codec])
+    try:
+        with open(path, 'rb') as source, os.fdopen(descriptor, 'wb') as target:
+            in_flight = deque()
+            while True:
+                block = source.read(block_size)
+                if block:
+                    in_flight.append(pool.submit(compress_block, codec, level, block))
+                if in_flight and (not block or len(in_flight) >= 2 * max(1, workers)):
+                    compressed = in_flight.popleft().result()
+                    compressed_hash.update(compressed)
+                    compressed_size += len(compressed)
+                    target.write(compressed)
+                elif not block:
+                    break
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+    return temporary_path, compressed_size, compressed_hash.hexdigest()
@@ -0,0 +1,233 @@
+import configparser
+import os
+from dataclasses import dataclass, fields, replace
+from threading import RLock
+from typing import Optional
+
+from record_keeping import RECORD_KEEPING_BACKENDS
+from scheduler import SCHEDULE_POLICIES
+
+MEGABYTE = 1024 * 1024
+DEFAULT_PAIR = 'default'
+PAIR_SECTION_PREFIX = 'pair:'
+# Options that belong to a sync pair and are not read from [app_config] sections
+PAIR_FIELDS = ('pair_name', 'pairs')
+WATCH_MODES = ('poll', 'inotify')
+SYNC_DIRECTIONS = ('push', 'both')
+# Options taking one of a few values, checked when config.ini is parsed
+FIELD_CHOICES = {
+    'watch_mode': WATCH_MODES,
+    'sync_direction': SYNC_DIRECTIONS,
+    'schedule_policy': SCHEDULE_POLICIES,
+    'record_keeping_backend': RECORD_KEEPING_BACKENDS,
+}
+
+
+@dataclass(frozen=True)
+class SyncPair:
+    # [pair:<name>] section, its options override [app_config] and [api] for this pair
+    name: str
+    values: tuple[tuple[str, object], ...] = ()
+
+
+@dataclass(frozen=True)
+class Config:
+    # Immutable snapshot of config.ini, defaults apply to options missing from older files
+    local_path: str = ''
+    interval: float = 5.0
+    watch_mode: str = 'poll'
+    debounce: float = 0.5
+    workers: int = 8
+    hash_workers: int = 4
+    pool_size: int = 8
+    keep_alive: bool = True
+    request_timeout: float = 60.0
+    api_base_url: str = 'https://cloud-api.yandex.net/v1/disk/'
+    api_rate: float = 10.0
+    api_burst: int = 10
+    api_retries: int = 5
+    breaker_threshold: int = 5
+    breaker_reset: float = 30.0
+    upload_chunk_size: int = MEGABYTE
+    upload_retries: int = 5
+    # Bytes per second of all uploads together, 0 is unlimited. Windows of bandwidth_schedule override it,
+    # e.g. "mon-fri 09:00-18:00 1048576, 22:00-06:00 0", the first matching one wins. Both are global,
+    # read from [app_config] only, and edits of config.ini apply to running uploads within a few seconds.
+    bandwidth_limit: int = 0
+    bandwidth_schedule: str = ''
+    progress_interval: float = 5.0
+    log_path: str = './file_synch.log'
+    record_keeping_backend: str = 'sqlite'
+    record_keeping_path: str = './record_keeping_files.db'
+    tree_index_path: str = './tree_index.json'
+    # Intents of the sync tasks in flight, replayed after a crash, empty turns it off
+    journal_path: str = './sync_journal.jsonl'
+    full_rescan_every: int = 12
+    reconcile_every: int = 100
+    sync_direction: str = 'push'
+    remote_poll_interval: float = 60.0
+    schedule_policy: str = 'size'
+    schedule_patterns: str = ''
+    large_file_size: int = 256 * MEGABYTE
+    large_file_workers: int = 1
+    listing_page_size: int = 1000
+    # Changed files younger than settle_time seconds wait until they stop changing, 0 uploads them right away.
+    # snapshot_mode reflink uploads a copy-on-write clone where the filesystem supports it.
+    settle_time: float = 2.0
+    snapshot_mode: str = 'off'
+    operation_poll_interval: float = 2.0
+    signatures_path: str = './signatures'
+    delta_mode: str = 'report'
+    delta_min_size: int = 64 * MEGABYTE
+    delta_block_size: int = 4 * MEGABYTE
+    compression: str = 'off'
+    compression_level: int = 6
+    compression_min_size: int = 4096
+    compression_workers: int = 2
+    compression_skip_extensions: str = (
+        'gz,zst,zip,7z,rar,xz,bz2,jpg,jpeg,png,gif,webp,heic,mp3,mp4,mkv,avi,mov,ogg,flac,pdf,docx,xlsx,pptx'
+    )
+    # Files up to pack_max_size are packed into tar bundles of about bundle_size when pushing, 0 turns it off
+    pack_max_size: int = 0
+    bundle_size: int = 16 * MEGABYTE
+    bundle_compaction_ratio: float = 0.5
+    pack_index_path: str = './pack_index.json'
+    # 0 and empty paths turn the exporter and the profiler off
+    metrics_port: int = 0
+    metrics_path: str = ''
+    metrics_interval: float = 15.0
+    profile_path: str = ''
+    remote_folder: str = ''
+    token: str = ''
+    pair_name: str = DEFAULT_PAIR
+    pairs: tuple[SyncPair, ...] = ()
+
+    @property
+    def local_folder_name(self) -> str:
+        # Remote folder in the disk root, named after the local folder unless set explicitly
+        return self.remote_folder.strip('/') or self.local_path.split('/')[-1]
+
+    @property
+    def pair_names(self) -> list[str]:
+        # The pair of [app_config] is kept while it has a folder or while it is the only one, the GUI edits it
+        names = [pair.name for pair in self.pairs]
+        if self.local_path or not names:
+            names.insert(0, DEFAULT_PAIR)
+        return names
+
+    def pair_config(self, pair_name: str) -> Optional['Config']:
+        if pair_name == DEFAULT_PAIR:
+            return self
+        pair = next((pair for pair in self.pairs if pair.name == pair_name), None)
+        if pair is None:
+            return None
+        # Per pair state files sit next to the default ones with the pair name in between
+        derived = {
+            'record_keeping_path': _pair_path(self.record_keeping_path, pair_name),
+            'tree_index_path': _pair_path(self.tree_index_path, pair_name),
+            'journal_path': _pair_path(self.journal_path, pair_name) if self.journal_path else '',
+            'signatures_path': f'{self.signatures_path}.{pair_name}',
+            'pack_index_path': _pair_path(self.pack_index_path, pair_name),
+            'profile_path': _pair_path(self.profile_path, pair_name) if self.profile_path else '',
+            'remote_folder': '',
+        }
+        return replace(self, pair_name=pair_name, pairs=(), **{**derived, **dict(pair.values)})
+
+    @classmethod
+    def from_parser(cls, parser: configparser.ConfigParser) -> 'Config':
+        values = {}
+        for field in fields(cls):
+            if field.name in PAIR_FIELDS:
+                continue
+            section = 'api' if field.name == 'token' else 'app_config'
+            if parser.has_option(section, field.name):
+                values[field.name] = _get_typed(parser, section, field)
+        pairs = []
+        for section in parser.sections():
+            if section.startswith(PAIR_SECTION_PREFIX):
+                pair_values = tuple(
+                    (field.name, _get_typed(parser, section, field))
+                    for field in fields(cls)
+                    if field.name not in PAIR_FIELDS and parser.has_option(section, field.name)
+                )
+                pairs.append(SyncPair(section[len(PAIR_SECTION_PREFIX):], pair_values))
+        return cls(**values, pairs=tuple(pairs))
+
+
+def _get_typed(parser: configparser.ConfigParser, section: str, field):
+    value = parser.get(section, field.name)
+    try:
+        if field.type is bool:
+            return parser.getboolean(section, field.name)
+        if field.type is int:
+            return parser.getint(section, field.name)
+        if field.type is float:
+            return parser.getfloat(section, field.name)
+    except ValueError:
+        raise ValueError(f'Wrong {field.name} "{value}" in [{section}], {field.type.__name__} expected.') from None
+    choices = FIELD_CHOICES.get(field.name)
+    if choices is not None and value not in choices:
+        raise ValueError(f'Wrong {field.name} "{value}" in [{section}], use {", ".join(choices)}.')
+    return value
+
+
+def _pair_path(path: str, pair_name: str) -> str:
+    stem, extension = os.path.splitext(path)
+    return f'{stem}.{pair_name}{extension}'
+
+
+class ConfigStore:
+    # Parses config.ini on first use and again only when its mtime changes or reload() is called,
+    # readers take `current`, a snapshot that never changes under them.
+    def __init__(self, path: str):
+        self._path = path
+        self._lock = RLock()
+        self._mtime_ns = None
+        self._overrides = {}
+        self._current: Optional[Config] = None
+        self._error: Optional[str] = None
+
+    @property
+    def current(self) -> Config:
+        if self._current is None:
+            return self.reload()
+        return self._current
+
+    def _read_mtime_ns(self):
+        try:
+            return os.stat(self._path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def reload(self) -> Config:
+        with self._lock:
+            parser = configparser.ConfigParser()
+            parser.read(self._path)
+            self._mtime_ns = self._read_mtime_ns()
+            self._current = replace(Config.from_parser(parser), **self._overrides)
+            return self._current
+
+    def refresh(self, force: bool = False) -> Config:
+        # A wrong value saved while running keeps the last good snapshot, the error is taken by pop_error().
+        # Only the first parse raises ValueError.
+        if self._current is None or force or self._read_mtime_ns() != self._mtime_ns:
+            with self._lock:
+                try:
+                    return self.reload()
+                except ValueError as e:
+                    if self._current is None:
+                        raise
+                    self._error = f'Configuration error, the previous settings are kept. {e}'
+        return self.current
+
+    def pop_error(self) -> Optional[str]:
+        with self._lock:
+            error, self._error = self._error, None
+            return error
+
+    def override(self, **values) -> Config:
+        # Values set from code win over the file, used by benchmarks and command line options
+        with self._lock:
+            self._overrides.update(values)
+            self._current = replace(self.current, **values)
+            return self._current
@@ -0,0 +1,204 @@
+import hashlib
+import json
+import os
+import zlib
+from threading import Condition, Lock
+from typing import Optional
+
+DELTA_BLOCK_SIZE = 4 * 1024 * 1024
+CHUNKS_FOLDER = '.chunks'
+MANIFEST_SUFFIX = '.manifest'
+
+
+def compute_signature(path: str, block_size: int = DELTA_BLOCK_SIZE) -> list[list]:
+    # Block signature is [adler32, sha256, length] for every block_size piece of the file
+    signature = []
+    with open(path, 'rb', buffering=0) as file:
+        while block := file.read(block_size):
+            signature.append([zlib.adler32(block), hashlib.sha256(block).hexdigest(), len(block)])
+    return signature
+
+
+def diff_signatures(new_signature: list[list], old_signature: list[list]) -> tuple[list[int], int]:
+    # Weak checksum filters candidates, strong one confirms them, so blocks that moved to another
+    # aligned offset still count as unchanged. Returns indexes of new blocks and their byte volume.
+    old_blocks = {}
+    for weak, strong, _ in old_signature:
+        old_blocks.setdefault(weak, set()).add(strong)
+    changed_blocks = []
+    changed_bytes = 0
+    for index, (weak, strong, length) in enumerate(new_signature):
+        if strong not in old_blocks.get(weak, ()):
+            changed_blocks.append(index)
+            changed_bytes += length
+    return changed_blocks, changed_bytes
+
+
+def chunk_rel_path(strong: str) -> str:
+    return f'{CHUNKS_FOLDER}/{strong}'
+
+
+def build_manifest(signature: list[list], size: int, block_size: int) -> bytes:
+    return json.dumps({
+        'size': size,
+        'block_size': block_size,
+        'chunks': [strong for _, strong, _ in signature],
+    }).encode()
+
+
+class SignatureStore:
+    # Signatures live next to the record keeping, one small file per synchronized file, plus the set
+    # of chunk objects already present on the remote storage and the chunks the manifest of every
+    # chunked file references. Uploaded chunks no manifest references are garbage, see take_garbage.
+    def __init__(self, folder: str):
+        self._folder = folder
+        self._lock = Lock()
+        self._chunks_collected = Condition(self._lock)
+        self._uploaded_chunks: Optional[set[str]] = None
+        # Signature key -> chunks of the manifest stored for the file
+        self._chunk_refs: Optional[dict[str, list[str]]] = None
+        # Chunks of the manifests being uploaded by rel_path and the chunks being deleted, never the same ones
+        self._pending_chunks: dict[str, set[str]] = {}
+        self._collecting_chunks: set[str] = set()
+        # Set when references were dropped, the first sweep after start looks for garbage too
+        self._garbage_possible = True
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def _key(rel_path: str) -> str:
+        return hashlib.sha1(rel_path.encode()).hexdigest()
+
+    @staticmethod
+    def _dump(path: str, data):
+        with open(path + '.tmp', 'w') as file:
+            json.dump(data, file)
+        os.replace(path + '.tmp', path)
+
+    def _signature_path(self, rel_path: str) -> str:
+        return os.path.join(self._folder, self._key(rel_path) + '.json')
+
+    def load(self, rel_path: str) -> Optional[list[list]]:
+        try:
+            with open(self._signature_path(rel_path), 'r') as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, rel_path: str, signature: list[list]):
+        self._dump(self._signature_path(rel_path), signature)
+
+    def remove(self, rel_path: str):
+        # The remote file is gone, its manifest with it
+        try:
+            os.remove(self._signature_path(rel_path))
+        except FileNotFoundError:
+            pass
+        self.release_chunks(rel_path)
+
+    def _chunks_path(self) -> str:
+        return os.path.join(self._folder, 'uploaded_chunks.json')
+
+    def _load_uploaded_chunks(self) -> set[str]:
+        if self._uploaded_chunks is None:
+            try:
+                with open(self._chunks_path(), 'r') as file:
+                    self._uploaded_chunks = set(json.load(file))
+            except (FileNotFoundError, ValueError):
+                self._uploaded_chunks = set()
+        return self._uploaded_chunks
+
+    def is_chunk_uploaded(self, strong: str) -> bool:
+        with self._lock:
+            return strong in self._load_uploaded_chunks()
+
+    def add_uploaded_chunks(self, strongs: set[str]):
+        with self._lock:
+            uploaded_chunks = self._load_uploaded_chunks()
+            uploaded_chunks |= strongs
+            self._dump(self._chunks_path(), sorted(uploaded_chunks))
+
+    def _refs_path(self) -> str:
+        return os.path.join(self._folder, 'chunk_refs.json')
+
+    def _load_chunk_refs(self) -> dict[str, list[str]]:
+        if self._chunk_refs is None:
+            try:
+                with open(self._refs_path(), 'r') as file:
+                    self._chunk_refs = json.load(file)
+            except (FileNotFoundError, ValueError):
+                self._chunk_refs = {}
+                if self._load_uploaded_chunks():
+                    # Chunks uploaded before references were kept: every saved signature counts as a manifest,
+                    # chunks of files stored whole are kept until those files change
+                    for name in os.listdir(self._folder):
+                        key, extension = os.path.splitext(name)
+                        if extension != '.json' or len(key) != 40:
+                            continue
+                        try:
+                            with open(os.path.join(self._folder, name), 'r') as file:
+                                self._chunk_refs[key] = [strong for _, strong, _ in json.load(file)]
+                        except (FileNotFoundError, ValueError):
+                            pass
+                    self._dump(self._refs_path(), self._chunk_refs)
+        return self._chunk_refs
+
+    def _set_chunk_refs(self, rel_path: str, strongs: Optional[list[str]]):
+        chunk_refs = self._load_chunk_refs()
+        previous = chunk_refs.pop(self._key(rel_path), None)
+        if strongs:
+            chunk_refs[self._key(rel_path)] = strongs
+        if previous is not None or strongs:
+            self._dump(self._refs_path(), chunk_refs)
+        if previous:
+            self._garbage_possible = True
+
+    def begin_chunks(self, rel_path: str, strongs: set[str]):
+        # Called before a chunked upload looks for stored chunks, chunks being deleted are waited for
+        with self._lock:
+            self._chunks_collected.wait_for(lambda: not strongs & self._collecting_chunks)
+            self._pending_chunks[rel_path] = strongs
+
+    def end_chunks(self, rel_path: str, stored: bool):
+        # stored tells whether the manifest of the upload was written, it references its chunks from now on
+        with self._lock:
+            strongs = self._pending_chunks.pop(rel_path, set())
+            if stored:
+                self._set_chunk_refs(rel_path, sorted(strongs))
+            else:
+                # Chunks sent for a manifest that was never written
+                self._garbage_possible = True
+
+    def release_chunks(self, rel_path: str):
+        # The file is not stored chunked any more
+        with self._lock:
+            self._set_chunk_refs(rel_path, None)
+
+    def take_garbage(self) -> list[str]:
+        # Uploaded chunks no manifest references. They count as not uploaded from now on, a crash leaves
+        # them on the remote storage, not in a manifest. Every call is followed by finish_garbage.
+        with self._lock:
+            if not self._garbage_possible:
+                return []
+            self._garbage_possible = False
+            uploaded_chunks = self._load_uploaded_chunks()
+            if not uploaded_chunks:
+                return []
+            referenced = set().union(*self._load_chunk_refs().values(), *self._pending_chunks.values())
+            garbage = uploaded_chunks - referenced - self._collecting_chunks
+            if garbage:
+                uploaded_chunks -= garbage
+                self._collecting_chunks |= garbage
+                self._dump(self._chunks_path(), sorted(uploaded_chunks))
+            return sorted(garbage)
+
+    def finish_garbage(self, strongs: list[str], deleted: set[str]):
+        # Chunks that were not deleted stay uploaded and are collected by a later sweep
+        with self._lock:
+            self._collecting_chunks.difference_update(strongs)
+            kept = set(strongs) - deleted
+            if kept:
+                uploaded_chunks = self._load_uploaded_chunks()
+                uploaded_chunks |= kept
+                self._dump(self._chunks_path(), sorted(uploaded_chunks))
+                self._garbage_possible = True
+            self._chunks_collected.notify_all()
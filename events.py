@@ -0,0 +1,30 @@
+from queue import Queue
+from threading import Event
+
+
+# Shared by the synchronizer and the GUI, kept apart from app so the GUI starts without loading it
+
+
+class LogQueue(Queue):
+    # Queue that tells subscribers about every new line, so readers wait instead of polling
+    def __init__(self):
+        super().__init__()
+        self._subscribers = []
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def put(self, item, block=True, timeout=None):
+        super().put(item, block, timeout)
+        for callback in self._subscribers:
+            callback()
+
+
+def create_events_hash() -> dict[str, Event]:
+    return {
+        'token_set_event': Event(),
+        'interval_set_event': Event(),
+        'local_folder_set_event': Event(),
+        'exit_event': Event(),
+        'wake_event': Event(),
+    }
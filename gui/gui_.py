@@ -1,59 +1,83 @@
 import os.path
 import re
 import tkinter.filedialog
-import pygame
 import configparser
 from queue import Queue
-from threading import Event
-from pygame import mixer
+from threading import Event, Thread
 from time import sleep
 from tkinter import Label, Entry, LabelFrame, Button, Tk, WORD, END, BOTH, Y, LEFT, RIGHT
 from tkinter.scrolledtext import ScrolledText
 from tkinter.messagebox import askokcancel
 
+# The log is drained by the Tk loop at this period when new lines were queued
+LOG_POLL_INTERVAL_MS = 100
+
 
 class _Sounds:
+    # pygame and the sound files are loaded by a background thread, so the window shows up without
+    # waiting for them. A sound played before they are ready is skipped, the login one is played as soon as they are.
+    _FILES = {
+        'login': 'gui_login1.ogg',
+        'pointing': 'gui_scroll1.ogg',
+        'select': 'gui_popup_select1.ogg',
+        'success': 'gui_button_on1.ogg',
+        'error': 'gui_button_ok1.ogg',
+        'logout': 'gui_logout1.ogg',
+        'accept': 'gui_popup_open1.ogg',
+    }
+
     def __init__(self):
-        self.pygame = pygame
-        self.pygame.init()
-        self._mixer = mixer
+        self.pygame = None
         self._sounds_folder = os.path.abspath('gui')
+        self._sounds = {}
+        self._loaded_event = Event()
+        Thread(target=self._load, name='gui-sounds', daemon=True).start()
+
+    def _load(self):
+        import pygame
+        from pygame import mixer
+
+        # Only the mixer, the screen size is taken from Tk
+        mixer.init()
+        self._sounds = {
+            name: mixer.Sound(os.path.join(self._sounds_folder, file_name)) for name, file_name in self._FILES.items()
+        }
+        self.pygame = pygame
+        self._loaded_event.set()
+        self._sounds['login'].play()
 
-        self._login_sound = self._mixer.Sound(os.path.join(self._sounds_folder, 'gui_login1.ogg'))
-        self._pointing_sound = self._mixer.Sound(os.path.join(self._sounds_folder, 'gui_scroll1.ogg'))
-        self._select_sound = self._mixer.Sound(os.path.join(self._sounds_folder, 'gui_popup_select1.ogg'))
-        self._success_sound = self._mixer.Sound(os.path.join(self._sounds_folder, 'gui_button_on1.ogg'))
-        self._error_sound = self._mixer.Sound(os.path.join(self._sounds_folder, 'gui_button_ok1.ogg'))
-        self._logout_sound = self._mixer.Sound(os.path.join(self._sounds_folder, 'gui_logout1.ogg'))
-        self._accept_sound = self._mixer.Sound(os.path.join(self._sounds_folder, 'gui_popup_open1.ogg'))
-
-    def login_sound(self):
-        self._login_sound.play()
+    def _play(self, name):
+        if self._loaded_event.is_set():
+            self._sounds[name].play()
 
     def pointing_sound(self, _=None):
-        self._pointing_sound.play()
+        self._play('pointing')
 
     def select_sound(self):
-        self._select_sound.play()
+        self._play('select')
 
     def success_sound(self):
-        self._select_sound.play()
+        self._play('select')
 
     def error_sound(self):
-        self._error_sound.play()
+        self._play('error')
 
     def accept_sound(self):
-        self._accept_sound.play()
+        self._play('accept')
 
     def logout_sound(self):
-        self._logout_sound.play()
+        self._play('logout')
+
+    def quit(self):
+        if self._loaded_event.is_set():
+            self.pygame.quit()
 
 
 class _MainFrames:
     def __init__(self):
         self.main_frame = Tk()
-        self.horizontal = str(pygame.display.Info().current_h)
-        self.vertical = str(pygame.display.Info().current_w)
+        self.horizontal = str(self.main_frame.winfo_screenheight())
+        self.vertical = str(self.main_frame.winfo_screenwidth())
         self.main_frame.geometry(self.vertical + 'x' + self.horizontal)
         self.main_frame.attributes('-fullscreen', True)
         self.main_frame.configure(bg='black')
@@ -146,6 +170,10 @@ class _Commands:
         self._main_frames.main_frame.protocol("WM_DELETE_WINDOW", self.exit)
         self._parser = configparser.ConfigParser()
 
+    def _notify(self, event_name):
+        self._events_hash[event_name].set()
+        self._events_hash['wake_event'].set()
+
     def swap_widgets(self, widget_to_pack_forget, widgets_to_pack):
         for widget in widget_to_pack_forget:
             widget.pack_forget()
@@ -169,7 +197,7 @@ class _Commands:
         elif os.path.exists(new_directory) and os.path.isdir(new_directory):
             old_value = self.update_config('app_config', 'local_path', new_directory)
             self._sounds.accept_sound()
-            self._events_hash['local_folder_set_event'].set()
+            self._notify('local_folder_set_event')
             self._labels.label_info_change_message('green',
                                                    f'Local path has been changed\n'
                                                    f'FROM {old_value}\n'
@@ -190,7 +218,7 @@ class _Commands:
             self._sounds.accept_sound()
             self._labels.label_info_change_message('green',
                                                    f'Interval has been changed from {old_value} to {new_value}')
-            self._events_hash['interval_set_event'].set()
+            self._notify('interval_set_event')
         except ValueError as e:
             self._sounds.error_sound()
             self._labels.label_info_change_message('red', f'Incorrect interval.\n{e}')
@@ -200,7 +228,7 @@ class _Commands:
         if askokcancel('Warning', 'Token serves for connection to disk api.'):
             self.update_config('api', 'token', new_value)
             self._sounds.accept_sound()
-            self._events_hash['token_set_event'].set()
+            self._notify('token_set_event')
             self._labels.label_info_change_message('green', f'Token has been changed')
         else:
             self._sounds.error_sound()
@@ -212,9 +240,9 @@ class _Commands:
         self._labels.label_info_change_message('white', 'Session termination')
         self._labels.label_info_main_frame_widget.update()
         self._sounds.logout_sound()
-        self._events_hash['exit_event'].set()
+        self._notify('exit_event')
         sleep(2)
-        self._sounds.pygame.quit()
+        self._sounds.quit()
         self._main_frames.main_frame.destroy()
 
     def update_config(self, section, key, new_value):
@@ -425,9 +453,11 @@ class Gui:
         self._labels.label_info_change_message('white', 'Main menu')
 
         self._commands.update_current_configuration()
-        self._sounds.login_sound()
 
-        self._main_frames.main_frame.after(1, self._refresh_log),
+        self._log_appended = Event()
+        self._queue.subscribe(self._log_appended.set)
+        self._refresh_log()
+        self._main_frames.main_frame.after(LOG_POLL_INTERVAL_MS, self._poll_log)
         self._main_frames.main_frame.mainloop()
 
     def _create_menu_window(self):
@@ -456,28 +486,31 @@ class Gui:
             self._texts.text_log_main_frame_widget.tag_add(word, start_index, end_index)
             self._texts.text_log_main_frame_widget.tag_configure(word, foreground=color)
 
+    def _poll_log(self):
+        # Logging threads only set the event, calls into Tk from them would wait for this loop
+        if self._log_appended.is_set():
+            self._log_appended.clear()
+            self._refresh_log()
+        self._main_frames.main_frame.after(LOG_POLL_INTERVAL_MS, self._poll_log)
+
     def _refresh_log(self):
-        try:
-            while not self._queue.empty():
-                log = self._queue.get()
-
-                self._texts.text_log_main_frame_widget.configure(state='normal')
-                self._texts.text_log_main_frame_widget.insert(END, log.rstrip() + '\n')
-                self._texts.text_log_main_frame_widget.configure(state='disabled')
-
-                self._colorize_word_in_last_line('Detected', '#b8860b')
-                self._colorize_word_in_last_line('Deleting', 'green')
-                self._colorize_word_in_last_line('Overwriting', 'green')
-                self._colorize_word_in_last_line('Writing', 'green')
-                self._colorize_word_in_last_line('Updating', 'green')
-                self._colorize_word_in_last_line('updated', 'green')
-                self._colorize_word_in_last_line('successfully', 'green')
-                self._colorize_word_in_last_line('unsuccessfully', 'red')
-                self._colorize_word_in_last_line('Initialize', 'green')
-                self._colorize_word_in_last_line('Initializing', 'green')
-                self._colorize_word_in_last_line('start', 'green')
-
-            self._texts.text_log_main_frame_widget.update_idletasks()
-            self._main_frames.main_frame.after(1, self._refresh_log)
-        except RecursionError:
-            self._main_frames.main_frame.after(1, self._refresh_log)
+        while not self._queue.empty():
+            log = self._queue.get()
+
+            self._texts.text_log_main_frame_widget.configure(state='normal')
+            self._texts.text_log_main_frame_widget.insert(END, log.rstrip() + '\n')
+            self._texts.text_log_main_frame_widget.configure(state='disabled')
+
+            self._colorize_word_in_last_line('Detected', '#b8860b')
+            self._colorize_word_in_last_line('Deleting', 'green')
+            self._colorize_word_in_last_line('Overwriting', 'green')
+            self._colorize_word_in_last_line('Writing', 'green')
+            self._colorize_word_in_last_line('Updating', 'green')
+            self._colorize_word_in_last_line('updated', 'green')
+            self._colorize_word_in_last_line('successfully', 'green')
+            self._colorize_word_in_last_line('unsuccessfully', 'red')
+            self._colorize_word_in_last_line('Initialize', 'green')
+            self._colorize_word_in_last_line('Initializing', 'green')
+            self._colorize_word_in_last_line('start', 'green')
+
+        self._texts.text_log_main_frame_widget.update_idletasks()
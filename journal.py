@@ -0,0 +1,87 @@
+import json
+import os
+from threading import Lock
+from typing import Optional
+
+
+class IntentJournal:
+    # Write-ahead journal of the sync tasks of one pair, one JSON object per line. An intent line is appended
+    # before a task starts, a done line with the record keeping changes it made once its result is recorded.
+    # Record keeping is committed at the end of a pass: after a crash the done lines bring back what finished,
+    # the intents left open are the operations to verify. Every commit checkpoints the journal down to the
+    # operations still in flight. Lines are flushed but not synced, the journal outlives the process, and a
+    # tail lost with a power failure only means its files are checked again.
+    def __init__(self, path: str):
+        self._path = path
+        self._lock = Lock()
+        self._file = None
+        # rel_path -> intent line of the operation in flight, a later intent for the same path replaces it
+        self._open: dict[str, dict] = {}
+        self._dirty = False
+
+    def read(self) -> tuple[list[dict[str, Optional[dict]]], list[dict]]:
+        # Changes of the finished operations in the order they were made and the intents left open by the last run
+        try:
+            with open(self._path, 'r') as file:
+                lines = file.readlines()
+        except FileNotFoundError:
+            return [], []
+        # Dropped by the next checkpoint, the caller records what it needs first
+        self._dirty = bool(lines)
+        changes = []
+        intents = {}
+        for line in lines:
+            try:
+                item = json.loads(line)
+            except ValueError:
+                # The line the crash cut short
+                continue
+            if 'intent' in item:
+                intents[item['path']] = item
+            else:
+                if item['done'] is not None:
+                    intents.pop(item['done'], None)
+                changes.append(item['changes'])
+        return changes, list(intents.values())
+
+    def _append(self, item: dict):
+        if self._file is None:
+            self._file = open(self._path, 'a')
+        self._file.write(json.dumps(item) + '\n')
+        self._file.flush()
+        self._dirty = True
+
+    def begin(self, task: str, rel_path: str, entry):
+        # entry is the one the task records when it succeeds, with the size and hash of the file for transfers
+        with self._lock:
+            item = {'intent': task, 'path': rel_path, 'entry': entry}
+            self._open[rel_path] = item
+            self._append(item)
+
+    def done(self, rel_path: Optional[str], changes: dict[str, Optional[dict]]):
+        # changes is rel_path -> entry, None for a removal. rel_path None records changes without an intent.
+        with self._lock:
+            if rel_path is not None and self._open.pop(rel_path, None) is None and not changes:
+                return
+            self._append({'done': rel_path, 'changes': changes})
+
+    def checkpoint(self):
+        # Called once record keeping is committed, the journal keeps only the operations in flight
+        with self._lock:
+            if not self._dirty:
+                return
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            temporary_path = self._path + '.tmp'
+            with open(temporary_path, 'w') as file:
+                for item in self._open.values():
+                    file.write(json.dumps(item) + '\n')
+            os.replace(temporary_path, self._path)
+            self._dirty = False
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -1,22 +1,29 @@
-from app import mainloop
-from gui.gui_ import Gui
-from threading import Thread, Event
-from queue import Queue
+from events import LogQueue, create_events_hash
+from threading import Thread
+
+
+def run_synchronizer(queue: LogQueue, events_hash):
+    # Imported here, requests and the rest of the synchronizer load while tkinter does
+    from app import mainloop
+
+    mainloop(queue, events_hash)
+
+
+def run_gui(queue: LogQueue, events_hash):
+    # Imported here, the synchronizer starts its first scan while tkinter is loading
+    from gui.gui_ import Gui
+
+    Gui(queue, events_hash)
 
 
 def launch_app():
-    queue = Queue()
-    events_hash = {
-        'token_set_event': Event(),
-        'interval_set_event': Event(),
-        'local_folder_set_event': Event(),
-        'exit_event': Event(),
-    }
-
-    gui_thread = Thread(target=lambda: Gui(queue, events_hash))
-    synch_thread = Thread(target=lambda: mainloop(queue, events_hash))
-    gui_thread.start()
+    queue = LogQueue()
+    events_hash = create_events_hash()
+
+    synch_thread = Thread(target=lambda: run_synchronizer(queue, events_hash))
+    gui_thread = Thread(target=lambda: run_gui(queue, events_hash))
     synch_thread.start()
+    gui_thread.start()
 
 
 if __name__ == '__main__':
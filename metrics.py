@@ -0,0 +1,232 @@
+import json
+import os
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Lock, Thread
+from time import perf_counter
+from typing import Callable
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DURATION_BUCKETS = (0.001, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+THROUGHPUT_BUCKETS = (0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0, 200.0, 500.0)
+
+# Kind and help line of every metric, names follow the Prometheus conventions
+METRICS = {
+    'file_synch_pass_phase_duration_seconds': ('histogram', 'Time spent in each phase of a sync pass.'),
+    'file_synch_scan_files': ('gauge', 'Files found by the last scan of the local folder.'),
+    'file_synch_scan_bytes': ('gauge', 'Bytes in the files found by the last scan of the local folder.'),
+    'file_synch_changes_detected_total': ('counter', 'Planned sync actions by kind.'),
+    'file_synch_changes_detected_bytes_total': ('counter', 'Bytes in the files of the planned sync actions.'),
+    'file_synch_task_duration_seconds': ('histogram', 'Time to run one sync task, transfers included.'),
+    'file_synch_api_request_duration_seconds': ('histogram', 'Latency of one Disk API request by Synchronizer method.'),
+    'file_synch_api_responses_total': ('counter', 'Disk API responses by Synchronizer method and status code.'),
+    'file_synch_api_retries_total': ('counter', 'Disk API requests retried by the request executor.'),
+    'file_synch_api_rate': ('gauge', 'Current Disk API request rate allowed by the rate limiter.'),
+    'file_synch_http_connections_total': ('counter', 'HTTP requests by session, sent over a new or a reused connection.'),
+    'file_synch_transfer_bytes_total': ('counter', 'Bytes sent to or received from the storage.'),
+    'file_synch_transfer_throughput_megabytes': ('histogram', 'Throughput of one upload or download attempt, MB/s.'),
+    'file_synch_transfer_retries_total': ('counter', 'Uploads and downloads attempted again after an error.'),
+    'file_synch_upload_bandwidth_bytes': ('gauge', 'Bytes per second allowed to all uploads now, 0 is unlimited.'),
+    'file_synch_queue_depth': ('gauge', 'Tasks waiting or running in the worker queues.'),
+}
+
+
+def _labels_key(labels: dict) -> tuple:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_number(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Histogram:
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list[tuple[str, int]]:
+        running = 0
+        result = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            running += count
+            result.append(('+Inf' if bound == float('inf') else _format_number(bound), running))
+        return result
+
+
+class Metrics:
+    # Counters, gauges and histograms of the sync pipeline, kept in memory and read by the endpoint or the dump.
+    # Values that are cheap to read on demand, like queue depths, come from collectors called on every read.
+    def __init__(self):
+        self._lock = Lock()
+        self._values: dict[str, dict[tuple, float]] = {}
+        self._histograms: dict[str, dict[tuple, _Histogram]] = {}
+        self._collectors: dict[str, Callable[[], list[tuple[str, dict, float]]]] = {}
+
+    def increment(self, name: str, value: float = 1.0, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            values = self._values.setdefault(name, {})
+            values[key] = values.get(key, 0.0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self._values.setdefault(name, {})[_labels_key(labels)] = value
+
+    def observe(self, name: str, value: float, buckets: tuple[float, ...] = LATENCY_BUCKETS, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            histograms = self._histograms.setdefault(name, {})
+            if key not in histograms:
+                histograms[key] = _Histogram(buckets)
+            histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, buckets: tuple[float, ...] = DURATION_BUCKETS, **labels):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, buckets, **labels)
+
+    def register_collector(self, key: str, collect: Callable[[], list[tuple[str, dict, float]]]):
+        # collect() returns (name, labels, value) of gauges, a collector registered again under the same key is replaced
+        with self._lock:
+            self._collectors[key] = collect
+
+    def unregister_collector(self, key: str):
+        with self._lock:
+            self._collectors.pop(key, None)
+
+    def _collect(self) -> tuple[dict[str, dict[tuple, float]], dict[str, dict[tuple, _Histogram]]]:
+        with self._lock:
+            values = {name: dict(samples) for name, samples in self._values.items()}
+            histograms = {
+                name: {key: (histogram.cumulative(), histogram.sum, histogram.count) for key, histogram in samples.items()}
+                for name, samples in self._histograms.items()
+            }
+            collectors = list(self._collectors.values())
+        for collect in collectors:
+            for name, labels, value in collect():
+                values.setdefault(name, {})[_labels_key(labels)] = value
+        return values, histograms
+
+    def to_prometheus(self) -> str:
+        values, histograms = self._collect()
+        lines = []
+        for name in sorted(set(values) | set(histograms)):
+            kind, description = METRICS.get(name, ('untyped', ''))
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}']
+            for key, value in sorted(values.get(name, {}).items()):
+                lines.append(f'{name}{_format_labels(key)} {_format_number(value)}')
+            for key, (buckets, total, count) in sorted(histograms.get(name, {}).items()):
+                for bound, cumulative_count in buckets:
+                    lines.append(f'{name}_bucket{_format_labels(key, (("le", bound),))} {cumulative_count}')
+                lines.append(f'{name}_sum{_format_labels(key)} {_format_number(total)}')
+                lines.append(f'{name}_count{_format_labels(key)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def to_json(self) -> dict:
+        values, histograms = self._collect()
+        result = {'time': datetime.now().astimezone().isoformat(timespec='seconds'), 'metrics': {}}
+        for name, samples in values.items():
+            result['metrics'][name] = [{'labels': dict(key), 'value': value} for key, value in samples.items()]
+        for name, samples in histograms.items():
+            result['metrics'][name] = [
+                {'labels': dict(key), 'count': count, 'sum': total, 'buckets': dict(buckets)}
+                for key, (buckets, total, count) in samples.items()
+            ]
+        return result
+
+
+metrics = Metrics()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = metrics.to_prometheus().encode()
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif self.path == '/metrics.json':
+            body = json.dumps(metrics.to_json()).encode()
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsExporter:
+    # Serves /metrics in the Prometheus text format and /metrics.json on localhost when port is set,
+    # writes the JSON to path every interval seconds when path is set, and once more on close.
+    def __init__(self, port: int = 0, path: str = '', interval: float = 15.0):
+        self._path = path
+        self._interval = interval
+        self._stop_event = Event()
+        self._server = None
+        self._threads = []
+        if port:
+            self._server = ThreadingHTTPServer(('127.0.0.1', port), _MetricsHandler)
+            self._threads.append(Thread(target=self._server.serve_forever, name='metrics-server', daemon=True))
+        if path:
+            self._threads.append(Thread(target=self._dump_periodically, name='metrics-dump', daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def dump(self):
+        temporary_path = self._path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as file:
+            json.dump(metrics.to_json(), file, indent=1)
+        os.replace(temporary_path, self._path)
+
+    def _dump_periodically(self):
+        while not self._stop_event.wait(self._interval):
+            self.dump()
+
+    def close(self):
+        self._stop_event.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        for thread in self._threads:
+            thread.join()
+        if self._path:
+            self.dump()
+
+
+@contextmanager
+def profile_to(path: str):
+    # cProfile of the calling thread, stats are written to path for pstats or snakeviz.
+    # Imported here, the profiler is not loaded unless a pass is profiled.
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
@@ -0,0 +1,158 @@
+import json
+import os
+import tarfile
+import tempfile
+import uuid
+from io import BytesIO
+from threading import RLock
+
+# Bundles live in their own folder of the remote one, the remote listing does not walk it
+BUNDLES_FOLDER = '.file_synch_bundles'
+
+
+def new_bundle_rel_path() -> str:
+    return f'{BUNDLES_FOLDER}/{uuid.uuid4().hex}.tar'
+
+
+def is_packed(entry) -> bool:
+    # Record keeping entries of packed files point to the bundles folder, the bundle is in the pack index
+    return isinstance(entry, dict) and entry.get('remote_path') == BUNDLES_FOLDER
+
+
+class BundleWriter:
+    # Plain tar in a temporary file, any tar tool restores the files from a bundle. Members are small
+    # by definition and are read whole, a file changing while it is packed can not break the archive.
+    def __init__(self):
+        descriptor, self.path = tempfile.mkstemp(prefix='file_synch_', suffix='.tar')
+        os.close(descriptor)
+        self._archive = tarfile.open(self.path, 'w', format=tarfile.PAX_FORMAT)
+        # rel_path -> (offset, length) of the member data in the bundle
+        self.locations: dict[str, tuple[int, int]] = {}
+
+    def add(self, rel_path: str, data: bytes, mtime: float):
+        member = tarfile.TarInfo(rel_path)
+        member.size = len(data)
+        member.mtime = int(mtime)
+        member.mode = 0o644
+        header = member.tobuf(self._archive.format, self._archive.encoding, self._archive.errors)
+        offset = self._archive.offset + len(header)
+        self._archive.addfile(member, BytesIO(data))
+        self.locations[rel_path] = (offset, len(data))
+
+    def close(self) -> int:
+        # Returns the size of the bundle, the caller removes the file
+        self._archive.close()
+        return os.path.getsize(self.path)
+
+    def discard(self):
+        self._archive.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class PackIndex:
+    # Local index of packed files: rel_path -> [bundle, offset, length], and for every bundle the bytes of
+    # file data it was written with, the bytes and the files still live in it. A changed file is written
+    # into a new bundle and only its old bytes turn dead, bundles mostly dead are rewritten by compaction.
+    def __init__(self, index_path: str):
+        self._index_path = index_path
+        self._lock = RLock()
+        self._files: dict[str, list] = {}
+        self._bundles: dict[str, dict[str, int]] = {}
+        self._changed = False
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self._index_path, 'r') as file:
+                data = json.load(file)
+            self._files = data['files']
+            self._bundles = data['bundles']
+        except (FileNotFoundError, ValueError, KeyError):
+            self._files = {}
+            self._bundles = {}
+
+    def save(self):
+        with self._lock:
+            if not self._changed:
+                return
+            temporary_path = self._index_path + '.tmp'
+            with open(temporary_path, 'w') as file:
+                json.dump({'files': self._files, 'bundles': self._bundles}, file)
+            os.replace(temporary_path, self._index_path)
+            self._changed = False
+
+    def _forget(self, rel_path: str):
+        location = self._files.pop(rel_path, None)
+        if location is not None:
+            sizes = self._bundles[location[0]]
+            sizes['live'] -= location[2]
+            sizes['files'] -= 1
+
+    def add_bundle(self, bundle: str, locations: dict[str, tuple[int, int]]):
+        # Files already packed elsewhere move to the new bundle
+        with self._lock:
+            for rel_path in locations:
+                self._forget(rel_path)
+            size = sum(length for _, length in locations.values())
+            self._bundles[bundle] = {'size': size, 'live': size, 'files': len(locations)}
+            for rel_path, (offset, length) in locations.items():
+                self._files[rel_path] = [bundle, offset, length]
+            self._changed = True
+
+    def move_files(self, bundle: str, locations: dict[str, tuple[int, int]], from_bundles: list[str]):
+        # Compaction copied the live files of from_bundles into bundle. Files packed again meanwhile
+        # stay where they are now.
+        with self._lock:
+            moved = {
+                rel_path: location for rel_path, location in locations.items()
+                if rel_path in self._files and self._files[rel_path][0] in from_bundles
+            }
+            self.add_bundle(bundle, moved)
+
+    def remove(self, rel_path: str):
+        with self._lock:
+            if rel_path in self._files:
+                self._forget(rel_path)
+                self._changed = True
+
+    def files_in(self, bundle: str) -> dict[str, tuple[int, int]]:
+        with self._lock:
+            return {
+                rel_path: (offset, length) for rel_path, (file_bundle, offset, length) in self._files.items()
+                if file_bundle == bundle
+            }
+
+    def dead_bundles(self) -> list[str]:
+        # Bundles without live files, kept until they are deleted from the remote storage
+        with self._lock:
+            return [bundle for bundle, sizes in self._bundles.items() if sizes['files'] <= 0]
+
+    def forget_bundle(self, bundle: str):
+        with self._lock:
+            if self._bundles.pop(bundle, None) is not None:
+                self._changed = True
+
+    def compaction_candidates(self, ratio: float, bundle_size: int) -> list[str]:
+        # Sparsest bundles first, as many as fill one new bundle with their live files
+        with self._lock:
+            sparse_bundles = sorted(
+                (sizes['live'] / max(sizes['size'], 1), bundle) for bundle, sizes in self._bundles.items()
+                if sizes['files'] > 0 and sizes['live'] < sizes['size'] * ratio
+            )
+            candidates = []
+            live = 0
+            for _, bundle in sparse_bundles:
+                if candidates and live + self._bundles[bundle]['live'] > bundle_size:
+                    break
+                candidates.append(bundle)
+                live += self._bundles[bundle]['live']
+            return candidates
+
+    def needs_compaction(self, ratio: float) -> bool:
+        with self._lock:
+            return any(
+                sizes['files'] <= 0 or sizes['live'] < sizes['size'] * ratio for sizes in self._bundles.values()
+            )
@@ -0,0 +1,236 @@
+from typing import Callable, Iterable, Optional
+
+from change_detector import is_changed
+from delta import CHUNKS_FOLDER, MANIFEST_SUFFIX
+from packing import BUNDLES_FOLDER, is_packed
+
+REMOTE_FIELDS = ','.join(
+    f'_embedded.items.{field}' for field in ('name', 'type', 'size', 'md5', 'sha256', 'modified')
+) + ',_embedded.total'
+
+UPLOAD = 'upload'
+OVERWRITE = 'overwrite'
+DELETE = 'delete'
+RECORD = 'record'
+FORGET = 'forget'
+DOWNLOAD = 'download'
+DELETE_LOCAL = 'delete_local'
+CONFLICT = 'conflict'
+
+
+class RemoteListingError(Exception):
+    pass
+
+
+def build_remote_index(list_page: Callable[[str, int, int], Optional[dict]], page_size: int = 1000) -> dict[str, dict]:
+    # list_page(rel_dir, limit, offset) returns the Disk API resource json of a folder page, None for a missing folder.
+    # Walks the remote tree with large pages and returns rel_path -> {size, md5, sha256, modified},
+    # chunked files show up under their own path with 'manifest': True.
+    remote_index = {}
+    stack = ['']
+    while stack:
+        rel_dir = stack.pop()
+        offset = 0
+        while True:
+            page = list_page(rel_dir, page_size, offset)
+            if page is None:
+                break
+            embedded = page.get('_embedded', {})
+            items = embedded.get('items', [])
+            for item in items:
+                rel_path = f'{rel_dir}/{item["name"]}' if rel_dir else item['name']
+                if item.get('type') == 'dir':
+                    if rel_path not in (CHUNKS_FOLDER, BUNDLES_FOLDER):
+                        stack.append(rel_path)
+                elif rel_path.endswith(MANIFEST_SUFFIX):
+                    remote_index[rel_path[:-len(MANIFEST_SUFFIX)]] = {'manifest': True, 'modified': item.get('modified')}
+                else:
+                    remote_index.setdefault(rel_path, {
+                        'size': item.get('size'),
+                        'md5': item.get('md5'),
+                        'sha256': item.get('sha256'),
+                        'modified': item.get('modified'),
+                    })
+            offset += len(items)
+            if not items or offset >= embedded.get('total', 0):
+                break
+    return remote_index
+
+
+def _stored_remote_path(last_entry) -> Optional[str]:
+    # Compressed files are stored under their own name with a suffix, chunked ones are listed
+    # under the file path, see build_remote_index
+    remote_path = last_entry.get('remote_path') if isinstance(last_entry, dict) else None
+    if remote_path and not remote_path.endswith(MANIFEST_SUFFIX):
+        return remote_path
+    return None
+
+
+def _matches_remote(local_entry: dict, last_entry, remote_entry: Optional[dict]) -> bool:
+    if remote_entry is None:
+        return False
+    if remote_entry.get('packed'):
+        # Bundles are not walked by the listing, the pack index knows where the file is
+        return not is_changed(local_entry, last_entry)
+    if remote_entry.get('manifest'):
+        # Manifest content is not listed, trust it while the record says the file was stored chunked
+        return isinstance(last_entry, dict) and bool(last_entry.get('remote_path')) and not is_changed(local_entry, last_entry)
+    if isinstance(last_entry, dict) and last_entry.get('compression'):
+        return remote_entry.get('sha256') == last_entry.get('compressed_sha256') and not is_changed(local_entry, last_entry)
+    return remote_entry.get('sha256') == local_entry['sha256']
+
+
+def two_way_diff(local_data: dict[str, dict], last_local_data: dict) -> list[tuple]:
+    # Local state against record keeping only, remote is assumed to match the record keeping
+    actions = []
+    for rel_path, last_entry in last_local_data.items():
+        local_entry = local_data.get(rel_path)
+        if local_entry is None:
+            actions.append((DELETE, rel_path, last_entry))
+        elif is_changed(local_entry, last_entry):
+            actions.append((OVERWRITE, rel_path, local_entry))
+        elif local_entry != last_entry:
+            # Touched, moved or re-hashed without a content change, nothing to upload
+            actions.append((RECORD, rel_path, {**last_entry, **local_entry} if isinstance(last_entry, dict) else local_entry))
+    for rel_path, local_entry in local_data.items():
+        if rel_path not in last_local_data:
+            actions.append((UPLOAD, rel_path, local_entry))
+    return actions
+
+
+def three_way_diff(local_data: dict[str, dict], last_local_data: dict, remote_index: dict[str, dict]) -> list[tuple]:
+    # Compares local state, record keeping (the common base) and the remote listing in one sweep.
+    # Returns (action, rel_path, entry) with the local entry for uploads and records, the last one for deletes.
+    actions = []
+    for rel_path in local_data.keys() | last_local_data.keys():
+        local_entry = local_data.get(rel_path)
+        last_entry = last_local_data.get(rel_path)
+        if is_packed(last_entry):
+            remote_entry = {'packed': True}
+        else:
+            remote_entry = remote_index.get(_stored_remote_path(last_entry) or rel_path)
+
+        if local_entry is not None:
+            if _matches_remote(local_entry, last_entry, remote_entry):
+                if isinstance(last_entry, dict) and last_entry.get('remote_path'):
+                    local_entry = {**last_entry, **local_entry}
+                if local_entry != last_entry:
+                    actions.append((RECORD, rel_path, local_entry))
+            elif remote_entry is None:
+                actions.append((UPLOAD, rel_path, local_entry))
+            else:
+                actions.append((OVERWRITE, rel_path, local_entry))
+        elif remote_entry is not None:
+            actions.append((DELETE, rel_path, last_entry))
+        else:
+            actions.append((FORGET, rel_path, last_entry))
+    return actions
+
+
+def bidirectional_diff(local_data: dict[str, dict], last_local_data: dict, remote_index: dict[str, dict]) -> list[tuple]:
+    # Changes on either side are found against record keeping, the state both sides had after the last
+    # synchronization. Files stored compressed or chunked, and legacy entries without a hash, are only pushed,
+    # as in three_way_diff. Returns the remote entry for downloads, the local one for uploads, records and
+    # conflicts, the last one for deletes.
+    actions = []
+    stored_remote_paths = {_stored_remote_path(last_entry) for last_entry in last_local_data.values()}
+    for rel_path in local_data.keys() | last_local_data.keys() | (remote_index.keys() - stored_remote_paths):
+        local_entry = local_data.get(rel_path)
+        last_entry = last_local_data.get(rel_path)
+        remote_entry = remote_index.get(rel_path)
+
+        if (
+            (last_entry is not None and (not isinstance(last_entry, dict) or last_entry.get('remote_path')))
+            or (remote_entry is not None and remote_entry.get('manifest'))
+        ):
+            actions += three_way_diff(
+                {rel_path: local_entry} if local_entry is not None else {},
+                {rel_path: last_entry} if last_entry is not None else {},
+                remote_index
+            )
+            continue
+
+        remote_sha256 = remote_entry.get('sha256') if remote_entry is not None else None
+        if last_entry is None:
+            if local_entry is None:
+                actions.append((DOWNLOAD, rel_path, remote_entry))
+            elif remote_entry is None:
+                actions.append((UPLOAD, rel_path, local_entry))
+            elif remote_sha256 == local_entry['sha256']:
+                actions.append((RECORD, rel_path, local_entry))
+            else:
+                actions.append((CONFLICT, rel_path, local_entry))
+            continue
+
+        local_changed = local_entry is None or is_changed(local_entry, last_entry)
+        # A listing without a hash can not tell a remote change, the remote side is taken as unchanged
+        remote_changed = remote_entry is None or (remote_sha256 is not None and remote_sha256 != last_entry.get('sha256'))
+        if not local_changed and not remote_changed:
+            if local_entry != last_entry:
+                actions.append((RECORD, rel_path, {**last_entry, **local_entry}))
+        elif not remote_changed:
+            if local_entry is None:
+                actions.append((DELETE, rel_path, last_entry))
+            else:
+                actions.append((OVERWRITE, rel_path, local_entry))
+        elif not local_changed:
+            if remote_entry is None:
+                actions.append((DELETE_LOCAL, rel_path, last_entry))
+            else:
+                actions.append((DOWNLOAD, rel_path, remote_entry))
+        # Both sides changed
+        elif local_entry is None and remote_entry is None:
+            actions.append((FORGET, rel_path, last_entry))
+        elif local_entry is None:
+            # Removed here, edited there: the edit wins, nothing is lost
+            actions.append((DOWNLOAD, rel_path, remote_entry))
+        elif remote_entry is None:
+            actions.append((UPLOAD, rel_path, local_entry))
+        elif remote_sha256 == local_entry['sha256']:
+            actions.append((RECORD, rel_path, local_entry))
+        else:
+            actions.append((CONFLICT, rel_path, local_entry))
+    return actions
+
+
+def untracked_remote_paths(local_data: dict, last_local_data: dict, remote_index: dict[str, dict]) -> list[str]:
+    stored_remote_paths = {_stored_remote_path(last_entry) for last_entry in last_local_data.values()}
+    return sorted(remote_index.keys() - local_data.keys() - last_local_data.keys() - stored_remote_paths)
+
+
+def _parent_dirs(rel_path: str) -> list[str]:
+    parts = rel_path.split('/')[:-1]
+    return ['/'.join(parts[:depth]) for depth in range(1, len(parts) + 1)]
+
+
+def removed_folders(deleted: dict, recorded_paths: Iterable[str], remote_index: Optional[dict[str, dict]] = None, exists: Callable[[str], bool] = lambda rel_dir: False) -> dict[str, list[str]]:
+    # deleted maps the files removed locally to their last entries. Returns the topmost folders where every
+    # recorded file is removed, with the removed files under each, so a folder is deleted with one request.
+    # With the remote index a folder holding any other remote file is kept, folders still present locally
+    # (exists) are kept too, they may hold files not recorded yet.
+    recorded_counts = {}
+    for rel_path in recorded_paths:
+        for rel_dir in _parent_dirs(rel_path):
+            recorded_counts[rel_dir] = recorded_counts.get(rel_dir, 0) + 1
+    deleted_counts = {}
+    for rel_path in deleted:
+        for rel_dir in _parent_dirs(rel_path):
+            deleted_counts[rel_dir] = deleted_counts.get(rel_dir, 0) + 1
+
+    kept_dirs = {CHUNKS_FOLDER, BUNDLES_FOLDER}
+    if remote_index is not None:
+        allowed_remote_paths = set(deleted) | {_stored_remote_path(last_entry) for last_entry in deleted.values()}
+        for rel_path in remote_index.keys() - allowed_remote_paths:
+            kept_dirs.update(_parent_dirs(rel_path))
+    candidates = {
+        rel_dir for rel_dir, count in deleted_counts.items()
+        if count == recorded_counts.get(rel_dir) and rel_dir not in kept_dirs and not exists(rel_dir)
+    }
+
+    folders = {rel_dir: [] for rel_dir in candidates if not any(parent in candidates for parent in _parent_dirs(rel_dir))}
+    for rel_path in deleted:
+        for rel_dir in _parent_dirs(rel_path):
+            if rel_dir in folders:
+                folders[rel_dir].append(rel_path)
+                break
+    return folders
@@ -0,0 +1,177 @@
+import json
+import os
+import sqlite3
+from abc import ABC, abstractmethod
+from typing import Iterator, Optional
+
+RECORD_KEEPING_BACKENDS = ('json', 'sqlite')
+
+
+class RecordKeeping(ABC):
+    # Per-file state of the last successful synchronization, keyed by path relative to the local folder.
+    # Changes are collected with upserts and removals and become durable only on commit().
+    # journal, when set, is checkpointed by every commit, see journal.IntentJournal.
+    journal = None
+
+    @abstractmethod
+    def get(self, rel_path: str, default=None):
+        pass
+
+    def __contains__(self, rel_path: str) -> bool:
+        return self.get(rel_path) is not None
+
+    @abstractmethod
+    def __setitem__(self, rel_path: str, entry):
+        pass
+
+    @abstractmethod
+    def pop(self, rel_path: str, default=None):
+        pass
+
+    @abstractmethod
+    def items(self) -> Iterator[tuple[str, object]]:
+        pass
+
+    def keys(self) -> Iterator[str]:
+        return (rel_path for rel_path, _ in self.items())
+
+    @abstractmethod
+    def is_initialized(self) -> bool:
+        pass
+
+    @abstractmethod
+    def mark_initialized(self):
+        pass
+
+    @abstractmethod
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _checkpoint_journal(self):
+        if self.journal is not None:
+            self.journal.checkpoint()
+
+
+class JsonRecordKeeping(RecordKeeping):
+    # The original format, the whole file is rewritten atomically on commit and only when something changed
+    def __init__(self, path: str):
+        self._path = path
+        self._changed = False
+        self._initialized = os.path.exists(path) and os.path.getsize(path) > 0
+        self._data = {}
+        if self._initialized:
+            with open(path, 'r') as file:
+                self._data = json.load(file)
+
+    def get(self, rel_path, default=None):
+        return self._data.get(rel_path, default)
+
+    def __contains__(self, rel_path):
+        return rel_path in self._data
+
+    def __setitem__(self, rel_path, entry):
+        if self._data.get(rel_path) != entry:
+            self._data[rel_path] = entry
+            self._changed = True
+
+    def pop(self, rel_path, default=None):
+        if rel_path in self._data:
+            self._changed = True
+        return self._data.pop(rel_path, default)
+
+    def items(self):
+        return iter(list(self._data.items()))
+
+    def is_initialized(self):
+        return self._initialized
+
+    def mark_initialized(self):
+        self._initialized = True
+        self._changed = True
+
+    def commit(self):
+        if self._changed:
+            with open(self._path + '.tmp', 'w') as file:
+                json.dump(self._data, file, indent=4)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(self._path + '.tmp', self._path)
+            self._changed = False
+        self._checkpoint_journal()
+
+
+class SqliteRecordKeeping(RecordKeeping):
+    # One row per file, lookups go to the database instead of a dict loaded in full,
+    # a scan commits one transaction with only the rows that changed.
+    def __init__(self, path: str, legacy_json_path: Optional[str] = None):
+        self._path = path
+        created = not os.path.exists(path)
+        self._connection = sqlite3.connect(path)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS records (path TEXT PRIMARY KEY, entry TEXT NOT NULL)')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self._connection.commit()
+        if created and legacy_json_path and os.path.exists(legacy_json_path) and os.path.getsize(legacy_json_path) > 0:
+            self._import_json(legacy_json_path)
+
+    def _import_json(self, legacy_json_path: str):
+        with open(legacy_json_path, 'r') as file:
+            data = json.load(file)
+        self._connection.executemany(
+            'INSERT OR REPLACE INTO records (path, entry) VALUES (?, ?)',
+            ((rel_path, json.dumps(entry)) for rel_path, entry in data.items())
+        )
+        self.mark_initialized()
+        self.commit()
+
+    def get(self, rel_path, default=None):
+        row = self._connection.execute('SELECT entry FROM records WHERE path = ?', (rel_path,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def __setitem__(self, rel_path, entry):
+        self._connection.execute(
+            'INSERT INTO records (path, entry) VALUES (?, ?) ON CONFLICT(path) DO UPDATE SET entry = excluded.entry',
+            (rel_path, json.dumps(entry))
+        )
+
+    def pop(self, rel_path, default=None):
+        entry = self.get(rel_path, default)
+        self._connection.execute('DELETE FROM records WHERE path = ?', (rel_path,))
+        return entry
+
+    def items(self):
+        for rel_path, entry in self._connection.execute('SELECT path, entry FROM records'):
+            yield rel_path, json.loads(entry)
+
+    def keys(self):
+        for (rel_path,) in self._connection.execute('SELECT path FROM records'):
+            yield rel_path
+
+    def is_initialized(self):
+        return self._connection.execute("SELECT 1 FROM meta WHERE key = 'initialized'").fetchone() is not None
+
+    def mark_initialized(self):
+        self._connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('initialized', '1')")
+
+    def commit(self):
+        self._connection.commit()
+        self._checkpoint_journal()
+
+    def close(self):
+        self._connection.close()
+
+
+def open_record_keeping(backend: str, path: str) -> RecordKeeping:
+    if backend == 'json':
+        return JsonRecordKeeping(path)
+    if backend == 'sqlite':
+        # Record keeping left by the JSON backend next to the database is imported once
+        stem, extension = os.path.splitext(path)
+        if extension == '.json':
+            path = stem + '.db'
+        return SqliteRecordKeeping(path, stem + '.json')
+    raise ValueError(f'Unknown record keeping backend {backend}.')
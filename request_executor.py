@@ -0,0 +1,195 @@
+import email.utils
+from datetime import datetime, timezone
+from threading import Lock
+from time import monotonic
+from typing import Callable, Optional
+
+import requests
+from requests import Response
+
+from transfer import backoff_delay
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+TRANSFER_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    pass
+
+
+def parse_retry_after(response: Optional[Response]) -> Optional[float]:
+    # Retry-After is either a number of seconds or an HTTP date
+    if response is None:
+        return None
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def retry_delay(response: Optional[Response], attempt: int, cap: float = 60.0) -> float:
+    retry_after = parse_retry_after(response)
+    if retry_after is not None:
+        return min(retry_after, cap)
+    return backoff_delay(attempt, cap=cap)
+
+
+class TokenBucket:
+    # Shared by all workers. A request takes a token ahead of time and waits until it is due,
+    # so callers queue up evenly instead of racing for the next refill. The rate is adaptive:
+    # halved on every 429, raised back step by step with successful requests. Rate 0 is unlimited.
+    def __init__(self, rate: float, burst: int):
+        self.max_rate = max(0.0, rate)
+        self.rate = self.max_rate
+        self._burst = max(1, burst)
+        self._tokens = float(self._burst)
+        self._updated = monotonic()
+        self._paused_until = 0.0
+        self._lock = Lock()
+
+    def _refill(self, now: float):
+        if self.rate:
+            self._tokens = min(self._burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self) -> float:
+        # Returns seconds to wait before sending
+        with self._lock:
+            now = monotonic()
+            delay = max(0.0, self._paused_until - now)
+            if not self.rate:
+                return delay
+            self._refill(now)
+            self._tokens -= 1
+            if self._tokens < 0:
+                delay = max(delay, -self._tokens / self.rate)
+            return delay
+
+    def throttle(self, retry_after: Optional[float] = None):
+        with self._lock:
+            now = monotonic()
+            self._refill(now)
+            if self.max_rate:
+                self.rate = max(self.max_rate / 16, self.rate / 2)
+                self._tokens = min(self._tokens, 0.0)
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+
+    def recover(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self._refill(monotonic())
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class CircuitBreaker:
+    # Opens after failure_threshold failures in a row and fails requests fast for reset_timeout seconds,
+    # then lets one probe request through, its result closes the circuit or opens it again.
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self._failure_threshold = max(1, failure_threshold)
+        self._reset_timeout = reset_timeout
+        self._failures_count = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self.state = self.CLOSED
+        self._lock = Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.OPEN and monotonic() - self._opened_at >= self._reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    return False
+                self._probing = True
+                return True
+            return self.state == self.CLOSED
+
+    def record_success(self):
+        with self._lock:
+            self._failures_count = 0
+            self._probing = False
+            self.state = self.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self._failures_count += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self._failures_count >= self._failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = monotonic()
+
+
+class RequestExecutor:
+    # Every Disk API call goes through execute(): rate limited, retried on connection errors, 429 and 5xx
+    # with Retry-After or exponential backoff with jitter, and cut off by the circuit breaker while the API is down.
+    # wait(seconds) sleeps and returns False when the application is exiting.
+    def __init__(self, bucket: TokenBucket, breaker: CircuitBreaker, retries: int, wait: Callable[[float], bool]):
+        self.bucket = bucket
+        self.breaker = breaker
+        self._retries = retries
+        self._wait = wait
+        self._retries_count = 0
+        self._lock = Lock()
+
+    @property
+    def retries_count(self) -> int:
+        return self._retries_count
+
+    def execute(self, send: Callable[[], Response]) -> Response:
+        response = None
+        error = None
+        for attempt in range(1, self._retries + 2):
+            if not self.breaker.allow():
+                raise CircuitOpenError('Disk API is unavailable, requests are suspended.')
+            delay = self.bucket.reserve()
+            if delay and not self._wait(delay):
+                break
+
+            try:
+                response = send()
+            except TRANSFER_ERRORS as e:
+                error, response = e, None
+                self.breaker.record_failure()
+            else:
+                error = None
+                if response.status_code == 429:
+                    # Too many requests is not an outage, only the rate goes down
+                    self.breaker.record_success()
+                    self.bucket.throttle(parse_retry_after(response))
+                elif response.status_code in RETRYABLE_STATUS_CODES:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                    self.bucket.recover()
+                    return response
+
+            if attempt > self._retries:
+                break
+            with self._lock:
+                self._retries_count += 1
+            if not self._wait(retry_delay(response, attempt)):
+                break
+
+        if response is None:
+            raise error or requests.exceptions.ConnectionError('Request cancelled.')
+        return response
@@ -0,0 +1,246 @@
+import fnmatch
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Condition, RLock, Thread
+from typing import Callable, Optional
+
+SCHEDULE_POLICIES = ('size', 'age', 'pattern')
+
+
+def parse_patterns(patterns: str) -> tuple[str, ...]:
+    return tuple(pattern.strip() for pattern in patterns.split(',') if pattern.strip())
+
+
+def task_priority(task: tuple, policy: str = 'size', patterns: tuple[str, ...] = ()) -> tuple:
+    # Lower sorts first. Deletes go first as one batch, each is a single cheap request.
+    # size: smallest files first, age: longest waiting change first,
+    # pattern: files matching an earlier pattern first, then by size.
+    _, _, file_name, new_entry = task
+    if new_entry is None:
+        return 0,
+    size = new_entry.get('size', 0) if isinstance(new_entry, dict) else 0
+    if policy == 'age':
+        return 1, new_entry.get('mtime_ns', 0), size
+    if policy == 'pattern':
+        rank = next((index for index, pattern in enumerate(patterns) if fnmatch.fnmatch(file_name, pattern)), len(patterns))
+        return 1, rank, size
+    return 1, size
+
+
+def is_large_task(task: tuple, large_file_size: int) -> bool:
+    new_entry = task[3]
+    return bool(large_file_size) and isinstance(new_entry, dict) and new_entry.get('size', 0) >= large_file_size
+
+
+class LargeFileLane:
+    # Huge files are uploaded by their own workers and a pass does not wait for them,
+    # so small files keep flowing while big transfers run. A task waiting here is replaced
+    # by a newer one for the same file, a file being transferred is not planned again until
+    # it is finished, finished files are handed back to the caller to be recorded and rechecked.
+    def __init__(self, workers: int, on_finished: Optional[Callable[[], None]] = None):
+        self._workers = max(1, workers)
+        self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='large-file')
+        self._waiting: dict[str, tuple[tuple, tuple]] = {}
+        self._running: set[str] = set()
+        self._finished: list[tuple[tuple, Future]] = []
+        self._on_finished = on_finished
+        self._closed = False
+        self._lock = RLock()
+
+    def is_running(self, file_name: str) -> bool:
+        with self._lock:
+            return file_name in self._running
+
+    def is_waiting(self, file_name: str) -> bool:
+        with self._lock:
+            return file_name in self._waiting
+
+    def submit(self, task: tuple, priority: tuple):
+        with self._lock:
+            self._waiting[task[2]] = (priority, task)
+            self._feed()
+
+    def _feed(self):
+        while not self._closed and len(self._running) < self._workers:
+            candidates = [file_name for file_name in self._waiting if file_name not in self._running]
+            if not candidates:
+                return
+            file_name = min(candidates, key=lambda candidate: self._waiting[candidate][0])
+            _, task = self._waiting.pop(file_name)
+            self._running.add(file_name)
+            function, args, _, _ = task
+            future = self._executor.submit(function, *args)
+            future.add_done_callback(lambda done_future, done_task=task: self._done(done_task, done_future))
+
+    def _done(self, task: tuple, future: Future):
+        with self._lock:
+            self._running.discard(task[2])
+            self._finished.append((task, future))
+            self._feed()
+        if self._on_finished is not None:
+            self._on_finished()
+
+    def has_finished(self) -> bool:
+        with self._lock:
+            return bool(self._finished)
+
+    def pop_finished(self) -> list[tuple[tuple, Future]]:
+        with self._lock:
+            finished, self._finished = self._finished, []
+        return finished
+
+    def depth(self) -> dict[str, int]:
+        with self._lock:
+            return {'waiting': len(self._waiting), 'running': len(self._running)}
+
+    def close(self):
+        # Waiting tasks are dropped, their files are still unrecorded and come back with the next scan
+        with self._lock:
+            self._closed = True
+            self._waiting.clear()
+        self._executor.shutdown(wait=True)
+
+
+class OperationPoller:
+    # Long remote operations, like deleting a folder, are answered with 202 and an operation to poll.
+    # They are polled here in the background, a pass does not wait for them. Files of a pending operation
+    # are not planned again, finished operations are handed back to the caller to be recorded.
+    # check(href) returns True when the operation succeeded, False when it failed and None while it runs.
+    def __init__(self, check: Callable[[str], Optional[bool]], interval: float = 2.0, on_finished: Optional[Callable[[], None]] = None):
+        self._check = check
+        self._interval = interval
+        self._on_finished = on_finished
+        self._pending: dict[str, list[str]] = {}
+        self._pending_files: set[str] = set()
+        self._finished: list[tuple[list[str], bool]] = []
+        self._thread: Optional[Thread] = None
+        self._closed = False
+        self._condition = Condition()
+
+    def watch(self, href: str, file_names: list[str]) -> bool:
+        # False when closed, the files stay recorded and are planned again by the next run
+        with self._condition:
+            if self._closed:
+                return False
+            self._pending[href] = file_names
+            self._pending_files.update(file_names)
+            if self._thread is None:
+                self._thread = Thread(target=self._poll, name='operation-poller', daemon=True)
+                self._thread.start()
+        return True
+
+    def is_pending(self, file_name: str) -> bool:
+        with self._condition:
+            return file_name in self._pending_files
+
+    def _poll(self):
+        while True:
+            with self._condition:
+                if self._closed or not self._pending:
+                    # Started again by the next watch
+                    self._thread = None
+                    return
+                hrefs = list(self._pending)
+            for href in hrefs:
+                succeeded = self._check(href)
+                if succeeded is None:
+                    continue
+                with self._condition:
+                    file_names = self._pending.pop(href)
+                    self._pending_files.difference_update(file_names)
+                    self._finished.append((file_names, succeeded))
+                    self._condition.notify_all()
+                if self._on_finished is not None:
+                    self._on_finished()
+            with self._condition:
+                if self._pending and not self._closed:
+                    self._condition.wait(self._interval)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        # True once nothing is pending
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._pending or self._closed, timeout) and not self._pending
+
+    def has_finished(self) -> bool:
+        with self._condition:
+            return bool(self._finished)
+
+    def pop_finished(self) -> list[tuple[list[str], bool]]:
+        with self._condition:
+            finished, self._finished = self._finished, []
+        return finished
+
+    def depth(self) -> int:
+        with self._condition:
+            return len(self._pending)
+
+    def close(self):
+        # Pending operations are left to the remote storage, their files are planned again by the next run
+        with self._condition:
+            self._closed = True
+            thread = self._thread
+            self._condition.notify_all()
+        if thread is not None:
+            thread.join()
+
+
+class FairTaskPool:
+    # One set of workers shared by all sync pairs. Every pair has its own queue and workers take
+    # tasks from the pairs in turn, so a pair with thousands of changed files does not starve the others.
+    # Tasks of one pair keep their submission order.
+    def __init__(self, workers: int):
+        self._workers = max(1, workers)
+        self._queues: dict[str, deque] = {}
+        self._turns: deque[str] = deque()
+        self._threads: list[Thread] = []
+        self._closed = False
+        self._condition = Condition()
+
+    def submit(self, pair_name: str, function: Callable, *args) -> Future:
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError('Task pool is closed.')
+            queue = self._queues.setdefault(pair_name, deque())
+            if not queue:
+                self._turns.append(pair_name)
+            queue.append((future, function, args))
+            if len(self._threads) < self._workers:
+                thread = Thread(target=self._work, name=f'sync-worker-{len(self._threads)}', daemon=True)
+                self._threads.append(thread)
+                thread.start()
+            self._condition.notify()
+        return future
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while not self._turns and not self._closed:
+                    self._condition.wait()
+                if not self._turns:
+                    return
+                pair_name = self._turns.popleft()
+                queue = self._queues[pair_name]
+                future, function, args = queue.popleft()
+                if queue:
+                    self._turns.append(pair_name)
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = function(*args)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def depth(self) -> dict[str, int]:
+        with self._condition:
+            return {pair_name: len(queue) for pair_name, queue in self._queues.items()}
+
+    def close(self):
+        # Queued tasks are still run, workers stop once the queues are empty
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
@@ -0,0 +1,69 @@
+import os
+from time import monotonic, time_ns
+from typing import Callable, Optional
+
+from change_detector import same_stat
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl of Linux that makes a file share the extents of another one, btrfs, XFS and others support it
+FICLONE = 0x40049409
+
+
+class StabilityGate:
+    # Holds back changed files that are still being written. A file is let through when its mtime is at least
+    # settle_time old, when it looked the same in two observations settle_time apart (mtime in the future,
+    # coarse timestamps), or when the watcher saw it closed after its last write. pop_closed(rel_paths)
+    # returns those of rel_paths closed after writing, see InotifyWatcher.pop_closed.
+    def __init__(self, settle_time: float, pop_closed: Optional[Callable[[set[str]], set[str]]] = None):
+        self._settle_time = settle_time
+        self._pop_closed = pop_closed
+        # rel_path -> ((size, mtime_ns), monotonic time it was first seen with that stat)
+        self._observations: dict[str, tuple[tuple[int, int], float]] = {}
+        self.held: set[str] = set()
+
+    def hold(self, local_stats: dict[str, dict[str, int]], last_local_data: dict) -> set[str]:
+        # Returns the files of local_stats changed since record keeping and not settled yet, they are held
+        # until the next call, which has to see them again
+        changed = {rel_path for rel_path, stat in local_stats.items() if not same_stat(last_local_data.get(rel_path), stat)}
+        closed = self._pop_closed(changed) if self._pop_closed is not None and changed else set()
+        now = monotonic()
+        settled_before_ns = time_ns() - int(self._settle_time * 1e9)
+        held = set()
+        observations = {}
+        for rel_path in changed:
+            stat = local_stats[rel_path]
+            if rel_path in closed or stat['mtime_ns'] <= settled_before_ns:
+                continue
+            observation = (stat['size'], stat['mtime_ns'])
+            previous = self._observations.get(rel_path)
+            if previous is not None and previous[0] == observation:
+                if now - previous[1] >= self._settle_time:
+                    continue
+                observations[rel_path] = previous
+            else:
+                observations[rel_path] = (observation, now)
+            held.add(rel_path)
+        self._observations = observations
+        self.held = held
+        return held
+
+
+def clone_file(source_path: str, target_path: str) -> bool:
+    # Copy-on-write snapshot of source_path, instant and consistent while a writer keeps going.
+    # False when the filesystem or the platform can not do it, nothing is left at target_path then.
+    if fcntl is None:
+        return False
+    try:
+        with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        return True
+    except OSError:
+        try:
+            os.remove(target_path)
+        except FileNotFoundError:
+            pass
+        return False
@@ -0,0 +1,62 @@
+import configparser
+import os
+
+import pytest
+
+from config import Config, ConfigStore
+
+
+def parse(text: str) -> Config:
+    parser = configparser.ConfigParser()
+    parser.read_string(text)
+    return Config.from_parser(parser)
+
+
+def test_choices_are_accepted():
+    config = parse('[app_config]\nwatch_mode = inotify\nsync_direction = both\nschedule_policy = pattern\n')
+
+    assert (config.watch_mode, config.sync_direction, config.schedule_policy) == ('inotify', 'both', 'pattern')
+
+
+@pytest.mark.parametrize('text, message', [
+    ('[app_config]\nwatch_mode = watch\n', 'Wrong watch_mode "watch" in \\[app_config\\]'),
+    ('[app_config]\nsync_direction = pull\n', 'Wrong sync_direction "pull"'),
+    ('[app_config]\nschedule_policy = fifo\n', 'Wrong schedule_policy "fifo"'),
+    ('[app_config]\n[pair:photos]\nsync_direction = Both\n', 'in \\[pair:photos\\]'),
+])
+def test_wrong_choice(text, message):
+    with pytest.raises(ValueError, match=message):
+        parse(text)
+
+
+def test_wrong_value_saved_while_running_keeps_last_snapshot(tmp_path):
+    path = tmp_path / 'config.ini'
+    path.write_text('[app_config]\ninterval = 5\nwatch_mode = poll\n')
+    store = ConfigStore(str(path))
+    config = store.refresh()
+
+    path.write_text('[app_config]\ninterval = often\nwatch_mode = poll\n')
+    os.utime(path, ns=(1, 1))
+    assert store.refresh() is config
+    assert 'interval' in store.pop_error()
+    # Reported once, the file is not parsed again until it changes
+    assert store.refresh() is config
+    assert store.pop_error() is None
+
+    path.write_text('[app_config]\ninterval = 5\nwatch_mode = watch\n')
+    os.utime(path, ns=(2, 2))
+    assert store.refresh(True) is config
+    assert 'Wrong watch_mode "watch"' in store.pop_error()
+
+    path.write_text('[app_config]\ninterval = 7\nwatch_mode = inotify\n')
+    os.utime(path, ns=(3, 3))
+    assert store.refresh().interval == 7.0
+    assert store.pop_error() is None
+
+
+def test_first_parse_raises(tmp_path):
+    path = tmp_path / 'config.ini'
+    path.write_text('[app_config]\nrecord_keeping_backend = csv\n')
+
+    with pytest.raises(ValueError, match='Wrong record_keeping_backend'):
+        ConfigStore(str(path)).refresh()
@@ -0,0 +1,83 @@
+import json
+import os
+
+from delta import SignatureStore
+
+
+def signature(*strongs):
+    return [[1, strong, 10] for strong in strongs]
+
+
+def upload(store, rel_path, *strongs, stored=True):
+    store.begin_chunks(rel_path, set(strongs))
+    store.add_uploaded_chunks(set(strongs))
+    store.end_chunks(rel_path, stored)
+
+
+def test_replaced_chunks_are_garbage(tmp_path):
+    store = SignatureStore(str(tmp_path))
+    upload(store, 'a.bin', 'x', 'y')
+    upload(store, 'b.bin', 'y', 'z')
+    assert store.take_garbage() == []
+
+    upload(store, 'a.bin', 'x', 'w')
+    # y is still in the manifest of b.bin
+    assert store.take_garbage() == []
+    store.release_chunks('b.bin')
+    garbage = store.take_garbage()
+    assert garbage == ['y', 'z']
+
+    store.finish_garbage(garbage, {'y', 'z'})
+    assert not store.is_chunk_uploaded('y')
+    assert store.is_chunk_uploaded('x')
+
+
+def test_failed_delete_is_collected_again(tmp_path):
+    store = SignatureStore(str(tmp_path))
+    upload(store, 'a.bin', 'x', 'y')
+    store.remove('a.bin')
+
+    garbage = store.take_garbage()
+    assert garbage == ['x', 'y']
+    store.finish_garbage(garbage, {'x'})
+
+    assert store.is_chunk_uploaded('y')
+    assert store.take_garbage() == ['y']
+
+
+def test_unstored_manifest_leaves_garbage(tmp_path):
+    store = SignatureStore(str(tmp_path))
+    upload(store, 'a.bin', 'x', stored=False)
+
+    assert store.take_garbage() == ['x']
+
+
+def test_chunks_of_running_upload_are_kept(tmp_path):
+    store = SignatureStore(str(tmp_path))
+    upload(store, 'a.bin', 'x')
+    store.release_chunks('a.bin')
+    store.begin_chunks('b.bin', {'x'})
+
+    assert store.take_garbage() == []
+
+
+def test_references_survive_restart(tmp_path):
+    upload(SignatureStore(str(tmp_path)), 'a.bin', 'x')
+    store = SignatureStore(str(tmp_path))
+
+    assert store.take_garbage() == []
+    store.release_chunks('a.bin')
+    assert store.take_garbage() == ['x']
+
+
+def test_chunks_uploaded_before_references_were_kept(tmp_path):
+    # Every saved signature counts as a manifest, only chunks of none of them are garbage
+    store = SignatureStore(str(tmp_path))
+    store.save('a.bin', signature('x', 'y'))
+    store.add_uploaded_chunks({'x', 'y', 'z'})
+    assert not os.path.exists(os.path.join(str(tmp_path), 'chunk_refs.json'))
+
+    store = SignatureStore(str(tmp_path))
+    assert store.take_garbage() == ['z']
+    with open(os.path.join(str(tmp_path), 'chunk_refs.json'), 'r') as file:
+        assert sorted(json.load(file).popitem()[1]) == ['x', 'y']
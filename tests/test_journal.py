@@ -0,0 +1,180 @@
+import json
+import os
+from queue import Queue
+
+from requests import Response
+
+from app import replay_journal, verify_intent
+from change_detector import hash_file, stat_file
+from config import Config
+from journal import IntentJournal
+from record_keeping import JsonRecordKeeping
+
+
+def entry(sha256):
+    return {'size': 1, 'mtime_ns': 1, 'inode': 1, 'sha256': sha256}
+
+
+def write_run(path):
+    # Two finished uploads and one still in flight, as a crashed run leaves them
+    journal = IntentJournal(path)
+    journal.begin('load_local_file', 'a.txt', entry('a'))
+    journal.done('a.txt', {'a.txt': entry('a')})
+    journal.begin('load_local_file', 'b.txt', entry('b'))
+    journal.begin('delete_remote_file', 'c.txt', None)
+    journal.done('b.txt', {'b.txt': entry('b')})
+    journal.close()
+
+
+def test_read_missing_journal(tmp_path):
+    assert IntentJournal(str(tmp_path / 'journal')).read() == ([], [])
+
+
+def test_read_finished_and_open_operations(tmp_path):
+    path = str(tmp_path / 'journal')
+    write_run(path)
+
+    changes, intents = IntentJournal(path).read()
+
+    assert changes == [{'a.txt': entry('a')}, {'b.txt': entry('b')}]
+    assert intents == [{'intent': 'delete_remote_file', 'path': 'c.txt', 'entry': None}]
+
+
+def test_read_skips_torn_last_line(tmp_path):
+    path = str(tmp_path / 'journal')
+    write_run(path)
+    with open(path, 'r') as file:
+        lines = file.readlines()
+    # The crash cut the done line of b.txt short
+    with open(path, 'w') as file:
+        file.writelines(lines[:-1])
+        file.write(lines[-1][:len(lines[-1]) // 2])
+
+    changes, intents = IntentJournal(path).read()
+
+    # b.txt is not recorded, its intent is left open to be verified
+    assert changes == [{'a.txt': entry('a')}]
+    assert sorted(intent['path'] for intent in intents) == ['b.txt', 'c.txt']
+
+
+def test_later_intent_replaces_earlier_one(tmp_path):
+    path = str(tmp_path / 'journal')
+    journal = IntentJournal(path)
+    journal.begin('load_local_file', 'a.txt', entry('a'))
+    journal.begin('push_local_file', 'a.txt', entry('b'))
+    journal.close()
+
+    assert IntentJournal(path).read()[1] == [{'intent': 'push_local_file', 'path': 'a.txt', 'entry': entry('b')}]
+
+
+def test_done_without_intent(tmp_path):
+    path = str(tmp_path / 'journal')
+    journal = IntentJournal(path)
+    journal.done(None, {'a.txt': None})
+    # A result for a path without an intent and without changes is not written
+    journal.done('b.txt', {})
+    journal.close()
+
+    assert IntentJournal(path).read() == ([{'a.txt': None}], [])
+
+
+def test_checkpoint_keeps_operations_in_flight(tmp_path):
+    path = str(tmp_path / 'journal')
+    journal = IntentJournal(path)
+    journal.begin('load_local_file', 'a.txt', entry('a'))
+    journal.done('a.txt', {'a.txt': entry('a')})
+    journal.begin('load_local_file', 'b.txt', entry('b'))
+
+    journal.checkpoint()
+    journal.close()
+
+    assert IntentJournal(path).read() == ([], [{'intent': 'load_local_file', 'path': 'b.txt', 'entry': entry('b')}])
+
+
+def test_checkpoint_after_replay_truncates(tmp_path):
+    path = str(tmp_path / 'journal')
+    write_run(path)
+
+    journal = IntentJournal(path)
+    journal.read()
+    # Record keeping got the replayed changes and was committed
+    journal.checkpoint()
+
+    with open(path, 'r') as file:
+        assert file.read() == ''
+
+
+class RemoteFiles:
+    # Answers file info requests of verify_intent from rel_path -> sha256
+    def __init__(self, files: dict[str, str]):
+        self.files = files
+
+    def get_file_info(self, rel_path):
+        response = Response()
+        if rel_path in self.files:
+            response.status_code = 200
+            response._content = json.dumps({'sha256': self.files[rel_path]}).encode()
+        else:
+            response.status_code = 404
+        return response
+
+
+def local_entry(local_path, rel_path, data):
+    path = os.path.join(local_path, rel_path)
+    with open(path, 'wb') as file:
+        file.write(data)
+    return {**stat_file(path), 'sha256': hash_file(path)}
+
+
+def test_replay_journal(tmp_path):
+    local_path = str(tmp_path / 'local')
+    os.makedirs(local_path)
+    config = Config(local_path=local_path)
+    record_keeping = JsonRecordKeeping(str(tmp_path / 'record_keeping.json'))
+    record_keeping['gone.txt'] = entry('g')
+    record_keeping['kept.txt'] = entry('k')
+    record_keeping.commit()
+    done = local_entry(local_path, 'done.txt', b'done')
+    sent = local_entry(local_path, 'sent.txt', b'sent')
+    unsent = local_entry(local_path, 'unsent.txt', b'unsent')
+    edited = local_entry(local_path, 'edited.txt', b'edited')
+
+    path = str(tmp_path / 'journal')
+    journal = IntentJournal(path)
+    journal.begin('load_local_file', 'done.txt', done)
+    journal.done('done.txt', {'done.txt': done})
+    # Uploaded, the crash came before its result was written
+    journal.begin('load_local_file', 'sent.txt', sent)
+    journal.begin('load_local_file', 'unsent.txt', unsent)
+    # Uploaded, then changed again before the restart
+    journal.begin('load_local_file', 'edited.txt', edited)
+    journal.begin('delete_remote_file', 'gone.txt', None)
+    journal.begin('delete_remote_file', 'kept.txt', None)
+    journal.close()
+    with open(path, 'a') as file:
+        file.write('{"done": "unsent.txt", "chan')
+    local_entry(local_path, 'edited.txt', b'edited again')
+    remote_files = RemoteFiles({
+        'done.txt': done['sha256'], 'sent.txt': sent['sha256'], 'edited.txt': edited['sha256'], 'kept.txt': 'k',
+    })
+
+    record_keeping.journal = IntentJournal(path)
+    replay_journal(remote_files, record_keeping, Queue(), config)
+
+    assert dict(record_keeping.items()) == {'done.txt': done, 'sent.txt': sent, 'kept.txt': entry('k')}
+    # Committed, the open intents are planned again by the next scan and the journal starts over
+    assert JsonRecordKeeping(str(tmp_path / 'record_keeping.json')).get('sent.txt') == sent
+    with open(path, 'r') as file:
+        assert file.read() == ''
+
+
+def test_verify_intent_skips_stored_forms(tmp_path):
+    local_path = str(tmp_path)
+    sent = local_entry(local_path, 'a.txt', b'a')
+    record_keeping = JsonRecordKeeping(str(tmp_path / 'record_keeping.json'))
+    record_keeping['a.txt'] = {**entry('old'), 'remote_path': 'a.txt.gz'}
+    intent = {'intent': 'load_local_file', 'path': 'a.txt', 'entry': sent}
+
+    # The remote file under its own name tells nothing about a compressed one
+    assert not verify_intent(intent, record_keeping, RemoteFiles({'a.txt': sent['sha256']}), Config(local_path=local_path))
+    assert verify_intent({**intent, 'intent': 'push_local_file'}, JsonRecordKeeping(str(tmp_path / 'other.json')), RemoteFiles({'a.txt': sent['sha256']}), Config(local_path=local_path))
@@ -0,0 +1,193 @@
+import pytest
+
+from reconciliation import (
+    CONFLICT, DELETE, DELETE_LOCAL, DOWNLOAD, FORGET, OVERWRITE, RECORD, UPLOAD, bidirectional_diff, removed_folders,
+    three_way_diff,
+)
+
+
+def entry(sha256, size=1, mtime_ns=1, inode=1):
+    return {'size': size, 'mtime_ns': mtime_ns, 'inode': inode, 'sha256': sha256}
+
+
+def remote(sha256, size=1):
+    return {'size': size, 'md5': None, 'sha256': sha256, 'modified': None}
+
+
+@pytest.mark.parametrize('local, last, remote_entry, expected', [
+    # Unchanged everywhere, nothing to do
+    (entry('a'), entry('a'), remote('a'), None),
+    # New file
+    (entry('a'), None, None, (UPLOAD, entry('a'))),
+    # New file already on the remote with the same content
+    (entry('a'), None, remote('a'), (RECORD, entry('a'))),
+    # New file, the remote holds other content under its name
+    (entry('a'), None, remote('b'), (OVERWRITE, entry('a'))),
+    # Edited locally
+    (entry('b'), entry('a'), remote('a'), (OVERWRITE, entry('b'))),
+    # Recorded but removed from the remote, uploaded again
+    (entry('a'), entry('a'), None, (UPLOAD, entry('a'))),
+    # Touched without a content change
+    (entry('a', mtime_ns=2), entry('a'), remote('a'), (RECORD, entry('a', mtime_ns=2))),
+    # Removed locally
+    (None, entry('a'), remote('a'), (DELETE, entry('a'))),
+    # Removed on both sides
+    (None, entry('a'), None, (FORGET, entry('a'))),
+])
+def test_three_way_diff(local, last, remote_entry, expected):
+    local_data = {'dir/file.txt': local} if local is not None else {}
+    last_local_data = {'dir/file.txt': last} if last is not None else {}
+    remote_index = {'dir/file.txt': remote_entry} if remote_entry is not None else {}
+
+    actions = three_way_diff(local_data, last_local_data, remote_index)
+
+    if expected is None:
+        assert actions == []
+    else:
+        assert actions == [(expected[0], 'dir/file.txt', expected[1])]
+
+
+def test_three_way_diff_legacy_size_entry():
+    # Record keeping from before hashing holds the size only
+    assert three_way_diff({'a.txt': entry('a', size=5)}, {'a.txt': 5}, {'a.txt': remote(None, size=5)}) == [
+        (OVERWRITE, 'a.txt', entry('a', size=5)),
+    ]
+    assert three_way_diff({}, {'a.txt': 5}, {'a.txt': remote(None, size=5)}) == [(DELETE, 'a.txt', 5)]
+
+
+def test_three_way_diff_compressed_file():
+    last = {**entry('a'), 'remote_path': 'a.txt.gz', 'compression': 'gzip', 'compressed_sha256': 'gz'}
+    remote_index = {'a.txt.gz': remote('gz')}
+
+    # Compared by the stored name and the hash of the compressed object
+    assert three_way_diff({'a.txt': entry('a')}, {'a.txt': last}, remote_index) == []
+    assert three_way_diff({'a.txt': entry('a')}, {'a.txt': last}, {'a.txt.gz': remote('other')}) == [
+        (OVERWRITE, 'a.txt', entry('a')),
+    ]
+    assert three_way_diff({}, {'a.txt': last}, remote_index) == [(DELETE, 'a.txt', last)]
+
+
+def test_three_way_diff_chunked_file():
+    last = {**entry('a'), 'remote_path': 'a.bin.manifest'}
+    remote_index = {'a.bin': {'manifest': True, 'modified': None}}
+
+    assert three_way_diff({'a.bin': entry('a')}, {'a.bin': last}, remote_index) == []
+    assert three_way_diff({'a.bin': entry('b')}, {'a.bin': last}, remote_index) == [(OVERWRITE, 'a.bin', entry('b'))]
+
+
+def test_three_way_diff_packed_file():
+    last = {**entry('a'), 'remote_path': '.file_synch_bundles'}
+
+    # Bundles are not in the listing, a packed file is trusted while unchanged
+    assert three_way_diff({'small.txt': entry('a')}, {'small.txt': last}, {}) == []
+    assert three_way_diff({'small.txt': entry('b')}, {'small.txt': last}, {}) == [(OVERWRITE, 'small.txt', entry('b'))]
+
+
+@pytest.mark.parametrize('local, last, remote_entry, expected', [
+    (entry('a'), entry('a'), remote('a'), None),
+    # New on one side
+    (entry('a'), None, None, (UPLOAD, entry('a'))),
+    (None, None, remote('a'), (DOWNLOAD, remote('a'))),
+    # New on both sides
+    (entry('a'), None, remote('a'), (RECORD, entry('a'))),
+    (entry('a'), None, remote('b'), (CONFLICT, entry('a'))),
+    # Changed on one side
+    (entry('b'), entry('a'), remote('a'), (OVERWRITE, entry('b'))),
+    (entry('a'), entry('a'), remote('b'), (DOWNLOAD, remote('b'))),
+    (None, entry('a'), remote('a'), (DELETE, entry('a'))),
+    (entry('a'), entry('a'), None, (DELETE_LOCAL, entry('a'))),
+    # Changed on both sides
+    (entry('b'), entry('a'), remote('c'), (CONFLICT, entry('b'))),
+    (entry('b'), entry('a'), remote('b'), (RECORD, entry('b'))),
+    (None, entry('a'), None, (FORGET, entry('a'))),
+    # Removed here, edited there: the edit wins
+    (None, entry('a'), remote('b'), (DOWNLOAD, remote('b'))),
+    # Removed there, edited here: the edit wins
+    (entry('b'), entry('a'), None, (UPLOAD, entry('b'))),
+    # Touched without a content change
+    (entry('a', mtime_ns=2), entry('a'), remote('a'), (RECORD, entry('a', mtime_ns=2))),
+    # A listing without a hash does not count as a remote change
+    (entry('a'), entry('a'), remote(None), None),
+])
+def test_bidirectional_diff(local, last, remote_entry, expected):
+    local_data = {'dir/file.txt': local} if local is not None else {}
+    last_local_data = {'dir/file.txt': last} if last is not None else {}
+    remote_index = {'dir/file.txt': remote_entry} if remote_entry is not None else {}
+
+    actions = bidirectional_diff(local_data, last_local_data, remote_index)
+
+    if expected is None:
+        assert actions == []
+    else:
+        assert actions == [(expected[0], 'dir/file.txt', expected[1])]
+
+
+def test_bidirectional_diff_remote_deleted_and_locally_new():
+    # One file removed on the remote, another created locally in the same pass
+    local_data = {'kept.txt': entry('k'), 'gone.txt': entry('g'), 'new.txt': entry('n')}
+    last_local_data = {'kept.txt': entry('k'), 'gone.txt': entry('g')}
+    remote_index = {'kept.txt': remote('k')}
+
+    actions = bidirectional_diff(local_data, last_local_data, remote_index)
+
+    assert sorted(actions, key=lambda action: action[1]) == [
+        (DELETE_LOCAL, 'gone.txt', entry('g')),
+        (UPLOAD, 'new.txt', entry('n')),
+    ]
+
+
+def test_bidirectional_diff_pushes_stored_files_only():
+    # Compressed files are synchronized one way, their stored object is not downloaded as a new file
+    last = {**entry('a'), 'remote_path': 'a.txt.gz', 'compression': 'gzip', 'compressed_sha256': 'gz'}
+
+    assert bidirectional_diff({'a.txt': entry('a')}, {'a.txt': last}, {'a.txt.gz': remote('gz')}) == []
+    assert bidirectional_diff({'a.txt': entry('a')}, {'a.txt': last}, {}) == [(UPLOAD, 'a.txt', entry('a'))]
+
+
+def test_removed_folders_returns_topmost_folder():
+    recorded = ['a/1.txt', 'a/b/2.txt', 'a/b/c/3.txt', 'top.txt']
+    deleted = {'a/1.txt': entry('1'), 'a/b/2.txt': entry('2'), 'a/b/c/3.txt': entry('3')}
+
+    assert removed_folders(deleted, recorded) == {'a': ['a/1.txt', 'a/b/2.txt', 'a/b/c/3.txt']}
+
+
+def test_removed_folders_keeps_folder_with_remaining_file():
+    recorded = ['a/1.txt', 'a/b/2.txt', 'a/b/3.txt']
+    deleted = {'a/1.txt': entry('1'), 'a/b/2.txt': entry('2'), 'a/b/3.txt': entry('3')}
+    assert removed_folders(deleted, recorded) == {'a': ['a/1.txt', 'a/b/2.txt', 'a/b/3.txt']}
+
+    # a keeps a recorded file, only a/b goes
+    recorded.append('a/kept.txt')
+    assert removed_folders(deleted, recorded) == {'a/b': ['a/b/2.txt', 'a/b/3.txt']}
+
+
+def test_removed_folders_ignores_root_files():
+    assert removed_folders({'top.txt': entry('t')}, ['top.txt']) == {}
+
+
+def test_removed_folders_keeps_folders_with_other_remote_files():
+    recorded = ['a/1.txt']
+    deleted = {'a/1.txt': entry('1')}
+
+    assert removed_folders(deleted, recorded, {'a/1.txt': remote('1')}) == {'a': ['a/1.txt']}
+    # A file uploaded by another client is not lost with the folder
+    assert removed_folders(deleted, recorded, {'a/1.txt': remote('1'), 'a/other.txt': remote('o')}) == {}
+
+
+def test_removed_folders_allows_stored_remote_names():
+    last = {**entry('1'), 'remote_path': 'a/1.txt.gz', 'compression': 'gzip', 'compressed_sha256': 'gz'}
+
+    assert removed_folders({'a/1.txt': last}, ['a/1.txt'], {'a/1.txt.gz': remote('gz')}) == {'a': ['a/1.txt']}
+
+
+def test_removed_folders_keeps_folders_present_locally():
+    recorded = ['a/1.txt', 'a/b/2.txt']
+    deleted = {'a/1.txt': entry('1'), 'a/b/2.txt': entry('2')}
+
+    assert removed_folders(deleted, recorded, exists=lambda rel_dir: rel_dir == 'a') == {'a/b': ['a/b/2.txt']}
+
+
+def test_removed_folders_keeps_store_folders():
+    deleted = {'.chunks/x': entry('x'), '.file_synch_bundles/y': entry('y')}
+
+    assert removed_folders(deleted, list(deleted)) == {}
@@ -0,0 +1,89 @@
+from datetime import datetime
+
+import pytest
+
+from transfer import BandwidthLimiter, parse_bandwidth_schedule
+
+# 2024-01-01 is a Monday
+MONDAY = 1
+SATURDAY = 6
+SUNDAY = 7
+
+
+def at(day, hour, minute=0):
+    return datetime(2024, 1, day, hour, minute)
+
+
+def test_parse_bandwidth_schedule():
+    assert parse_bandwidth_schedule('mon-fri 09:00-18:00 1048576, sat 10:30-12:00 0') == (
+        (frozenset(range(5)), 9 * 60, 18 * 60, 1048576),
+        (frozenset({5}), 10 * 60 + 30, 12 * 60, 0),
+    )
+
+
+def test_parse_bandwidth_schedule_defaults():
+    # Days are optional, empty entries are skipped
+    assert parse_bandwidth_schedule('') == ()
+    assert parse_bandwidth_schedule(' 01:00-02:00 100 , ') == ((frozenset(range(7)), 60, 120, 100),)
+
+
+def test_parse_bandwidth_schedule_day_range_wraps_the_week():
+    assert parse_bandwidth_schedule('fri-mon 00:00-24:00 1') == ((frozenset({4, 5, 6, 0}), 0, 24 * 60, 1),)
+
+
+@pytest.mark.parametrize('schedule, message', [
+    ('09:00-18:00', 'Wrong window'),
+    ('mon 09:00-18:00 fast', 'Wrong window'),
+    ('mon 09:00-18:00 100 extra', 'Wrong window'),
+    ('weekdays 09:00-18:00 100', 'Unknown days'),
+    ('mon-someday 09:00-18:00 100', 'Unknown days'),
+    ('09:00 100', 'Wrong time'),
+    ('9-18:00 100', 'Wrong time'),
+    ('09:60-18:00 100', 'Wrong time'),
+    ('09:00-25:00 100', 'Wrong time'),
+])
+def test_parse_bandwidth_schedule_invalid(schedule, message):
+    with pytest.raises(ValueError, match=message):
+        parse_bandwidth_schedule(schedule)
+
+
+def test_current_rate_uses_first_matching_window():
+    limiter = BandwidthLimiter(500, parse_bandwidth_schedule('mon-fri 09:00-18:00 100, 12:00-13:00 200'))
+
+    assert limiter.current_rate(at(MONDAY, 9)) == 100
+    assert limiter.current_rate(at(MONDAY, 12, 30)) == 100
+    assert limiter.current_rate(at(SATURDAY, 12, 30)) == 200
+    # The end is exclusive, outside of the windows the plain limit applies
+    assert limiter.current_rate(at(MONDAY, 18)) == 500
+    assert limiter.current_rate(at(SATURDAY, 9)) == 500
+
+
+def test_current_rate_window_crossing_midnight():
+    # Belongs to the day it starts: Friday night runs into Saturday morning, Sunday night does not start
+    limiter = BandwidthLimiter(0, parse_bandwidth_schedule('mon-fri 22:00-06:00 100'))
+
+    assert limiter.current_rate(at(MONDAY, 23)) == 100
+    assert limiter.current_rate(at(MONDAY + 1, 5, 59)) == 100
+    assert limiter.current_rate(at(MONDAY + 1, 6)) == 0
+    assert limiter.current_rate(at(SATURDAY, 3)) == 100
+    assert limiter.current_rate(at(SATURDAY, 23)) == 0
+    assert limiter.current_rate(at(SUNDAY, 23)) == 0
+    assert limiter.current_rate(at(MONDAY, 3)) == 0
+
+
+def test_configure_keeps_windows():
+    limiter = BandwidthLimiter(0, parse_bandwidth_schedule('00:00-24:00 100'))
+
+    limiter.configure(500)
+    assert limiter.current_rate(at(MONDAY, 12)) == 100
+    limiter.configure(500, ())
+    assert limiter.current_rate(at(MONDAY, 12)) == 500
+
+
+def test_reserve():
+    assert BandwidthLimiter(0).reserve(10 ** 9) == 0.0
+
+    limiter = BandwidthLimiter(1000)
+    # The bucket starts empty, a second of the rate is the most that is sent without waiting
+    assert limiter.reserve(1000) == pytest.approx(1.0, abs=0.05)
+    assert limiter.reserve(500) == pytest.approx(1.5, abs=0.05)
@@ -0,0 +1,178 @@
+import os
+import random
+from datetime import datetime
+from threading import Lock
+from time import monotonic
+from typing import Callable, Optional
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MEGABYTE = 1024 * 1024
+WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+MINUTES_IN_DAY = 24 * 60
+
+
+class TransferAborted(Exception):
+    # Raised for a block of a transfer when the application is exiting, the transfer is left unfinished
+    pass
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    # Exponential backoff with full jitter, attempt starts from 1
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+def _parse_days(days: str) -> frozenset[int]:
+    first, _, last = days.lower().partition('-')
+    if first not in WEEKDAYS or (last and last not in WEEKDAYS):
+        raise ValueError(f'Unknown days "{days}", use mon, tue, wed, thu, fri, sat, sun or a range like mon-fri.')
+    first_index = WEEKDAYS.index(first)
+    last_index = WEEKDAYS.index(last) if last else first_index
+    return frozenset((first_index + offset) % 7 for offset in range((last_index - first_index) % 7 + 1))
+
+
+def _parse_minute(clock: str) -> int:
+    hours, _, minutes = clock.partition(':')
+    if not (hours.isdigit() and minutes.isdigit()) or int(minutes) > 59 or int(hours) * 60 + int(minutes) > MINUTES_IN_DAY:
+        raise ValueError(f'Wrong time "{clock}", use HH:MM.')
+    return int(hours) * 60 + int(minutes)
+
+
+def parse_bandwidth_schedule(schedule: str) -> tuple[tuple[frozenset[int], int, int, int], ...]:
+    # "mon-fri 09:00-18:00 1048576, 18:00-09:00 0" -> (days, start minute, end minute, bytes per second).
+    # Days are optional, a window ending before its start crosses midnight and belongs to the day it starts.
+    windows = []
+    for entry in filter(None, (part.strip() for part in schedule.split(','))):
+        parts = entry.split()
+        if len(parts) == 2:
+            parts.insert(0, 'mon-sun')
+        if len(parts) != 3 or not parts[2].isdigit():
+            raise ValueError(f'Wrong window "{entry}", use [days] HH:MM-HH:MM bytes_per_second.')
+        days, hours, limit = parts
+        start, _, end = hours.partition('-')
+        windows.append((_parse_days(days), _parse_minute(start), _parse_minute(end), int(limit)))
+    return tuple(windows)
+
+
+def _in_window(window: tuple[frozenset[int], int, int, int], weekday: int, minute: int) -> bool:
+    days, start, end, _ = window
+    if start < end:
+        return weekday in days and start <= minute < end
+    return (weekday in days and minute >= start) or ((weekday - 1) % 7 in days and minute < end)
+
+
+class BandwidthLimiter:
+    # Token bucket on the bytes sent, shared by all uploads. Like the request limiter, a read takes its bytes
+    # ahead of time and waits until they are due. The rate comes from the first window of the schedule
+    # matching the local time, limit applies outside of them. The burst is one second of the rate, 0 is unlimited.
+    def __init__(self, limit: int = 0, windows: tuple = ()):
+        self._lock = Lock()
+        self._limit = limit
+        self._windows = windows
+        self._tokens = 0.0
+        self._updated = monotonic()
+
+    def configure(self, limit: int, windows: Optional[tuple] = None):
+        # windows None keeps the current ones
+        with self._lock:
+            self._limit = limit
+            if windows is not None:
+                self._windows = windows
+
+    def current_rate(self, now: Optional[datetime] = None) -> int:
+        now = now or datetime.now()
+        weekday = now.weekday()
+        minute = now.hour * 60 + now.minute
+        window = next((window for window in self._windows if _in_window(window, weekday, minute)), None)
+        return window[3] if window is not None else self._limit
+
+    def reserve(self, bytes_count: int) -> float:
+        # Returns seconds to wait before sending bytes_count
+        with self._lock:
+            now = monotonic()
+            rate = self.current_rate()
+            if not rate:
+                self._tokens = 0.0
+                self._updated = now
+                return 0.0
+            self._tokens = min(float(rate), self._tokens + (now - self._updated) * rate) - bytes_count
+            self._updated = now
+            return max(0.0, -self._tokens / rate)
+
+
+class TransferProgress:
+    # throttle(bytes_count) is called for every block, uploads wait there for the bandwidth limiter
+    # and every transfer raises TransferAborted there once the application is exiting
+    def __init__(self, total_bytes: int, report: Optional[Callable[['TransferProgress'], None]] = None, report_interval: float = 5.0, throttle: Optional[Callable[[int], None]] = None):
+        self.total_bytes = total_bytes
+        self.bytes_done = 0
+        self.reported = False
+        self._report = report
+        self._report_interval = report_interval
+        self._throttle = throttle
+        self._started = monotonic()
+        self._last_report = self._started
+
+    def advance(self, bytes_count: int):
+        if self._throttle is not None and bytes_count:
+            self._throttle(bytes_count)
+        self.bytes_done += bytes_count
+        now = monotonic()
+        if self._report is not None and now - self._last_report >= self._report_interval:
+            self._last_report = now
+            self.reported = True
+            self._report(self)
+
+    @property
+    def elapsed(self) -> float:
+        return max(monotonic() - self._started, 1e-6)
+
+    @property
+    def throughput(self) -> float:
+        return self.bytes_done / MEGABYTE / self.elapsed
+
+    @property
+    def eta(self) -> float:
+        if not self.bytes_done:
+            return float('inf')
+        return (self.total_bytes - self.bytes_done) * self.elapsed / self.bytes_done
+
+    def describe(self) -> str:
+        percent = 100 * self.bytes_done / self.total_bytes if self.total_bytes else 100.0
+        eta = '--:--:--' if self.eta == float('inf') else '{:02d}:{:02d}:{:02d}'.format(
+            int(self.eta // 3600), int(self.eta % 3600 // 60), int(self.eta % 60)
+        )
+        return f'{percent:.1f}% {self.bytes_done / MEGABYTE:.1f}/{self.total_bytes / MEGABYTE:.1f} MB {self.throughput:.2f} MB/s ETA {eta}'
+
+
+class UploadStream:
+    # File-like body for requests: a byte range of a file read through a fixed-size buffer.
+    # __len__ lets requests send Content-Length instead of chunked encoding, every read advances progress.
+    def __init__(self, path: str, progress: TransferProgress, chunk_size: int = UPLOAD_CHUNK_SIZE, offset: int = 0, length: Optional[int] = None):
+        self._file = open(path, 'rb', buffering=chunk_size)
+        self._chunk_size = chunk_size
+        if length is None:
+            length = os.fstat(self._file.fileno()).st_size - offset
+        self._file.seek(offset)
+        self._remaining = length
+        self._length = length
+        self._progress = progress
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self._chunk_size
+        data = self._file.read(min(size, self._remaining))
+        self._remaining -= len(data)
+        self._progress.advance(len(data))
+        return data
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
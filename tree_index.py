@@ -0,0 +1,127 @@
+import json
+import os
+from typing import Optional
+
+from change_detector import stat_file
+
+
+class TreeIndex:
+    # On-disk index of the local tree keyed by relative directory path ('' is the root):
+    # {'mtime_ns': ..., 'files': {name: stat}, 'dirs': [name, ...]}.
+    # A directory whose mtime did not change keeps its cached listing, so a rescan only reads
+    # directories where entries were added, removed or renamed. In-place edits do not touch the
+    # directory mtime: without a watcher the cached files are still stat-ed, with trust_directory_mtime
+    # (set while the watcher reports edits) cached stats are reused until the periodic full rescan.
+    def __init__(self, index_path: str, full_rescan_every: int = 12):
+        self._index_path = index_path
+        self._full_rescan_every = max(1, full_rescan_every)
+        self._scans_count = 0
+        self._root = None
+        self._directories: dict[str, dict] = {}
+        self._changed = False
+        self.trust_directory_mtime = False
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self._index_path, 'r') as file:
+                data = json.load(file)
+            self._root = data['root']
+            self._directories = data['directories']
+        except (FileNotFoundError, ValueError, KeyError):
+            self._root = None
+            self._directories = {}
+
+    def save(self):
+        if not self._changed:
+            return
+        temporary_path = self._index_path + '.tmp'
+        with open(temporary_path, 'w') as file:
+            json.dump({'root': self._root, 'directories': self._directories}, file)
+        os.replace(temporary_path, self._index_path)
+        self._changed = False
+
+    def scan(self, root: str, excluded: set[str] = frozenset(), full: bool = False) -> dict[str, dict[str, int]]:
+        if root != self._root:
+            self._root = root
+            self._directories = {}
+            full = True
+        self._scans_count += 1
+        if self._scans_count % self._full_rescan_every == 0:
+            full = True
+
+        local_files_hash = {}
+        directories = {}
+        stack = ['']
+        while stack:
+            rel_dir = stack.pop()
+            abs_dir = os.path.join(root, rel_dir) if rel_dir else root
+            try:
+                mtime_ns = os.stat(abs_dir).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            cached = self._directories.get(rel_dir)
+            if not full and cached is not None and cached['mtime_ns'] == mtime_ns:
+                directory = cached if self.trust_directory_mtime else self._restat_directory(abs_dir, cached)
+                if directory is not cached:
+                    self._changed = True
+            else:
+                directory = self._read_directory(abs_dir, mtime_ns)
+                if directory != cached:
+                    self._changed = True
+            directories[rel_dir] = directory
+
+            for file_name, stat in directory['files'].items():
+                rel_path = f'{rel_dir}/{file_name}' if rel_dir else file_name
+                if rel_path not in excluded:
+                    local_files_hash[rel_path] = stat
+            for dir_name in directory['dirs']:
+                stack.append(f'{rel_dir}/{dir_name}' if rel_dir else dir_name)
+
+        if directories.keys() != self._directories.keys():
+            self._changed = True
+        self._directories = directories
+        return local_files_hash
+
+    @staticmethod
+    def _read_directory(abs_dir: str, mtime_ns: int) -> dict:
+        files = {}
+        dirs = []
+        try:
+            with os.scandir(abs_dir) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            dirs.append(entry.name)
+                        elif entry.is_file():
+                            files[entry.name] = stat_file(entry.path)
+                    except FileNotFoundError:
+                        pass
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        return {'mtime_ns': mtime_ns, 'files': files, 'dirs': sorted(dirs)}
+
+    @staticmethod
+    def _restat_directory(abs_dir: str, cached: dict) -> dict:
+        files = {}
+        for file_name in cached['files']:
+            try:
+                files[file_name] = stat_file(os.path.join(abs_dir, file_name))
+            except FileNotFoundError:
+                pass
+        if files == cached['files']:
+            return cached
+        return {**cached, 'files': files}
+
+    def update_file(self, rel_path: str, stat: Optional[dict[str, int]]):
+        # Keeps cached stats in line with changes picked up by the watcher outside of scan()
+        rel_dir, _, file_name = rel_path.rpartition('/')
+        directory = self._directories.get(rel_dir)
+        if directory is None:
+            return
+        if stat is None:
+            if directory['files'].pop(file_name, None) is not None:
+                self._changed = True
+        elif directory['files'].get(file_name) != stat:
+            directory['files'][file_name] = stat
+            self._changed = True
@@ -0,0 +1,245 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Optional
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o00004000
+IN_CLOEXEC = 0o02000000
+
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+)
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class WatcherUnavailable(Exception):
+    pass
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        raise WatcherUnavailable('inotify is available only on Linux.')
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        raise WatcherUnavailable('libc has no inotify support.')
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+class InotifyWatcher:
+    # Watches every directory of the tree and collects relative paths of changed files, handing them
+    # out once they have been quiet for `debounce` seconds. pop_dirty() returns None when events were
+    # lost or directories were added or removed, then the caller has to rescan the tree.
+    def __init__(self, path: str, debounce: float, wake_event: Optional[Event] = None):
+        self.path = path
+        self._debounce = debounce
+        self._wake_event = wake_event
+        self._libc = _load_libc()
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise WatcherUnavailable(os.strerror(ctypes.get_errno()))
+        self._watches: dict[int, str] = {}
+        try:
+            self._add_watch_tree('')
+        except WatcherUnavailable:
+            os.close(self._fd)
+            raise
+
+        self._lock = Lock()
+        self._pending: dict[str, float] = {}
+        self._dirty: set[str] = set()
+        # Files closed after writing, or renamed into place, and not touched since
+        self._closed: set[str] = set()
+        self._rescan = False
+        self.broken = False
+        self.ready_event = Event()
+        self._stop_read_fd, self._stop_write_fd = os.pipe()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _add_watch(self, rel_dir: str):
+        abs_dir = os.path.join(self.path, rel_dir) if rel_dir else self.path
+        watch_descriptor = self._libc.inotify_add_watch(self._fd, os.fsencode(abs_dir), WATCH_MASK)
+        if watch_descriptor < 0:
+            errno = ctypes.get_errno()
+            if rel_dir and errno in (2, 20):
+                # ENOENT or ENOTDIR, the directory went away before it could be watched
+                return
+            raise WatcherUnavailable(os.strerror(errno))
+        self._watches[watch_descriptor] = rel_dir
+
+    def _add_watch_tree(self, rel_dir: str):
+        # One watch per directory, ENOSPC here means fs.inotify.max_user_watches is too small for the tree
+        abs_dir = os.path.join(self.path, rel_dir) if rel_dir else self.path
+        self._add_watch(rel_dir)
+        for dir_path, dir_names, _ in os.walk(abs_dir):
+            rel_parent = os.path.relpath(dir_path, self.path)
+            for dir_name in dir_names:
+                self._add_watch(dir_name if rel_parent == '.' else f'{rel_parent}/{dir_name}')
+
+    def _run(self):
+        while True:
+            with self._lock:
+                timeout = None
+                if self._pending:
+                    timeout = max(0.0, min(self._pending.values()) + self._debounce - monotonic())
+            readable, _, _ = select.select([self._fd, self._stop_read_fd], [], [], timeout)
+            if self._stop_read_fd in readable:
+                break
+            if self._fd in readable:
+                self._read_events()
+            self._flush_quiet()
+
+    def _read_events(self):
+        try:
+            buffer = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        now = monotonic()
+        offset = 0
+        with self._lock:
+            while offset < len(buffer):
+                watch_descriptor, mask, _, name_length = _EVENT_HEADER.unpack_from(buffer, offset)
+                offset += _EVENT_HEADER.size
+                name = os.fsdecode(buffer[offset:offset + name_length].rstrip(b'\0'))
+                offset += name_length
+                rel_dir = self._watches.get(watch_descriptor)
+
+                if mask & IN_IGNORED:
+                    self._watches.pop(watch_descriptor, None)
+                elif mask & IN_Q_OVERFLOW or rel_dir is None:
+                    self._rescan = True
+                    self._set_ready()
+                elif mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    if not rel_dir:
+                        self._rescan = True
+                        self.broken = True
+                        self._set_ready()
+                elif mask & IN_ISDIR:
+                    # Whole subtrees appear or go away without events for their files,
+                    # the directory index sorts that out on a rescan
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        try:
+                            self._add_watch_tree(f'{rel_dir}/{name}' if rel_dir else name)
+                        except WatcherUnavailable:
+                            pass
+                    self._rescan = True
+                    self._set_ready()
+                elif name:
+                    rel_path = f'{rel_dir}/{name}' if rel_dir else name
+                    self._pending[rel_path] = now
+                    if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                        self._closed.add(rel_path)
+                    elif mask & (IN_MODIFY | IN_CREATE | IN_DELETE | IN_MOVED_FROM):
+                        self._closed.discard(rel_path)
+
+    def _flush_quiet(self):
+        now = monotonic()
+        with self._lock:
+            quiet = [name for name, last_event in self._pending.items() if now - last_event >= self._debounce]
+            for name in quiet:
+                self._pending.pop(name)
+                self._dirty.add(name)
+            if quiet:
+                self._set_ready()
+
+    def _set_ready(self):
+        self.ready_event.set()
+        if self._wake_event is not None:
+            self._wake_event.set()
+
+    def has_dirty(self) -> bool:
+        return self.ready_event.is_set()
+
+    def pop_dirty(self) -> Optional[set[str]]:
+        with self._lock:
+            self.ready_event.clear()
+            dirty, self._dirty = self._dirty, set()
+            if self._rescan:
+                self._rescan = False
+                return None
+            return dirty
+
+    def pop_closed(self, rel_paths: set[str]) -> set[str]:
+        # Those of rel_paths no writer has touched since they were closed
+        with self._lock:
+            closed = self._closed & rel_paths
+            self._closed -= closed
+            return closed
+
+    def close(self):
+        os.write(self._stop_write_fd, b'\0')
+        self._thread.join()
+        for fd in (self._fd, self._stop_read_fd, self._stop_write_fd):
+            os.close(fd)
+
+
+class FolderWatch:
+    # Keeps an InotifyWatcher on the current local folder, with interval polling as the fallback.
+    # pop_dirty() returns None whenever the whole folder has to be scanned.
+    def __init__(self, wake_event: Optional[Event] = None):
+        self.watcher: Optional[InotifyWatcher] = None
+        self._wake_event = wake_event
+        self._failed_path = None
+        self._restarted = True
+
+    def refresh(self, path: str, watch_mode: str, debounce: float) -> Optional[str]:
+        if watch_mode != 'inotify':
+            self.close()
+            return None
+        if self.watcher is not None and self.watcher.path == path:
+            return None
+        self.close()
+        if path == self._failed_path or not os.path.isdir(path):
+            return None
+        try:
+            self.watcher = InotifyWatcher(path, debounce, self._wake_event)
+            self._failed_path = None
+        except WatcherUnavailable as e:
+            self._failed_path = path
+            return str(e)
+
+    def has_dirty(self) -> bool:
+        return self.watcher is not None and self.watcher.has_dirty()
+
+    def pop_dirty(self) -> Optional[set[str]]:
+        if self.watcher is None:
+            return None
+        dirty = self.watcher.pop_dirty()
+        if self._restarted:
+            self._restarted = False
+            return None
+        if self.watcher.broken:
+            # The folder itself went away or was moved, start over with a fresh watch
+            self.close()
+        return dirty
+
+    def pop_closed(self, rel_paths: set[str]) -> set[str]:
+        if self.watcher is None:
+            return set()
+        return self.watcher.pop_closed(rel_paths)
+
+    def close(self):
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+            self._restarted = True